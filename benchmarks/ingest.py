@@ -0,0 +1,364 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python benchmarks/ingest.py [--output results.json]
+                                       [--compare baseline.json]
+
+    Runs generated notification streams (see benchmarks/notifications.py)
+    through views.process_raw_data() and the post processing the worker
+    does for each message, one scenario after another:
+
+        nova_lifecycles  creates, rebuilds, resizes and deletes, with many
+                         compute.instance.update events
+        nova_exists      the compute.instance.exists burst at the end of
+                         the audit period for those instances
+        glance_images    image.activate and image.delete
+        glance_exists    image.exists, each carrying many images
+
+    and reports messages/sec and SQL statements per message for each
+    scenario, plus the p50/p99 latency and statements per message of
+    each event type. With --batch-size messages go through in batches
+    the way a worker with that batch_size (or an exists burst) takes
+    them, and each message is counted as its share of its batch.
+
+    Each run gets a freshly created test database from the configured
+    settings (in memory for sqlite), so the stream and the database it
+    runs against are the same every time. Statement counts should then
+    only change when the code does. Save a run with --output and pass it
+    to a later run with --compare to see the differences; the exit status
+    is 1 if anything got slower than --threshold allows or ran more
+    statements.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir, os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'stacktach')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.db import connection
+from south.management.commands import patch_for_test_db_setup
+
+from notifications import NotificationGenerator
+from stacktach import db
+from stacktach import usage_cache
+from stacktach import views
+from worker import worker
+
+SCENARIOS = ['nova_lifecycles', 'nova_exists', 'glance_images',
+             'glance_exists']
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a sorted list."""
+    if not values:
+        return 0
+    index = int(round(fraction * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class Results(object):
+    """Latency and statement counts for one scenario, overall and by event
+    type."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.queries = {}
+        self.elapsed = 0.0
+
+    def add(self, event, seconds, queries):
+        self.latencies.setdefault(event, []).append(seconds)
+        self.queries[event] = self.queries.get(event, 0) + queries
+
+    def to_dict(self):
+        messages = sum(len(l) for l in self.latencies.values())
+        queries = sum(self.queries.values())
+        events = {}
+        for event, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            events[event] = {
+                'messages': len(latencies),
+                'queries_per_message': self.queries[event] /
+                                       float(len(latencies)),
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000}
+        return {'messages': messages,
+                'seconds': self.elapsed,
+                'messages_per_second': messages / self.elapsed
+                                       if self.elapsed else 0,
+                'queries_per_message': queries / float(messages)
+                                       if messages else 0,
+                'events': events}
+
+
+def generate(args):
+    """Returns {scenario: [(exchange, routing_key, body), ...]}. Later
+    scenarios refer back to what earlier ones made, so all of them are
+    always generated in order even if only some are run."""
+    generator = NotificationGenerator(args.seed)
+    streams = {}
+    streams['nova_lifecycles'] = generator.nova_lifecycles(args.instances,
+                                                           args.updates)
+    streams['nova_exists'] = generator.nova_exists()
+    streams['glance_images'] = generator.glance_images(args.owners,
+                                                       args.images)
+    streams['glance_exists'] = generator.glance_exists()
+    return streams
+
+
+def ingest(deployment, exchange, routing_key, body):
+    """Does what the worker does for a single message, less the ack."""
+    json_args = json.dumps([routing_key, body])
+    # Decoded the way the worker decodes, so the bodies aren't shared
+    # with the generator.
+    args = json.loads(json_args)
+    raw, notif = views.process_raw_data(deployment, args, json_args,
+                                        exchange)
+    worker.POST_PROCESS_METHODS[raw.get_name()](raw, notif)
+
+
+def ingest_batch(deployment, exchange, messages):
+    """Does what the worker does for a batch of messages from one exchange,
+    less the acks."""
+    decoded = []
+    for routing_key, body in messages:
+        json_args = json.dumps([routing_key, body])
+        decoded.append((json.loads(json_args), json_args))
+    results = views.process_raw_data_batch(deployment, decoded, exchange)
+    if not results:
+        return
+    name = results[0][0].get_name()
+    if len(results) > 1 and name in worker.BATCH_POST_PROCESS_METHODS:
+        worker.BATCH_POST_PROCESS_METHODS[name](results)
+        return
+    for raw, notif in results:
+        worker.POST_PROCESS_METHODS[name](raw, notif)
+
+
+def _batches(messages, batch_size):
+    """Consecutive runs of up to batch_size messages from one exchange."""
+    batch = []
+    for message in messages:
+        if batch and (len(batch) == batch_size or
+                      batch[0][0] != message[0]):
+            yield batch
+            batch = []
+        batch.append(message)
+    if batch:
+        yield batch
+
+
+def run_scenario(deployment, messages, batch_size=1):
+    results = Results()
+    start = time.time()
+    if batch_size > 1:
+        for batch in _batches(messages, batch_size):
+            batch_start = time.time()
+            ingest_batch(deployment, batch[0][0],
+                         [(routing_key, body)
+                          for exchange, routing_key, body in batch])
+            seconds = (time.time() - batch_start) / len(batch)
+            queries = len(connection.queries) / float(len(batch))
+            for exchange, routing_key, body in batch:
+                results.add(body['event_type'], seconds, queries)
+        results.elapsed = time.time() - start
+        return results
+    for exchange, routing_key, body in messages:
+        message_start = time.time()
+        # process_raw_data() resets connection.queries, so what's left
+        # afterwards is this message's.
+        ingest(deployment, exchange, routing_key, body)
+        results.add(body['event_type'], time.time() - message_start,
+                    len(connection.queries))
+    results.elapsed = time.time() - start
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=POSSIBLE_TOPDIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print "%-16s %8s %10s %10s" % ('scenario', 'messages', 'msgs/sec',
+                                   'queries')
+    for scenario in SCENARIOS:
+        if scenario not in results['scenarios']:
+            continue
+        summary = results['scenarios'][scenario]
+        print "%-16s %8d %10.1f %10.2f" % (
+            scenario, summary['messages'], summary['messages_per_second'],
+            summary['queries_per_message'])
+    print
+    print "%-54s %8s %10s %10s %10s" % ('event', 'messages', 'p50 ms',
+                                        'p99 ms', 'queries')
+    for scenario in SCENARIOS:
+        if scenario not in results['scenarios']:
+            continue
+        events = results['scenarios'][scenario]['events']
+        for event in sorted(events):
+            summary = events[event]
+            print "%-54s %8d %10.2f %10.2f %10.2f" % (
+                '%s %s' % (scenario, event), summary['messages'],
+                summary['p50_ms'], summary['p99_ms'],
+                summary['queries_per_message'])
+
+
+def compare(results, baseline, threshold):
+    """Prints how results differ from baseline and returns the number of
+    regressions. Statement counts are deterministic, so any increase is a
+    regression. Timings are noisy, so they only count once they're worse
+    by more than threshold (a fraction)."""
+    regressions = 0
+    if baseline.get('options') != results['options']:
+        print "Warning: baseline was run with different options: %s" % \
+              baseline.get('options')
+    print
+    print "Compared with %s:" % (baseline.get('commit') or 'baseline')
+
+    def check(name, old, new, higher_is_worse, exact=False):
+        if not old:
+            return 0
+        change = (new - old) / float(old)
+        worse = change if higher_is_worse else -change
+        regressed = worse > 0 if exact else worse > threshold
+        print "%-56s %10.2f %10.2f %+7.1f%%%s" % (
+            name, old, new, change * 100, '  REGRESSED' if regressed else '')
+        return int(regressed)
+
+    for scenario in SCENARIOS:
+        old = baseline['scenarios'].get(scenario)
+        new = results['scenarios'].get(scenario)
+        if not old or not new:
+            continue
+        regressions += check('%s msgs/sec' % scenario,
+                             old['messages_per_second'],
+                             new['messages_per_second'], False)
+        for event in sorted(new['events']):
+            if event not in old['events']:
+                continue
+            old_event, new_event = old['events'][event], new['events'][event]
+            regressions += check('%s %s queries' % (scenario, event),
+                                 old_event['queries_per_message'],
+                                 new_event['queries_per_message'], True,
+                                 exact=True)
+            regressions += check('%s %s p50' % (scenario, event),
+                                 old_event['p50_ms'], new_event['p50_ms'],
+                                 True)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach ingest benchmark')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='Only run this scenario. Can be repeated.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=10,
+                        help='compute.instance.update events per action.')
+    parser.add_argument('--owners', type=int, default=10,
+                        help='Glance image owners, each gets one exists.')
+    parser.add_argument('--images', type=int, default=50,
+                        help='Images per owner.')
+    parser.add_argument('--lifecycle-cache-size', type=int, default=0)
+    parser.add_argument('--usage-cache-size', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Messages saved and post processed together.')
+    parser.add_argument('--output', help='Write the results here as json.')
+    parser.add_argument('--compare',
+                        help='json results of an earlier run to compare '
+                             'with.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='How much slower a timing can get before it '
+                             'is called a regression. Default 0.2 (20%%).')
+    args = parser.parse_args()
+    scenarios = args.scenario or SCENARIOS
+
+    streams = generate(args)
+
+    patch_for_test_db_setup()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    engine = None
+    try:
+        connection.use_debug_cursor = True
+        if args.lifecycle_cache_size:
+            engine = worker.lifecycle_engine.LifecycleStateEngine(
+                db, max_instances=args.lifecycle_cache_size)
+        views.LIFECYCLE_ENGINE = engine
+        if args.usage_cache_size:
+            views.USAGE_CACHE = usage_cache.UsageCache(
+                db, max_instances=args.usage_cache_size)
+        deployment, new = db.get_or_create_deployment('benchmark')
+
+        results = {'commit': git_commit(),
+                   'time': time.time(),
+                   'database': connection.vendor,
+                   'options': {'seed': args.seed,
+                               'instances': args.instances,
+                               'updates': args.updates,
+                               'owners': args.owners,
+                               'images': args.images,
+                               'lifecycle_cache_size':
+                                   args.lifecycle_cache_size,
+                               'usage_cache_size': args.usage_cache_size,
+                               'batch_size': args.batch_size},
+                   'scenarios': {}}
+        for scenario in SCENARIOS:
+            if scenario in scenarios:
+                results['scenarios'][scenario] = run_scenario(
+                    deployment, streams[scenario],
+                    batch_size=args.batch_size).to_dict()
+            else:
+                # Still needed by the scenarios that follow, but not
+                # measured.
+                for exchange, routing_key, body in streams[scenario]:
+                    ingest(deployment, exchange, routing_key, body)
+            if engine is not None:
+                engine.flush()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
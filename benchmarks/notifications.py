@@ -0,0 +1,338 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python benchmarks/notifications.py <file> [options]
+
+    Generates synthetic nova and glance notification streams shaped like
+    a real deployment's: instance lifecycles with a storm of
+    compute.instance.update events around every action, the burst of
+    compute.instance.exists at the end of an audit period, and glance
+    image.exists events that each carry many images.
+
+    The output is seeded, so the same options always give the same
+    stream. Written to a file, each line is a json [routing_key, body]
+    pair that scripts/replay_notifications.py can read.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import uuid
+
+START = datetime.datetime(2013, 5, 15)
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+ROUTING_KEY = 'monitor.info'
+
+FLAVORS = [('1', '2'), ('2', '3'), ('3', '4'), ('4', '5'), ('5', '6')]
+IMAGE_META = [
+    {'image_type': 'base', 'os_type': 'linux', 'os_distro': 'ubuntu',
+     'org.openstack__1__architecture': 'x64',
+     'org.openstack__1__os_distro': 'org.ubuntu',
+     'org.openstack__1__os_version': '12.04',
+     'com.rackspace__1__options': '0'},
+    {'image_type': 'base', 'os_type': 'linux', 'os_distro': 'centos',
+     'org.openstack__1__architecture': 'x64',
+     'org.openstack__1__os_distro': 'org.centos',
+     'org.openstack__1__os_version': '6.4',
+     'com.rackspace__1__options': '0'},
+    {'image_type': 'snapshot', 'os_type': 'windows',
+     'org.openstack__1__architecture': 'x64',
+     'org.openstack__1__os_distro': 'com.microsoft.server',
+     'org.openstack__1__os_version': '2008.2',
+     'com.rackspace__1__options': '1'},
+]
+
+# (start event, end event, task states the updates walk through) for
+# each action. Resizes get both their prep and finish halves.
+ACTIONS = {
+    'create': [('compute.instance.create.start',
+                'compute.instance.create.end',
+                ['scheduling', 'block_device_mapping', 'networking',
+                 'spawning'])],
+    'rebuild': [('compute.instance.rebuild.start',
+                 'compute.instance.rebuild.end',
+                 ['rebuilding', 'rebuild_block_device_mapping',
+                  'rebuild_spawning'])],
+    'resize': [('compute.instance.resize.prep.start',
+                'compute.instance.resize.prep.end',
+                ['resize_prep', 'resize_migrating']),
+               ('compute.instance.finish_resize.start',
+                'compute.instance.finish_resize.end',
+                ['resize_migrated', 'resize_finish'])],
+    'delete': [('compute.instance.delete.start',
+                'compute.instance.delete.end',
+                ['deleting'])],
+}
+
+# The end events that give an instance a new launched_at.
+LAUNCH_EVENTS = ['compute.instance.create.end',
+                 'compute.instance.rebuild.end',
+                 'compute.instance.finish_resize.end']
+
+
+def _format(when):
+    return when.strftime(TIME_FORMAT)
+
+
+class NotificationGenerator(object):
+    """Builds notification streams from a seeded random number generator.
+    The nova exists burst covers the instances made by earlier calls to
+    nova_lifecycles(), and glance_exists() the images made by
+    glance_images()."""
+
+    def __init__(self, seed=0, start=START):
+        self.random = random.Random(seed)
+        self.start = start
+        self.end = start + datetime.timedelta(days=1)
+        self.sequence = 0
+        self.instances = []
+        self.images = []
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def _when(self):
+        seconds = self.random.uniform(0, 86400 - 3600)
+        return self.start + datetime.timedelta(seconds=seconds)
+
+    def _body(self, event_type, publisher, when, payload, request_id=None):
+        self.sequence += 1
+        body = {'event_type': event_type,
+                'publisher_id': publisher,
+                'timestamp': _format(when),
+                'message_id': self._uuid(),
+                'priority': 'INFO',
+                '_context_request_id': request_id or 'req-%s' % self._uuid(),
+                '_context_project_id': payload.get('tenant_id'),
+                'payload': payload}
+        return when, self.sequence, body
+
+    def _instance_payload(self, instance, state, task=None,
+                          old_state=None, old_task=None):
+        payload = {'instance_id': instance['uuid'],
+                   'tenant_id': instance['tenant'],
+                   'instance_type_id': instance['flavor'][0],
+                   'instance_flavor_id': instance['flavor'][1],
+                   'state': state,
+                   'old_state': old_state or state,
+                   'new_task_state': task,
+                   'old_task_state': old_task,
+                   'image_meta': instance['image_meta'],
+                   'launched_at': instance['launched_at'] or '',
+                   'deleted_at': '',
+                   'terminated_at': '',
+                   'audit_period_beginning': _format(self.start),
+                   'audit_period_ending': _format(self.end)}
+        return payload
+
+    def _action(self, instance, action, when, updates):
+        """The events for one action on instance, starting at when."""
+        events = []
+        request_id = 'req-%s' % self._uuid()
+        host = 'compute.%s' % instance['host']
+        for start_event, end_event, tasks in ACTIONS[action]:
+            if start_event == 'compute.instance.finish_resize.start':
+                instance['flavor'] = self.random.choice(FLAVORS)
+            state = 'building' if action == 'create' else 'active'
+            payload = self._instance_payload(instance, state,
+                                             task=tasks[0])
+            events.append(self._body(start_event, host, when, payload,
+                                     request_id))
+            # Every state and task change sends an update, and so do
+            # progress and power state syncs, so there are usually far
+            # more updates than anything else.
+            old_task = None
+            for i in range(updates):
+                when += datetime.timedelta(seconds=self.random.uniform(
+                    0.1, 5))
+                task = tasks[i * len(tasks) // updates]
+                payload = self._instance_payload(instance, state,
+                                                 task=task,
+                                                 old_task=old_task)
+                publisher = host if i % 4 else 'api.%s' % instance['host']
+                events.append(self._body('compute.instance.update',
+                                         publisher, when, payload,
+                                         request_id))
+                old_task = task
+            when += datetime.timedelta(seconds=self.random.uniform(1, 30))
+            if end_event in LAUNCH_EVENTS:
+                instance['launched_at'] = _format(when)
+            end_state = 'deleted' if action == 'delete' else 'active'
+            payload = self._instance_payload(instance, end_state,
+                                             old_state=state,
+                                             old_task=old_task)
+            if action == 'create':
+                payload['message'] = 'Success'
+            if action == 'delete':
+                instance['deleted_at'] = _format(when)
+                payload['deleted_at'] = instance['deleted_at']
+                payload['terminated_at'] = instance['deleted_at']
+            events.append(self._body(end_event, host, when, payload,
+                                     request_id))
+        return events, when
+
+    def nova_lifecycles(self, count, updates=10):
+        """Creates count instances and puts some of them through
+        rebuilds, resizes and deletes. Events for different instances are
+        interleaved in timestamp order."""
+        events = []
+        for i in range(count):
+            instance = {'uuid': self._uuid(),
+                        'tenant': str(self.random.randint(1, count // 10 + 1)),
+                        'host': 'cpu%03d-n01.example.com' %
+                                self.random.randint(1, 50),
+                        'flavor': self.random.choice(FLAVORS),
+                        'image_meta': self.random.choice(IMAGE_META),
+                        'launched_at': None,
+                        'deleted_at': None}
+            self.instances.append(instance)
+            actions = ['create']
+            actions.extend(a for a in ('rebuild', 'resize')
+                           if self.random.random() < 0.3)
+            if self.random.random() < 0.25:
+                actions.append('delete')
+            when = self._when()
+            for action in actions:
+                found, when = self._action(instance, action, when, updates)
+                events.extend(found)
+                when += datetime.timedelta(
+                    seconds=self.random.uniform(10, 600))
+        return [('nova', ROUTING_KEY, body) for when, seq, body in
+                sorted(events)]
+
+    def nova_exists(self):
+        """The audit period's compute.instance.exists for every instance
+        made so far, all within a few minutes of the period ending."""
+        events = []
+        for instance in self.instances:
+            when = self.end + datetime.timedelta(
+                seconds=self.random.uniform(0, 300))
+            payload = self._instance_payload(instance, 'active')
+            if instance['deleted_at']:
+                payload['state'] = 'deleted'
+                payload['deleted_at'] = instance['deleted_at']
+            payload['bandwidth'] = {'public': {
+                'bw_in': self.random.randint(0, 10 ** 9),
+                'bw_out': self.random.randint(0, 10 ** 9)}}
+            events.append(self._body('compute.instance.exists',
+                                     'compute.%s' % instance['host'],
+                                     when, payload))
+        return [('nova', ROUTING_KEY, body) for when, seq, body in
+                sorted(events)]
+
+    def _image_payload(self, image):
+        return {'id': image['uuid'],
+                'owner': image['owner'],
+                'size': image['size'],
+                'status': image['status'],
+                'created_at': image['created_at'],
+                'deleted_at': image['deleted_at'],
+                'is_public': False,
+                'properties': {'image_type': 'snapshot',
+                               'instance_uuid': image['instance']},
+                'image_meta': {'image_type': 'snapshot'}}
+
+    def glance_images(self, owners, images_per_owner):
+        """Uploads images_per_owner snapshots for each of owners and
+        deletes a few of them."""
+        events = []
+        for i in range(owners):
+            owner = str(1000 + i)
+            for j in range(images_per_owner):
+                when = self._when()
+                image = {'uuid': self._uuid(),
+                         'owner': owner,
+                         'size': self.random.randint(10 ** 8, 10 ** 10),
+                         'status': 'active',
+                         'created_at': _format(when),
+                         'deleted_at': None,
+                         'instance': self._uuid()}
+                self.images.append(image)
+                events.append(self._body('image.activate',
+                                         'glance-api01.example.com', when,
+                                         self._image_payload(image)))
+                if self.random.random() < 0.1:
+                    when += datetime.timedelta(
+                        seconds=self.random.uniform(60, 3600))
+                    image['status'] = 'deleted'
+                    image['deleted_at'] = _format(when)
+                    events.append(self._body('image.delete',
+                                             'glance-api01.example.com',
+                                             when,
+                                             self._image_payload(image)))
+        return [('glance', ROUTING_KEY, body) for when, seq, body in
+                sorted(events)]
+
+    def glance_exists(self):
+        """One image.exists per owner listing all of their images."""
+        by_owner = {}
+        for image in self.images:
+            by_owner.setdefault(image['owner'], []).append(image)
+        events = []
+        for owner in sorted(by_owner):
+            when = self.end + datetime.timedelta(
+                seconds=self.random.uniform(0, 300))
+            payload = {'owner': owner,
+                       'audit_period_beginning': _format(self.start),
+                       'audit_period_ending': _format(self.end),
+                       'images': [{'id': image['uuid'],
+                                   'size': image['size'],
+                                   'status': image['status'],
+                                   'created_at': image['created_at'],
+                                   'deleted_at': image['deleted_at']}
+                                  for image in by_owner[owner]]}
+            events.append(self._body('image.exists',
+                                     'glance-api01.example.com', when,
+                                     payload))
+        return [('glance', ROUTING_KEY, body) for when, seq, body in
+                sorted(events)]
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach notification generator')
+    parser.add_argument('file', help='Where to write the notifications.')
+    parser.add_argument('--exchange', default='nova', choices=['nova',
+                                                               'glance'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=10,
+                        help='compute.instance.update events per action.')
+    parser.add_argument('--owners', type=int, default=10)
+    parser.add_argument('--images', type=int, default=50,
+                        help='Images per owner.')
+    args = parser.parse_args()
+
+    generator = NotificationGenerator(args.seed)
+    if args.exchange == 'nova':
+        events = generator.nova_lifecycles(args.instances, args.updates)
+        events.extend(generator.nova_exists())
+    else:
+        events = generator.glance_images(args.owners, args.images)
+        events.extend(generator.glance_exists())
+    with open(args.file, 'w') as f:
+        for exchange, routing_key, body in events:
+            f.write('%s\n' % json.dumps([routing_key, body]))
+    print "Wrote %d notifications to %s" % (len(events), args.file)
+
+
+if __name__ == '__main__':
+    main()
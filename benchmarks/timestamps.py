@@ -0,0 +1,122 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python benchmarks/timestamps.py [--number N]
+
+    Compares utils.str_time_to_unix() against the strptime based parser
+    it replaced, for each of the timestamp formats seen in notifications.
+    Both unique timestamps (no memo hits) and a repeated audit period
+    string are timed.
+"""
+
+import argparse
+import calendar
+import datetime
+import decimal
+import os
+import sys
+import timeit
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir, os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'stacktach')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+from stacktach import utils
+
+FORMATS = [
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+]
+
+
+def strptime_str_time_to_unix(when):
+    if 'Z' in when:
+        formats = ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ"]
+    elif 'T' in when:
+        formats = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]
+    else:
+        formats = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]
+    for format in formats:
+        try:
+            utc = datetime.datetime.strptime(when, format)
+            break
+        except ValueError:
+            pass
+    decimal.getcontext().prec = 30
+    return decimal.Decimal(str(calendar.timegm(utc.utctimetuple()))) + \
+        (decimal.Decimal(str(utc.microsecond)) /
+         decimal.Decimal("1000000.0"))
+
+
+def _timestamps(format, count):
+    start = datetime.datetime(2013, 5, 15, 11, 51, 11, 123456)
+    step = datetime.timedelta(seconds=1, microseconds=7)
+    return [(start + step * i).strftime(format) for i in xrange(count)]
+
+
+def _time(func, values, number):
+    def run():
+        for value in values:
+            func(value)
+    return min(timeit.repeat(run, number=number, repeat=3)) / \
+        (number * len(values))
+
+
+def _time_unique(values, number):
+    def run():
+        utils._PARSED_TIMES.clear()
+        for value in values:
+            utils.str_time_to_unix(value)
+    return min(timeit.repeat(run, number=number, repeat=3)) / \
+        (number * len(values))
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach timestamp benchmark')
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args()
+
+    print "%-24s %12s %12s %8s" % ("format", "strptime us", "fast us",
+                                   "speedup")
+    for format in FORMATS:
+        values = _timestamps(format, args.count)
+        for value in values:
+            assert strptime_str_time_to_unix(value) == \
+                utils.str_time_to_unix(value), value
+        old = _time(strptime_str_time_to_unix, values, args.number)
+        new = _time_unique(values, args.number)
+        print "%-24s %12.2f %12.2f %7.1fx" % (format, old * 1e6, new * 1e6,
+                                              old / new)
+
+    audit_period = ["2013-05-15 00:00:00"] * args.count
+    old = _time(strptime_str_time_to_unix, audit_period, args.number)
+    new = _time(utils.str_time_to_unix, audit_period, args.number)
+    print "%-24s %12.2f %12.2f %7.1fx" % ("repeated audit period",
+                                          old * 1e6, new * 1e6, old / new)
+
+
+if __name__ == '__main__':
+    main()
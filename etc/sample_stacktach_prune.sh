@@ -4,6 +4,13 @@
 # The following is one way you could keep your RawData table from growing
 # very large -- keep only the last N days worth of data, N being a number
 # convenient to your installation.
+#
+# scripts/prune_raw_data.py deletes in small chunks instead, and cleans up
+# the rows that point at what it deletes.
+#
+# On MySQL, scripts/partition_raw_tables.py can partition the raw tables by
+# day instead, so old data is dropped a partition at a time rather than
+# with one long DELETE.
 
 # Full path to where you have deployed the Stacktach app
 PATH_TO_ST='/path/to/stacktach'
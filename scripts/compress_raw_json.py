@@ -0,0 +1,129 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python scripts/compress_raw_json.py [options]
+
+    Compresses the json column of raw data rows saved before the worker's
+    compress_raw_json option was turned on, a batch at a time in id order
+    so it can run alongside the workers. Rows that are already compressed
+    are left alone. With --decompress it goes the other way, for turning
+    compression back off.
+
+    Progress is printed as the last id done, which can be passed back in
+    with --start-id to pick up where an interrupted run left off.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
+
+from stacktach import db
+from stacktach import fields
+from stacktach import models
+
+MODELS = {
+    'nova': models.RawData,
+    'glance': models.GlanceRawData,
+    'generic': models.GenericRawData,
+}
+
+
+def compact_batch(Model, last_id, batch_size, end_id=None,
+                  decompress=False):
+    """Rewrites up to batch_size rows after last_id. Returns (rows seen,
+    rows changed, bytes before, bytes after, new last id)."""
+    query = Model.objects.filter(id__gt=last_id)
+    if end_id is not None:
+        query = query.filter(id__lte=end_id)
+    # values_list() hands back what's stored, not the decompressed text
+    # the model would give us.
+    rows = list(query.order_by('id').values_list('id', 'json')[:batch_size])
+    changed = before = after = 0
+    with db.commit_on_success():
+        for id, value in rows:
+            if decompress:
+                new_value = fields.decompress(value)
+            else:
+                new_value = fields.compress(value)
+            before += len(value)
+            after += len(new_value)
+            if new_value != value:
+                Model.objects.filter(id=id).update(json=new_value)
+                changed += 1
+    if rows:
+        last_id = rows[-1][0]
+    return len(rows), changed, before, after, last_id
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach raw json compaction')
+    parser.add_argument('--table', choices=sorted(MODELS.keys()),
+                        action='append',
+                        help='Raw data table to compact, by exchange. Can '
+                             'be repeated. Defaults to all of them.')
+    parser.add_argument('--start-id', type=int, default=0,
+                        help='Only rows after this id. Only valid with a '
+                             'single --table.')
+    parser.add_argument('--end-id', type=int, default=None,
+                        help='Stop after this id.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Rows per transaction.')
+    parser.add_argument('--sleep', type=float, default=0.1,
+                        help='Seconds to pause between batches, to go easy '
+                             'on the database.')
+    parser.add_argument('--decompress', action='store_true',
+                        help='Store rows uncompressed instead.')
+    args = parser.parse_args()
+    tables = args.table or sorted(MODELS.keys())
+    if args.start_id and len(tables) > 1:
+        parser.error('--start-id needs a single --table')
+
+    # Writes through the model must not compress what we're decompressing.
+    fields.COMPRESS = False
+    for table in tables:
+        Model = MODELS[table]
+        last_id = args.start_id
+        seen = changed = before = after = 0
+        while True:
+            results = compact_batch(Model, last_id, args.batch_size,
+                                    end_id=args.end_id,
+                                    decompress=args.decompress)
+            if not results[0]:
+                break
+            seen += results[0]
+            changed += results[1]
+            before += results[2]
+            after += results[3]
+            last_id = results[4]
+            print "%s: %d rows, %d rewritten, last id %d" % (table, seen,
+                                                             changed, last_id)
+            sys.stdout.flush()
+            time.sleep(args.sleep)
+        if before:
+            print "%s: done, %d bytes now %d (%.1f%%)" % (
+                table, before, after, after * 100.0 / before)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python scripts/partition_raw_tables.py setup [options]
+           python scripts/partition_raw_tables.py maintain [options]
+
+    Manages day or week partitions on 'when' for the raw data tables in
+    MySQL, so expired rows are dropped a partition at a time rather than
+    with a long running DELETE.
+
+    setup partitions the tables for the first time. It rebuilds each
+    table, so expect it to take a while on a big one. Everything already
+    in the table goes into a single partition, dropped once it's older
+    than the retention period.
+
+    maintain is meant to run from cron, daily. It adds partitions so
+    there are always --future of them ready ahead of time and drops the
+    ones older than --retention-days. Rows that refer to the dropped raws
+    are nulled or deleted first, as the pruner does, and a partition
+    holding a raw the pruner would keep isn't dropped.
+
+    With --dry-run the SQL is printed instead of run.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
+
+from django.db import connection
+
+from stacktach import models
+from stacktach import partitions
+from stacktach import pruner
+
+TABLES = {
+    'nova': models.RawData,
+    'glance': models.GlanceRawData,
+    'generic': models.GenericRawData,
+}
+
+
+def _query(sql, params):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def foreign_keys(table):
+    """(table, constraint) for each foreign key to or from table."""
+    return _query("SELECT TABLE_NAME, CONSTRAINT_NAME "
+                  "FROM information_schema.REFERENTIAL_CONSTRAINTS "
+                  "WHERE CONSTRAINT_SCHEMA = DATABASE() "
+                  "AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)",
+                  [table, table])
+
+
+def existing_partitions(table):
+    rows = _query("SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+                  "FROM information_schema.PARTITIONS "
+                  "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                  "AND PARTITION_NAME IS NOT NULL "
+                  "ORDER BY PARTITION_ORDINAL_POSITION", [table])
+    return [(name, None if upper == 'MAXVALUE' else int(upper))
+            for name, upper in rows]
+
+
+def references(Model):
+    """(table, column, action) for each row that refers to Model, from
+    the pruner's list."""
+    return [(Referrer._meta.db_table,
+             Referrer._meta.get_field(field).column, action)
+            for Referrer, field, action in pruner.REFERENCES[Model]]
+
+
+def kept_since(table, refs):
+    """Unix time of the oldest raw that a row which has to be kept
+    refers to, or None."""
+    oldest = None
+    for owner, column, action in refs:
+        if action != pruner.KEEP:
+            continue
+        rows = _query("SELECT FLOOR(MIN(`%s`.`when`)) FROM `%s` "
+                      "JOIN `%s` ON `%s`.`%s` = `%s`.`id`" %
+                      (table, owner, table, owner, column, table), [])
+        when = rows[0][0]
+        if when is not None and (oldest is None or when < oldest):
+            oldest = int(when)
+    return oldest
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach raw table partitioning')
+    parser.add_argument('action', choices=['setup', 'maintain'])
+    parser.add_argument('--table', choices=sorted(TABLES.keys()),
+                        action='append',
+                        help='Raw data table, by exchange. Can be repeated. '
+                             'Defaults to all of them.')
+    parser.add_argument('--period', choices=sorted(partitions.PERIODS),
+                        default='day',
+                        help='How much time each partition holds.')
+    parser.add_argument('--future', type=int, default=7,
+                        help='Partitions to keep ready ahead of the '
+                             'current one.')
+    parser.add_argument('--retention-days', type=int, default=None,
+                        help='Drop partitions entirely older than this. '
+                             'Nothing is dropped if unset.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the SQL instead of running it.')
+    args = parser.parse_args()
+
+    if connection.vendor != 'mysql':
+        parser.error('Partitioning is only supported on MySQL, not %s' %
+                     connection.vendor)
+
+    now = datetime.datetime.utcnow()
+    for name in args.table or sorted(TABLES.keys()):
+        table = TABLES[name]._meta.db_table
+        current = existing_partitions(table)
+        if args.action == 'setup':
+            if current:
+                print "%s is already partitioned" % table
+                continue
+            statements = partitions.foreign_key_sql(foreign_keys(table))
+            statements.extend(partitions.partition_table_sql(
+                table, now, period=args.period, future=args.future))
+        elif not current:
+            print "%s isn't partitioned yet, run setup first" % table
+            continue
+        else:
+            refs = references(TABLES[name])
+            statements = partitions.maintain_sql(
+                table, current, now, period=args.period,
+                future=args.future, retention_days=args.retention_days,
+                references=refs, kept_since=kept_since(table, refs))
+
+        for sql in statements:
+            print "%s;" % sql
+            if not args.dry_run:
+                connection.cursor().execute(sql)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python scripts/prune_raw_data.py --keep-days N [options]
+
+    Deletes raw data older than --keep-days, a chunk at a time in id
+    order, with a pause between chunks so replicas keep up. Lifecycle,
+    Timing, InstanceDeletes, InstanceExists, ImageUsage and ImageDeletes
+    rows that point at a deleted raw have the reference nulled, and the
+    RawDataImageMeta rows go with their raw. Glance raws that an
+    ImageExists still points at are kept.
+
+    Progress is checkpointed per table, so it carries on where it left
+    off when restarted. With --continuous it keeps running, pruning
+    again every --interval seconds.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
+
+from stacktach import models
+from stacktach import pruner
+from stacktach import stacklog
+from worker import aggregator
+
+TABLES = {
+    'nova': models.RawData,
+    'glance': models.GlanceRawData,
+    'generic': models.GenericRawData,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach raw data pruner')
+    parser.add_argument('--keep-days', type=float, required=True,
+                        help='Delete raw data older than this.')
+    parser.add_argument('--table', choices=sorted(TABLES.keys()),
+                        action='append',
+                        help='Raw data table, by exchange. Can be repeated. '
+                             'Defaults to all of them.')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Rows per transaction.')
+    parser.add_argument('--rows-per-second', type=float, default=None,
+                        help='Most rows to delete a second, on average.')
+    parser.add_argument('--sleep', type=float, default=0.5,
+                        help='Seconds to pause between chunks.')
+    parser.add_argument('--checkpoint-dir', default='/var/log/stacktach')
+    parser.add_argument('--continuous', action='store_true')
+    parser.add_argument('--interval', type=int, default=300,
+                        help='Seconds between runs with --continuous.')
+    parser.add_argument('--log-dir', default='/var/log/stacktach')
+    args = parser.parse_args()
+
+    stacklog.set_default_logger_location(
+        os.path.join(args.log_dir, '%s.log'))
+    stacklog.set_default_logger_name('pruner')
+    log_listener = stacklog.LogListener(
+        stacklog.get_logger('pruner', is_parent=True))
+    log_listener.start()
+
+    pruners = []
+    for name in args.table or sorted(TABLES.keys()):
+        Model = TABLES[name]
+        checkpoint = aggregator.Checkpoint(os.path.join(
+            args.checkpoint_dir, 'prune_%s.checkpoint' % Model._meta.db_table))
+        pruners.append(pruner.Pruner(Model, checkpoint,
+                                     chunk_size=args.chunk_size,
+                                     rows_per_second=args.rows_per_second,
+                                     sleep=args.sleep))
+
+    try:
+        while True:
+            cutoff = time.time() - args.keep_days * 24 * 60 * 60
+            for table_pruner in pruners:
+                deleted = table_pruner.prune(cutoff)
+                print "%s: deleted %d" % (table_pruner.Model.__name__,
+                                          deleted)
+                sys.stdout.flush()
+            if not args.continuous:
+                break
+            time.sleep(args.interval)
+    finally:
+        log_listener.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+    Usage: python scripts/replay_notifications.py <file> [options]
+
+    Feeds recorded notifications through the worker's ingest path, the
+    same decode, save and post processing a message from RabbitMQ gets,
+    without needing a broker. Each line of the file is a json
+    [routing_key, body] pair, the same as the json column of RawData.
+
+    Handy for reprocessing an archive or for benchmarking ingest against
+    a local database. Queries are counted from Django's debug cursor, so
+    the number reported is every statement the ingest path ran.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
+
+import django.db
+from django.db import connection
+
+from stacktach import db
+from stacktach import stacklog
+from stacktach import views
+import worker.worker as worker
+
+# The worker ignores ^C, but we want it.
+signal.signal(signal.SIGINT, signal.default_int_handler)
+
+# Statements run in every process, counted as they're thrown away by
+# django.db.reset_queries() at the start of each message or batch.
+query_count = multiprocessing.Value('l', 0)
+_reset_queries = django.db.reset_queries
+
+
+def _counting_reset_queries():
+    with query_count.get_lock():
+        query_count.value += len(connection.queries)
+    _reset_queries()
+
+
+class _ReplayMessage(object):
+    """Stands in for a kombu message."""
+
+    def __init__(self, delivery_tag, routing_key, body):
+        self.delivery_tag = delivery_tag
+        self.delivery_info = {'routing_key': routing_key}
+        self.body = body
+        self.acknowledged = False
+
+    def ack(self):
+        self.acknowledged = True
+
+
+def read_messages(path, limit=None):
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if limit is not None and number >= limit:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            routing_key, body = json.loads(line)
+            yield _ReplayMessage(number + 1, routing_key, json.dumps(body))
+
+
+class Throttle(object):
+    """Holds back to rate messages a second, or not at all if rate is
+    0."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.sent = 0
+
+    def wait(self):
+        if self.rate:
+            ahead = self.start + self.sent / float(self.rate) - time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+        self.sent += 1
+
+
+def replay(consumer, messages, throttle):
+    """Replays messages on a single consumer. Returns (processed, failed)."""
+    processed = failed = 0
+    for message in messages:
+        throttle.wait()
+        try:
+            consumer.on_nova(None, message)
+        except Exception, e:
+            failed += 1
+            print "Failed message %d: %s" % (message.delivery_tag, e)
+        processed += 1
+        consumer.on_iteration()
+    if consumer.batch:
+        consumer._process_batch()
+    return processed, failed
+
+
+def replay_sharded(consumer, messages, throttle, max_in_flight):
+    """Replays messages over consumer's ShardPool, by instance.
+    Returns (processed, failed)."""
+    processed = failed = 0
+
+    def collect(results):
+        failures = 0
+        for tag, error in results:
+            # Failed or not, it's no longer in flight.
+            consumer.in_flight.pop(tag)
+            if error is not None:
+                failures += 1
+                print "Failed message %s: %s" % (tag, error)
+        return failures
+
+    for message in messages:
+        throttle.wait()
+        consumer._route(message)
+        processed += 1
+        while len(consumer.in_flight) >= max_in_flight:
+            failed += collect(consumer.shards.finished())
+            time.sleep(0.01)
+        failed += collect(consumer.shards.finished())
+    failed += collect(consumer.shards.stop())
+    return processed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach notification replay')
+    parser.add_argument('file',
+                        help='File of json [routing_key, body] pairs, one '
+                             'per line.')
+    parser.add_argument('--deployment', default='replay',
+                        help='Deployment to save the notifications under.')
+    parser.add_argument('--exchange', default='nova',
+                        help='Exchange the notifications came from '
+                             '(nova, glance, ...).')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages a second. 0 for as fast as possible.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Processes to spread the work over, by '
+                             'instance.')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--transactional', action='store_true')
+    parser.add_argument('--no-post-process', action='store_true',
+                        help='Only save the raw rows.')
+    parser.add_argument('--lifecycle-cache-size', type=int, default=0)
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Stop after this many lines.')
+    parser.add_argument('--log-dir', default='/var/log/stacktach')
+    args = parser.parse_args()
+
+    stacklog.set_default_logger_location(
+        os.path.join(args.log_dir, '%s.log'))
+    stacklog.set_default_logger_name('worker')
+    log_listener = stacklog.LogListener(
+        stacklog.get_logger('worker', is_parent=True))
+    log_listener.start()
+
+    deployment, new = db.get_or_create_deployment(args.deployment)
+    connection.use_debug_cursor = True
+    django.db.reset_queries = _counting_reset_queries
+    django.db.reset_queries()
+
+    consumer_kwargs = dict(batch_size=args.batch_size,
+                           transactional=args.transactional,
+                           post_process=not args.no_post_process)
+    shards = None
+    engine = None
+    if args.processes > 1:
+        shards = worker.ShardPool(
+            args.processes,
+            (args.deployment, None, deployment, False, {}, args.exchange,
+             []),
+            consumer_kwargs,
+            lifecycle_cache_size=args.lifecycle_cache_size)
+        shards.start()
+    elif args.lifecycle_cache_size:
+        engine = worker.lifecycle_engine.LifecycleStateEngine(
+            db, max_instances=args.lifecycle_cache_size)
+        views.LIFECYCLE_ENGINE = engine
+    consumer = worker.Consumer(args.deployment, None, deployment, False, {},
+                               args.exchange, [], lifecycle_engine=engine,
+                               shards=shards, **consumer_kwargs)
+
+    messages = read_messages(args.file, limit=args.limit)
+    throttle = Throttle(args.rate)
+    start = time.time()
+    if shards is not None:
+        processed, failed = replay_sharded(consumer, messages, throttle,
+                                           max_in_flight=1000 * args.processes)
+    else:
+        processed, failed = replay(consumer, messages, throttle)
+    if engine is not None:
+        engine.flush()
+    elapsed = time.time() - start
+    django.db.reset_queries()
+    log_listener.end()
+
+    print "Replayed %d messages (%d failed) in %.2fs" % (processed, failed,
+                                                        elapsed)
+    if processed:
+        print "%.1f msgs/sec, %.2f queries/msg" % (
+            processed / elapsed, query_count.value / float(processed))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,20 @@ import decimal
 
 
 def dt_to_decimal(utc):
-    decimal.getcontext().prec = 30
-    return decimal.Decimal(str(calendar.timegm(utc.utctimetuple()))) + \
-           (decimal.Decimal(str(utc.microsecond)) /
-           decimal.Decimal("1000000.0"))
+    return seconds_to_decimal(calendar.timegm(utc.utctimetuple()),
+                              utc.microsecond)
+
+
+def seconds_to_decimal(seconds, microsecond=0):
+    """Builds the Decimal for a unix timestamp directly from its digits,
+    rather than dividing, so no decimal context is needed. Trailing zeros
+    are dropped from the fraction."""
+    if not microsecond:
+        return decimal.Decimal(seconds)
+    fraction = ('%06d' % microsecond).rstrip('0')
+    if seconds >= 0:
+        return decimal.Decimal('%d.%s' % (seconds, fraction))
+    return decimal.Decimal(seconds) + decimal.Decimal('0.' + fraction)
 
 
 def dt_from_decimal(dec):
@@ -1,19 +1,54 @@
+import decimal
+import sys
+
+from django.db import connections
+from django.db import DatabaseError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import IntegrityError
+from django.db import transaction
+
 from stacktach import stacklog
 from stacktach import models
 
+# The most uuids or instances in one IN list, or rows in one multi-row
+# insert, when saving exists in bulk. It keeps statements for tenants with
+# thousands of images, or the exists burst after each audit period, to a
+# sensible size, and under sqlite's limit on parameters.
+BULK_CHUNK_SIZE = 500
+# sqlite hands decimals back rounded to 15 significant digits, which is
+# the last few microseconds of a timestamp.
+LAUNCHED_AT_SLACK = decimal.Decimal('0.00001')
+
+# MySQL errors that mean the server is gone, unreachable or too busy to
+# answer. Anything else it reports means it rejected what we sent, which
+# sending it again later won't fix.
+MYSQL_OUTAGE_CODES = frozenset([
+    1040,  # Too many connections
+    1053,  # Server shutdown in progress
+    1205,  # Lock wait timeout exceeded
+    1213,  # Deadlock found when trying to get lock
+    2002,  # Can't connect to local MySQL server through socket
+    2003,  # Can't connect to MySQL server
+    2006,  # MySQL server has gone away
+    2013,  # Lost connection to MySQL server during query
+    2055,  # Lost connection to MySQL server at '%s'
+])
+# How the other drivers say the same, without a code to go by.
+OUTAGE_MESSAGES = ('database is locked', 'unable to open database',
+                   'could not connect', 'server closed the connection',
+                   'terminating connection')
+
 
 def _safe_get(Model, **kwargs):
-    object = None
-    query = Model.objects.filter(**kwargs)
-    count = query.count()
-    if count > 1:
+    # Fetching up to two rows tells us everything a count() would, without
+    # a second round trip for the row itself.
+    objects = list(Model.objects.filter(**kwargs)[:2])
+    if len(objects) > 1:
         stacklog.warn('Multiple records found for %s get.' % Model.__name__)
-        object = query[0]
-    elif count < 1:
+    elif not objects:
         stacklog.warn('No records found for %s get.' % Model.__name__)
-    else:
-        object = query[0]
-    return object
+        return None
+    return objects[0]
 
 
 def get_deployment(id):
@@ -24,13 +59,44 @@ def get_or_create_deployment(name):
     return models.Deployment.objects.get_or_create(name=name)
 
 
-def create_nova_rawdata(**kwargs):
+def commit_on_success():
+    return transaction.commit_on_success()
+
+
+def is_database_failure(e):
+    """True if e means the database is down or unusable, as opposed to
+    having rejected what we sent it. Django only wraps errors from
+    queries, so errors from the driver itself are checked for too."""
+    connection = connections[DEFAULT_DB_ALIAS]
+    driver = getattr(sys.modules[type(connection).__module__], 'Database',
+                     None)
+    integrity_errors = [IntegrityError]
+    errors = [DatabaseError]
+    if driver is not None:
+        integrity_errors.append(driver.IntegrityError)
+        errors.append(driver.Error)
+    if (isinstance(e, tuple(integrity_errors)) or
+            not isinstance(e, tuple(errors))):
+        return False
+    # Django passes MySQL's error code along as the first argument.
+    if e.args and isinstance(e.args[0], (int, long)):
+        return e.args[0] in MYSQL_OUTAGE_CODES
+    message = str(e).lower()
+    return any(marker in message for marker in OUTAGE_MESSAGES)
+
+
+def _split_nova_rawdata_kwargs(kwargs):
     imagemeta_fields = ['os_architecture', 'os_version',
                         'os_distro', 'rax_options']
     imagemeta_kwargs = \
         dict((k, v) for k, v in kwargs.iteritems() if k in imagemeta_fields)
     rawdata_kwargs = \
         dict((k, v) for k, v in kwargs.iteritems() if k not in imagemeta_fields)
+    return rawdata_kwargs, imagemeta_kwargs
+
+
+def create_nova_rawdata(**kwargs):
+    rawdata_kwargs, imagemeta_kwargs = _split_nova_rawdata_kwargs(kwargs)
     rawdata = models.RawData(**rawdata_kwargs)
     rawdata.save()
 
@@ -40,6 +106,31 @@ def create_nova_rawdata(**kwargs):
     return rawdata
 
 
+def create_nova_rawdata_batch(rows):
+    """Saves a list of RawData kwargs along with their image meta.
+
+    bulk_create() doesn't give us primary keys back and the lifecycle
+    and usage rows need them, so the RawData rows are still inserted one
+    at a time. The RawDataImageMeta rows are never referenced, so they
+    all go out in a single multi-row insert.
+    """
+    raws = []
+    imagemetas = []
+    for kwargs in rows:
+        rawdata_kwargs, imagemeta_kwargs = _split_nova_rawdata_kwargs(kwargs)
+        rawdata = models.RawData(**rawdata_kwargs)
+        rawdata.save()
+        raws.append(rawdata)
+
+        imagemeta_kwargs.update({'raw_id': rawdata.id})
+        imagemetas.append(models.RawDataImageMeta(**imagemeta_kwargs))
+
+    if imagemetas:
+        models.RawDataImageMeta.objects.bulk_create(imagemetas)
+
+    return raws
+
+
 def create_lifecycle(**kwargs):
     return models.Lifecycle(**kwargs)
 
@@ -92,6 +183,55 @@ def create_instance_exists(**kwargs):
     return models.InstanceExists(**kwargs)
 
 
+def create_instance_exists_batch(rows):
+    return _bulk_create(models.InstanceExists, rows)
+
+
+def _safe_get_by_launch(Model, launches):
+    """_safe_get(Model, instance=instance,
+    launched_at__range=(launched_at, launched_at + 1)) for every
+    (instance, launched_at) in launches, with one IN query per
+    BULK_CHUNK_SIZE instances. Returns {(instance, launched_at): row},
+    without the launches that have no row. Where there are several the
+    oldest wins."""
+    launches = sorted(set(launches))
+    instances = sorted(set(instance for instance, launched_at in launches))
+    rows = {}
+    for start in range(0, len(instances), BULK_CHUNK_SIZE):
+        chunk = instances[start:start + BULK_CHUNK_SIZE]
+        query = Model.objects.filter(instance__in=chunk).order_by('id')
+        for row in query:
+            if row.launched_at is not None:
+                rows.setdefault(row.instance, []).append(row)
+    found = {}
+    multiple = 0
+    for instance, launched_at in launches:
+        lowest = launched_at - LAUNCHED_AT_SLACK
+        highest = launched_at + 1 + LAUNCHED_AT_SLACK
+        matches = [row for row in rows.get(instance, [])
+                   if lowest <= row.launched_at <= highest]
+        if len(matches) > 1:
+            multiple += 1
+        if matches:
+            found[(instance, launched_at)] = matches[0]
+    if multiple:
+        stacklog.warn('Multiple records found for %d %s gets.' %
+                      (multiple, Model.__name__))
+    if len(found) < len(launches):
+        stacklog.warn('No records found for %d of %d %s gets.' %
+                      (len(launches) - len(found), len(launches),
+                       Model.__name__))
+    return found
+
+
+def get_instance_usages(launches):
+    return _safe_get_by_launch(models.InstanceUsage, launches)
+
+
+def get_instance_deletes(launches):
+    return _safe_get_by_launch(models.InstanceDeletes, launches)
+
+
 def save(obj):
     obj.save()
 
@@ -103,6 +243,12 @@ def create_glance_rawdata(**kwargs):
     return rawdata
 
 
+def create_glance_rawdata_batch(rows):
+    # The image usage, delete and exists rows point back at these,
+    # so they need their primary keys.
+    return [create_glance_rawdata(**kwargs) for kwargs in rows]
+
+
 def create_generic_rawdata(**kwargs):
     rawdata = models.GenericRawData(**kwargs)
     rawdata.save()
@@ -110,6 +256,59 @@ def create_generic_rawdata(**kwargs):
     return rawdata
 
 
+def create_generic_rawdata_batch(rows):
+    # Nothing references GenericRawData, so a multi-row insert is fine
+    # even though the returned rows won't have their ids populated.
+    raws = [models.GenericRawData(**kwargs) for kwargs in rows]
+    if raws:
+        models.GenericRawData.objects.bulk_create(raws)
+    return raws
+
+
+def get_raw_by_message_id(Model, message_id):
+    """The earliest raw saved with message_id, or None."""
+    raws = Model.objects.filter(message_id=message_id).order_by('id')[:1]
+    if raws:
+        return raws[0]
+    return None
+
+
+def get_recent_message_ids(Model, count):
+    """The message ids of the last count raws of Model."""
+    return Model.objects.exclude(message_id=None).order_by('-id')\
+        .values_list('message_id', flat=True)[:count]
+
+
+def get_last_raw_id(Model):
+    last = Model.objects.order_by('-id').values_list('id', flat=True)[:1]
+    if last:
+        return last[0]
+    return 0
+
+
+def find_raw_keys_after(Model, key, last_id, limit):
+    """Returns (id, deployment_id, key) for the next limit raws of Model
+    with an id above last_id, in id order."""
+    query = Model.objects.filter(id__gt=last_id).order_by('id')
+    return list(query.values_list('id', 'deployment_id', key)[:limit])
+
+
+def find_raw_keys_by_id(Model, key, ids):
+    """find_raw_keys_after() for whichever of the raws with the given ids
+    exist, in id order."""
+    rows = []
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        query = Model.objects.filter(
+            id__in=ids[start:start + BULK_CHUNK_SIZE]).order_by('id')
+        rows.extend(query.values_list('id', 'deployment_id', key))
+    return rows
+
+
+def get_raws_by_id(Model, ids):
+    query = Model.objects.select_related('deployment').filter(id__in=ids)
+    return list(query.order_by('id'))
+
+
 def create_image_usage(**kwargs):
     usage = models.ImageUsage(**kwargs)
     usage.save()
@@ -137,3 +336,50 @@ def get_image_delete(**kwargs):
 
 def get_image_usage(**kwargs):
     return _safe_get(models.ImageUsage, **kwargs)
+
+
+def _safe_get_by_uuid(Model, uuids):
+    """_safe_get(Model, uuid=uuid) for every one of uuids, with one IN
+    query per BULK_CHUNK_SIZE of them. Returns {uuid: row}, without the
+    uuids that have no row. Where there are several the oldest wins."""
+    uuids = sorted(set(uuids))
+    found = {}
+    multiple = 0
+    for start in range(0, len(uuids), BULK_CHUNK_SIZE):
+        chunk = uuids[start:start + BULK_CHUNK_SIZE]
+        query = Model.objects.filter(uuid__in=chunk).order_by('id')
+        for row in query:
+            if row.uuid in found:
+                multiple += 1
+            else:
+                found[row.uuid] = row
+    if multiple:
+        stacklog.warn('Multiple records found for %d %s gets.' %
+                      (multiple, Model.__name__))
+    if len(found) < len(uuids):
+        stacklog.warn('No records found for %d of %d %s gets.' %
+                      (len(uuids) - len(found), len(uuids), Model.__name__))
+    return found
+
+
+def get_image_deletes(uuids):
+    return _safe_get_by_uuid(models.ImageDeletes, uuids)
+
+
+def get_image_usages(uuids):
+    return _safe_get_by_uuid(models.ImageUsage, uuids)
+
+
+def _bulk_create(Model, rows):
+    # Nothing refers to an exists once it's saved, so they can all go out
+    # as multi-row inserts even though they won't get their ids.
+    # Django would let a batch_size passed to bulk_create() override the
+    # smaller one sqlite needs, so the chunking is done here instead.
+    objects = [Model(**kwargs) for kwargs in rows]
+    for start in range(0, len(objects), BULK_CHUNK_SIZE):
+        Model.objects.bulk_create(objects[start:start + BULK_CHUNK_SIZE])
+    return objects
+
+
+def create_image_exists_batch(rows):
+    return _bulk_create(models.ImageExists, rows)
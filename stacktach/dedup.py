@@ -0,0 +1,148 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Spots notifications that rabbit has handed us before, which happens when
+# a worker dies or reconnects with messages saved but not yet acked.
+#
+# Every message_id goes into a bloom filter. One that isn't in the filter
+# is certainly new, so the common case costs no queries. One that is in
+# the filter is only probably a duplicate, so it's looked up in the raw
+# table before being treated as one.
+#
+# The filters are only kept in memory, and a worker that has just been
+# restarted is when redeliveries turn up. So a new Deduplicator is seeded
+# with the message ids of the last few raws saved, which covers whatever
+# was saved but still unacked when the last worker died.
+
+import hashlib
+import math
+import struct
+import time
+
+from stacktach import db
+from stacktach import models
+
+RAW_MODELS = {
+    'nova': models.RawData,
+    'glance': models.GlanceRawData,
+}
+
+
+def raw_model(exchange):
+    """The raw table notifications from exchange are saved to."""
+    return RAW_MODELS.get(exchange, models.GenericRawData)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        # The standard sizing for capacity keys at the given rate of false
+        # positives.
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) /
+                                         math.log(2) ** 2)))
+        self.hashes = max(1, int(round(math.log(2) * self.size / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing with the two halves of one md5, rather than
+        # hashing the key once per position.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class MessageFilter(object):
+    """Remembers message ids for between one and two windows, in a
+    bounded amount of memory. Ids go into the current filter, which
+    becomes the previous one and is replaced with an empty one once the
+    window is up or it's holding capacity ids, whichever comes first."""
+
+    def __init__(self, capacity, error_rate=0.001, window=86400):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.started = time.time()
+
+    def _maybe_rotate(self):
+        if (self.current.count >= self.capacity or
+                time.time() - self.started >= self.window):
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.started = time.time()
+
+    def add(self, key):
+        """Adds key, returning True if it has probably been seen before."""
+        self._maybe_rotate()
+        if key in self.current:
+            return True
+        self.current.add(key)
+        return self.previous is not None and key in self.previous
+
+
+class Deduplicator(object):
+    def __init__(self, Model, capacity, error_rate=0.001, window=86400,
+                 drop=True, transactional=False):
+        self.Model = Model
+        self.filter = MessageFilter(capacity, error_rate=error_rate,
+                                    window=window)
+        # When False duplicates are only counted, and still saved.
+        self.drop = drop
+        # With transactional ingest a raw is post processed in the same
+        # transaction it's saved in, so by the time it's redelivered there
+        # is nothing left to do. Otherwise it's acked before being post
+        # processed, so a redelivered copy means the saved raw never was.
+        # A worker_processes shard sets this too, as its messages are only
+        # acked after it has had the chance to post process them.
+        self.transactional = transactional
+        self.probable = 0
+        self.duplicates = 0
+
+    def seed(self, count):
+        """Remembers the message ids of the last count raws saved."""
+        for message_id in db.get_recent_message_ids(self.Model, count):
+            self.filter.add(message_id)
+
+    def find_duplicate(self, notification):
+        """The raw already saved with the notification's message_id, or
+        None. Notifications without a message_id are never duplicates."""
+        message_id = notification.message_id
+        if not message_id or not self.filter.add(message_id):
+            return None
+        self.probable += 1
+        raw = db.get_raw_by_message_id(self.Model, message_id)
+        if raw is None:
+            return None
+        self.duplicates += 1
+        return raw
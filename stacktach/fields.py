@@ -0,0 +1,73 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import base64
+import zlib
+
+from django.db import models
+from south.modelsinspector import add_introspection_rules
+
+# Compressed values are stored as this marker followed by the base64 of the
+# zlib compressed utf-8 text. Plain json always starts with '[' or '{', so
+# old uncompressed rows and new compressed ones can sit side by side. The
+# number is the format version, should it ever need to change.
+COMPRESSED_MARKER = 'z1:'
+
+# Whether new values are written compressed. Set by the worker from the
+# deployment's compress_raw_json option. Reading works either way.
+COMPRESS = False
+
+
+def is_compressed(value):
+    return isinstance(value, basestring) and \
+        value.startswith(COMPRESSED_MARKER)
+
+
+def compress(text):
+    if is_compressed(text):
+        return text
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return COMPRESSED_MARKER + base64.b64encode(zlib.compress(text, 6))
+
+
+def decompress(value):
+    if not is_compressed(value):
+        return value
+    data = base64.b64decode(value[len(COMPRESSED_MARKER):])
+    return zlib.decompress(data).decode('utf-8')
+
+
+class CompressedTextField(models.TextField):
+    """A TextField that can be stored compressed. Values always read back
+    as the original text, whichever way they were stored."""
+
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        return decompress(value)
+
+    def get_prep_value(self, value):
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if COMPRESS and value:
+            return compress(value)
+        return value
+
+add_introspection_rules([], [r'^stacktach\.fields\.CompressedTextField'])
@@ -0,0 +1,163 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+import time
+
+from stacktach import models
+
+
+class _InstanceState(object):
+    def __init__(self, lifecycle):
+        self.lifecycle = lifecycle
+        # Timing name -> list of Timings with a start but no end, oldest
+        # first. Names are only loaded from the db the first time we need
+        # them.
+        self.open_timings = {}
+
+
+class LifecycleStateEngine(object):
+    """Keeps the Lifecycle and open Timings of recently seen instances
+    in memory so aggregate_lifecycle() doesn't have to look them up for
+    every event. Changes are written behind: rows are marked dirty and
+    saved by flush(), which the worker calls every flush_interval seconds.
+
+    New Lifecycles are saved right away since Timings reference them.
+    Anything still dirty when the worker dies is lost, which is fine for
+    this debugging and kpi data but is why usage isn't handled here.
+    """
+
+    def __init__(self, db, max_instances=10000, flush_interval=5):
+        self.db = db
+        self.max_instances = max_instances
+        self.flush_interval = flush_interval
+        self.instances = collections.OrderedDict()
+        self.dirty_lifecycles = collections.OrderedDict()
+        self.dirty_timings = collections.OrderedDict()
+        self.last_flush = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def get_lifecycle(self, instance):
+        state = self.instances.pop(instance, None)
+        if state is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            state = _InstanceState(self._load_lifecycle(instance))
+            self._evict()
+        # Re-inserting keeps the most recently used instance at the end.
+        self.instances[instance] = state
+        return state.lifecycle
+
+    def _load_lifecycle(self, instance):
+        # While we hope only one lifecycle ever exists it's quite
+        # likely we get multiple due to the workers and threads.
+        lifecycles = self.db.find_lifecycles(instance=instance)
+        if len(lifecycles) > 0:
+            return lifecycles[0]
+        lifecycle = self.db.create_lifecycle(instance=instance)
+        self.db.save(lifecycle)
+        return lifecycle
+
+    def _evict(self):
+        while len(self.instances) >= self.max_instances:
+            instance, state = self.instances.popitem(last=False)
+            self._flush_instance(state)
+
+    def _flush_instance(self, state):
+        lifecycle = self.dirty_lifecycles.pop(id(state.lifecycle), None)
+        if lifecycle is not None:
+            self.db.save(lifecycle)
+        for timing in self.dirty_timings.values():
+            if timing.lifecycle_id == state.lifecycle.id:
+                self.db.save(self.dirty_timings.pop(id(timing)))
+
+    def _state(self, lifecycle):
+        return self.instances[lifecycle.instance]
+
+    def save_lifecycle(self, lifecycle):
+        self.dirty_lifecycles[id(lifecycle)] = lifecycle
+
+    def find_open_timing(self, lifecycle, name):
+        open_timings = self._open_timings(lifecycle, name)
+        if open_timings:
+            return open_timings[0]
+        return None
+
+    def _open_timings(self, lifecycle, name):
+        state = self._state(lifecycle)
+        if name not in state.open_timings:
+            open_timings = []
+            for t in self.db.find_timings(name=name, lifecycle=lifecycle):
+                try:
+                    if t.end_raw == None and t.start_raw != None:
+                        open_timings.append(t)
+                except models.RawData.DoesNotExist:
+                    # Our raw data was removed.
+                    pass
+            state.open_timings[name] = open_timings
+        return state.open_timings[name]
+
+    def save_timing(self, lifecycle, timing):
+        open_timings = self._open_timings(lifecycle, timing.name)
+        # Unsaved models all compare equal, so match on identity.
+        known = any(t is timing for t in open_timings)
+        is_open = timing.start_raw is not None and timing.end_raw is None
+        if is_open and not known:
+            open_timings.append(timing)
+        elif not is_open and known:
+            open_timings[:] = [t for t in open_timings if t is not timing]
+        self.dirty_timings[id(timing)] = timing
+
+    def save_now(self, obj):
+        """Writes obj immediately, for when something else is about
+        to reference it."""
+        self.dirty_lifecycles.pop(id(obj), None)
+        self.dirty_timings.pop(id(obj), None)
+        self.db.save(obj)
+
+    def discard(self):
+        """Forgets every instance and unsaved change, for when a
+        transaction they were made in was rolled back. They may point at
+        raws or Lifecycles that were never committed, and saving them
+        would fail every flush from then on. Changes from earlier, still
+        unsaved, are lost with them."""
+        self.instances.clear()
+        self.dirty_lifecycles.clear()
+        self.dirty_timings.clear()
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        flushed = len(self.dirty_lifecycles) + len(self.dirty_timings)
+        if flushed:
+            with self.db.commit_on_success():
+                # Lifecycles first, the Timings point at them.
+                for lifecycle in self.dirty_lifecycles.values():
+                    self.db.save(lifecycle)
+                for timing in self.dirty_timings.values():
+                    self.db.save(timing)
+            self.dirty_lifecycles.clear()
+            self.dirty_timings.clear()
+        self.last_flush = time.time()
+        return flushed
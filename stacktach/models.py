@@ -19,6 +19,7 @@ from django.db import models
 from django.db.models import Q
 
 from stacktach import datetime_to_decimal as dt
+from stacktach import fields
 
 
 def routing_key_type(key):
@@ -40,7 +41,7 @@ class GenericRawData(models.Model):
     deployment = models.ForeignKey(Deployment)
     tenant = models.CharField(max_length=50, null=True, blank=True,
                               db_index=True)
-    json = models.TextField()
+    json = fields.CompressedTextField()
     routing_key = models.CharField(max_length=50, null=True,
                                    blank=True, db_index=True)
     when = models.DecimalField(max_digits=20, decimal_places=6,
@@ -83,7 +84,7 @@ class RawData(models.Model):
     deployment = models.ForeignKey(Deployment)
     tenant = models.CharField(max_length=50, null=True, blank=True,
                               db_index=True)
-    json = models.TextField()
+    json = fields.CompressedTextField()
     routing_key = models.CharField(max_length=50, null=True,
                                    blank=True, db_index=True)
     state = models.CharField(max_length=20, null=True,
@@ -109,6 +110,8 @@ class RawData(models.Model):
                                 blank=True, db_index=True)
     request_id = models.CharField(max_length=50, null=True,
                                 blank=True, db_index=True)
+    message_id = models.CharField(max_length=50, null=True,
+                                  blank=True, db_index=True)
 
     def __repr__(self):
         return "%s %s %s" % (self.event, self.instance, self.state)
@@ -421,7 +424,7 @@ class GlanceRawData(models.Model):
     deployment = models.ForeignKey(Deployment)
     owner = models.CharField(max_length=255, null=True, blank=True,
                              db_index=True)
-    json = models.TextField()
+    json = fields.CompressedTextField()
     routing_key = models.CharField(max_length=50, null=True, blank=True,
                                    db_index=True)
     when = models.DecimalField(max_digits=20, decimal_places=6, db_index=True)
@@ -442,6 +445,8 @@ class GlanceRawData(models.Model):
     status = models.CharField(max_length=30, db_index=True,
                               choices=STATUS_CHOICES, null=True)
     image_type = models.IntegerField(null=True, default=0, db_index=True)
+    message_id = models.CharField(max_length=50, null=True, blank=True,
+                                  db_index=True)
 
     @staticmethod
     def get_name():
@@ -23,130 +23,187 @@ from stacktach import image_type
 from stacktach import db
 
 
+_UNSET = object()
+
+
+def _find(value, keys):
+    """Follows keys down through nested dicts, giving {} as soon as one is
+    missing or isn't a dict."""
+    for key in keys:
+        if not isinstance(value, dict):
+            return {}
+        value = value.get(key, {})
+    if not isinstance(value, dict):
+        return {}
+    return value
+
+
+def _tenant(body, payload):
+    tenant = body.get('_context_project_id', None)
+    if isinstance(payload, dict):
+        tenant = payload.get('tenant_id', tenant)
+    return tenant
+
+
+def find_instance(payload):
+    """The instance a nova payload is about, or None."""
+    # instance UUID's seem to hide in a lot of odd places.
+    instance = payload.get('instance_id', None)
+    instance = payload.get('instance_uuid', instance)
+    if not instance:
+        instance = payload.get('exception', {}).get('kwargs', {}).get('uuid')
+    if not instance:
+        instance = payload.get('instance', {}).get('uuid')
+    return instance
+
+
+def _slots(fields):
+    return [name for keys, values in fields for name, key, default in values]
+
+
+def _reader(fields):
+    """A function that reads every value in a FIELDS table off a body
+    onto a notification."""
+    def read(self, body):
+        for keys, values in fields:
+            get = _find(body, keys).get
+            for name, key, default in values:
+                setattr(self, name, get(key, default))
+    return read
+
+
 class Notification(object):
+    # The values read straight out of the body, as (keys down to a dict,
+    # [(attribute, key, default), ...]). Values are worked out once, when
+    # the notification is made, and kept in slots, since the worker reads
+    # most of them more than once for every message.
+    FIELDS = [
+        ((), [('request_id', '_context_request_id', ""),
+              ('message_id', 'message_id', None)]),
+    ]
+
+    __slots__ = ['body', 'deployment', 'routing_key', 'json', 'payload',
+                 'publisher', 'event', '_when', 'service', 'host', 'tenant',
+                 'instance'] + _slots(FIELDS)
+
     def __init__(self, body, deployment, routing_key, json):
         self.body = body
-        self.request_id = body.get('_context_request_id', "")
         self.deployment = deployment
         self.routing_key = routing_key
         self.json = json
         self.payload = body.get('payload', {})
-        self.publisher = self.body['publisher_id']
-        self.event = self.body['event_type']
+        self.publisher = body['publisher_id']
+        self.event = body['event_type']
+        _read_notification(self, body)
+        self._when = _UNSET
+
+        parts = self.publisher.split('.', 1)
+        self.service = parts[0]
+        self.host = None
+        if len(parts) > 1:
+            self.host = parts[1]
 
+        self._read_payload()
 
     @property
     def when(self):
-        when = self.body.get('timestamp', None)
-        if not when:
-            when = self.body['_context_timestamp']  # Old way of doing it
-        when = utils.str_time_to_unix(when)
-        return when
+        # Parsed the first time it's wanted rather than up front, since the
+        # worker's update policy makes a notification for every update
+        # just to look at its payload, and most of those are then dropped.
+        if self._when is _UNSET:
+            when = self.body.get('timestamp', None)
+            if not when:
+                when = self.body['_context_timestamp']  # Old way of doing it
+            self._when = utils.str_time_to_unix(when)
+        return self._when
 
-    @property
-    def service(self):
-        parts = self.publisher.split('.')
-        return parts[0]
+    def _read_payload(self):
+        """Fills in the values from the payload, which each kind of
+        notification has its own ideas about."""
+        self.tenant = _tenant(self.body, self.payload)
 
-    @property
-    def host(self):
-        host = None
-        parts = self.publisher.split('.')
-        if len(parts) > 1:
-            host = ".".join(parts[1:])
-        return host
+        self.instance = find_instance(self.payload)
 
-    @property
-    def tenant(self):
-        tenant = self.body.get('_context_project_id', None)
-        tenant = self.payload.get('tenant_id', tenant)
-        return tenant
+    def rawdata_kwargs(self):
+        return dict(deployment=self.deployment,
+                    routing_key=self.routing_key,
+                    tenant=self.tenant,
+                    json=self.json,
+                    when=self.when,
+                    publisher=self.publisher,
+                    event=self.event,
+                    service=self.service,
+                    host=self.host,
+                    instance=self.instance,
+                    request_id=self.request_id,
+                    message_id=self.message_id)
 
-    @property
-    def instance(self):
-        # instance UUID's seem to hide in a lot of odd places.
-        instance = self.payload.get('instance_id', None)
-        instance = self.payload.get('instance_uuid', instance)
-        if not instance:
-            instance = self.payload.get('exception', {}).get('kwargs', {}).get('uuid')
-        if not instance:
-            instance = self.payload.get('instance', {}).get('uuid')
-        return instance
+    def save(self):
+        return db.create_generic_rawdata(**self.rawdata_kwargs())
 
-    @property
-    def message_id(self):
-        return self.body.get('message_id', None)
+    @classmethod
+    def save_batch(cls, notifications):
+        return db.create_generic_rawdata_batch(
+            [n.rawdata_kwargs() for n in notifications])
 
-    def save(self):
-        return db.create_generic_rawdata(deployment=self.deployment,
-                                         routing_key=self.routing_key,
-                                         tenant=self.tenant,
-                                         json=self.json,
-                                         when=self.when,
-                                         publisher=self.publisher,
-                                         event=self.event,
-                                         service=self.service,
-                                         host=self.host,
-                                         instance=self.instance,
-                                         request_id=self.request_id,
-                                         message_id=self.message_id)
+
+_read_notification = _reader(Notification.FIELDS)
 
 
 class GlanceNotification(Notification):
-    def __init__(self, body, deployment, routing_key, json):
-        super(GlanceNotification, self).__init__(body, deployment,
-                                                 routing_key, json)
+    FIELDS = [
+        (('payload',), [('status', 'status', None),
+                        ('uuid', 'id', None),
+                        ('size', 'size', None),
+                        ('owner', 'owner', None)]),
+    ]
+
+    __slots__ = ['properties', 'image_type', 'created_at', 'deleted_at'] + \
+        _slots(FIELDS)
+
+    def _read_payload(self):
+        _read_glance(self, self.body)
+        self.tenant = _tenant(self.body, self.payload)
         if isinstance(self.payload, dict):
             self.properties = self.payload.get('properties', {})
             self.image_type = image_type.get_numeric_code(self.payload)
-            self.status = self.payload.get('status', None)
-            self.uuid = self.payload.get('id', None)
-            self.size = self.payload.get('size', None)
             created_at = self.payload.get('created_at', None)
             self.created_at = created_at and utils.str_time_to_unix(created_at)
         else:
             self.properties = {}
             self.image_type = None
-            self.status = None
-            self.uuid = None
-            self.size = None
             self.created_at = None
+        self.instance = self.properties.get('instance_uuid', None)
 
-    @property
-    def owner(self):
-        if isinstance(self.payload, dict):
-            return self.payload.get('owner', None)
-        else:
-            return None
-
-    @property
-    def instance(self):
-        return self.properties.get('instance_uuid', None)
-
-    @property
-    def deleted_at(self):
         deleted_at = self.body.get('deleted_at', None)
-
         if isinstance(self.payload, dict):
             deleted_at = deleted_at or self.payload.get('deleted_at', None)
+        self.deleted_at = deleted_at and utils.str_time_to_unix(deleted_at)
 
-        return deleted_at and utils.str_time_to_unix(deleted_at)
+    def rawdata_kwargs(self):
+        return dict(deployment=self.deployment,
+                    routing_key=self.routing_key,
+                    owner=self.owner,
+                    json=self.json,
+                    when=self.when,
+                    publisher=self.publisher,
+                    event=self.event,
+                    service=self.service,
+                    host=self.host,
+                    instance=self.instance,
+                    request_id=self.request_id,
+                    image_type=self.image_type,
+                    status=self.status,
+                    uuid=self.uuid,
+                    message_id=self.message_id)
 
     def save(self):
-        return db.create_glance_rawdata(deployment=self.deployment,
-                                        routing_key=self.routing_key,
-                                        owner=self.owner,
-                                        json=self.json,
-                                        when=self.when,
-                                        publisher=self.publisher,
-                                        event=self.event,
-                                        service=self.service,
-                                        host=self.host,
-                                        instance=self.instance,
-                                        request_id=self.request_id,
-                                        image_type=self.image_type,
-                                        status=self.status,
-                                        uuid=self.uuid)
+        return db.create_glance_rawdata(**self.rawdata_kwargs())
+
+    @classmethod
+    def save_batch(cls, notifications):
+        return db.create_glance_rawdata_batch(
+            [n.rawdata_kwargs() for n in notifications])
 
     def save_exists(self, raw):
         if isinstance(self.payload, dict):
@@ -167,6 +224,7 @@ class GlanceNotification(Notification):
             audit_period_ending = None
             images = []
 
+        rows = []
         for image in images:
             created_at = image['created_at']
             created_at = created_at and utils.str_time_to_unix(created_at)
@@ -184,19 +242,28 @@ class GlanceNotification(Notification):
                     'raw': raw,
                     'message_id': message_id
                 }
-                usage = db.get_image_usage(uuid=uuid)
-                values['usage'] = usage
                 values['created_at'] = created_at
                 if deleted_at:
-                    delete = db.get_image_delete(uuid=uuid)
-                    values['delete'] = delete
                     values['deleted_at'] = deleted_at
-
-                db.create_image_exists(**values)
+                rows.append(values)
             else:
                 stacklog.warn("Ignoring exists without created_at. GlanceRawData(%s)"
                               % raw.id)
 
+        if not rows:
+            return
+
+        # One tenant's exists can list thousands of images, so their usages
+        # and deletes are looked up together and the exists saved together.
+        usages = db.get_image_usages([values['uuid'] for values in rows])
+        deletes = db.get_image_deletes([values['uuid'] for values in rows
+                                        if 'deleted_at' in values])
+        for values in rows:
+            values['usage'] = usages.get(values['uuid'])
+            if 'deleted_at' in values:
+                values['delete'] = deletes.get(values['uuid'])
+        db.create_image_exists_batch(rows)
+
     def save_usage(self, raw):
         values = {
             'uuid': self.uuid,
@@ -216,72 +283,75 @@ class GlanceNotification(Notification):
         db.create_image_delete(**values)
 
 
+_read_glance = _reader(GlanceNotification.FIELDS)
+
+
 class NovaNotification(Notification):
-    def __init__(self, body, deployment, routing_key, json):
-        super(NovaNotification, self).__init__(body, deployment, routing_key,
-                                               json)
-        self.state = self.payload.get('state', '')
-        self.old_state = self.payload.get('old_state', '')
-        self.old_task = self.payload.get('old_task_state', '')
-        self.task = self.payload.get('new_task_state', '')
-        self.image_type = image_type.get_numeric_code(self.payload)
-        image_meta = self.payload.get('image_meta', {})
-        self.os_architecture = \
-            image_meta.get('org.openstack__1__architecture', '')
-        self.os_distro = image_meta.get('org.openstack__1__os_distro', '')
-        self.os_version = image_meta.get('org.openstack__1__os_version', '')
-        self.rax_options = image_meta.get('com.rackspace__1__options', '')
-        self.instance_type_id = self.payload.get('instance_type_id', None)
-        self.instance_flavor_id = self.payload.get('instance_flavor_id', None)
-        self.new_instance_type_id = \
-            self.payload.get('new_instance_type_id', None)
-        self.launched_at = self.payload.get('launched_at', None)
-        self.deleted_at = self.payload.get('deleted_at', None)
-        self.terminated_at = self.payload.get('terminated_at', None)
-        self.audit_period_beginning = self.payload.get(
-            'audit_period_beginning', None)
-        self.audit_period_ending = self.payload.get(
-            'audit_period_ending', None)
-        self.message = self.payload.get('message', None)
+    FIELDS = [
+        (('payload',), [
+            ('state', 'state', ''),
+            ('old_state', 'old_state', ''),
+            ('old_task', 'old_task_state', ''),
+            ('task', 'new_task_state', ''),
+            ('instance_type_id', 'instance_type_id', None),
+            ('instance_flavor_id', 'instance_flavor_id', None),
+            ('new_instance_type_id', 'new_instance_type_id', None),
+            ('launched_at', 'launched_at', None),
+            ('deleted_at', 'deleted_at', None),
+            ('terminated_at', 'terminated_at', None),
+            ('audit_period_beginning', 'audit_period_beginning', None),
+            ('audit_period_ending', 'audit_period_ending', None),
+            ('message', 'message', None)]),
+        (('payload', 'image_meta'), [
+            ('os_architecture', 'org.openstack__1__architecture', ''),
+            ('os_distro', 'org.openstack__1__os_distro', ''),
+            ('os_version', 'org.openstack__1__os_version', ''),
+            ('rax_options', 'com.rackspace__1__options', '')]),
         # (TMaddox) bandwidth could be None in the payload.
-        bandwidth = self.payload.get('bandwidth', {}) or {}
-        bandwidth_public = bandwidth.get('public', {})
-        self.bandwidth_public_out = bandwidth_public.get('bw_out', 0)
+        (('payload', 'bandwidth', 'public'), [
+            ('bandwidth_public_out', 'bw_out', 0)]),
+    ]
 
-    @property
-    def host(self):
-        host = None
-        parts = self.publisher.split('.')
-        if len(parts) > 1:
-            host = ".".join(parts[1:])
-        return host
+    __slots__ = ['image_type'] + _slots(FIELDS)
 
-    @property
-    def service(self):
-        parts = self.publisher.split('.')
-        return parts[0]
+    def _read_payload(self):
+        super(NovaNotification, self)._read_payload()
+        _read_nova(self, self.body)
+        self.image_type = image_type.get_numeric_code(self.payload)
+
+    def rawdata_kwargs(self):
+        return dict(deployment=self.deployment,
+                    routing_key=self.routing_key,
+                    tenant=self.tenant,
+                    json=self.json,
+                    when=self.when,
+                    publisher=self.publisher,
+                    event=self.event,
+                    service=self.service,
+                    host=self.host,
+                    instance=self.instance,
+                    request_id=self.request_id,
+                    image_type=self.image_type,
+                    state=self.state,
+                    old_state=self.old_state,
+                    task=self.task,
+                    old_task=self.old_task,
+                    os_architecture=self.os_architecture,
+                    os_distro=self.os_distro,
+                    os_version=self.os_version,
+                    rax_options=self.rax_options,
+                    message_id=self.message_id)
 
     def save(self):
-        return db.create_nova_rawdata(deployment=self.deployment,
-                                      routing_key=self.routing_key,
-                                      tenant=self.tenant,
-                                      json=self.json,
-                                      when=self.when,
-                                      publisher=self.publisher,
-                                      event=self.event,
-                                      service=self.service,
-                                      host=self.host,
-                                      instance=self.instance,
-                                      request_id=self.request_id,
-                                      image_type=self.image_type,
-                                      state=self.state,
-                                      old_state=self.old_state,
-                                      task=self.task,
-                                      old_task=self.old_task,
-                                      os_architecture=self.os_architecture,
-                                      os_distro=self.os_distro,
-                                      os_version=self.os_version,
-                                      rax_options=self.rax_options)
+        return db.create_nova_rawdata(**self.rawdata_kwargs())
+
+    @classmethod
+    def save_batch(cls, notifications):
+        return db.create_nova_rawdata_batch(
+            [n.rawdata_kwargs() for n in notifications])
+
+
+_read_nova = _reader(NovaNotification.FIELDS)
 
 
 def notification_factory(body, deployment, routing_key, json, exchange):
@@ -0,0 +1,168 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# MySQL range partitioning of the raw data tables on 'when', so old data
+# can be dropped a whole partition at a time instead of deleted row by row.
+#
+# MySQL needs the partitioning column in every unique key, so the primary
+# key becomes (id, when). id is still unique on its own and Django never
+# knows the difference. Partitioned InnoDB tables can't have foreign keys
+# either way, so the constraints to and from the raw tables are dropped;
+# the columns and their indexes stay. 'when' is a DECIMAL, which can't be
+# used directly, so partitions are on FLOOR(when) in unix seconds. MySQL
+# can't prune partitions through FLOOR(), so a query on 'when' still looks
+# in every partition. The only gain is dropping old data cheaply, and SQL
+# here that reads just the expiring partitions names them explicitly.
+#
+# Without the constraints nothing stops a dropped partition leaving rows
+# pointing at raws that are gone, so before a drop the rows that refer to
+# them get the same treatment the pruner gives them: nulled or deleted,
+# and a raw that has to be kept holds back its partition and every one
+# after it.
+#
+# The functions here only build SQL, the caller decides whether to run it.
+
+import calendar
+import datetime
+
+from stacktach import pruner
+
+PERIODS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(days=7),
+}
+
+# Everything from before the table was partitioned.
+FIRST_PARTITION = 'pold'
+LAST_PARTITION = 'pmax'
+
+
+def _unix(when):
+    return calendar.timegm(when.utctimetuple())
+
+
+def _from_unix(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def period_start(when, period):
+    """The start of the day, or the Monday of the week, when falls in."""
+    start = datetime.datetime(when.year, when.month, when.day)
+    if period == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def partition_name(start):
+    return 'p%s' % start.strftime('%Y%m%d')
+
+
+def _partition(name, upper):
+    return 'PARTITION %s VALUES LESS THAN (%s)' % (name, upper)
+
+
+def _future(after, now, period, future):
+    """(name, upper bound) for each partition needed after the bound
+    after, so there are future partitions beyond the current one."""
+    step = PERIODS[period]
+    wanted = _unix(period_start(now, period) + step * (future + 1))
+    partitions = []
+    upper = after
+    while upper < wanted:
+        start = _from_unix(upper)
+        upper = _unix(start + step)
+        partitions.append((partition_name(start), upper))
+    return partitions
+
+
+def foreign_key_sql(constraints):
+    """Drops foreign keys. constraints is a list of (table, constraint
+    name) from the information schema."""
+    return ['ALTER TABLE `%s` DROP FOREIGN KEY `%s`' % (owner, name)
+            for owner, name in constraints]
+
+
+def partition_table_sql(table, now, period='day', future=7):
+    """Partitions an unpartitioned table. Existing rows all land in the
+    first partition, which is dropped like any other once it's old
+    enough."""
+    start = _unix(period_start(now, period))
+    partitions = [_partition(FIRST_PARTITION, start)]
+    partitions.extend(_partition(name, upper) for name, upper in
+                      _future(start, now, period, future))
+    partitions.append(_partition(LAST_PARTITION, 'MAXVALUE'))
+    return ['ALTER TABLE `%s` DROP PRIMARY KEY, '
+            'ADD PRIMARY KEY (`id`, `when`) '
+            'PARTITION BY RANGE (FLOOR(`when`)) (%s)' %
+            (table, ', '.join(partitions))]
+
+
+def reference_sql(table, references, names):
+    """Nulls or deletes the rows that refer to raws in the named
+    partitions of table. references is a list of (table, column, action)
+    for the rows that refer to the raw table."""
+    statements = []
+    for owner, column, action in references:
+        join = ('`%s` JOIN `%s` PARTITION (%s) ON `%s`.`%s` = `%s`.`id`' %
+                (owner, table, ', '.join(names), owner, column, table))
+        if action == pruner.NULL:
+            statements.append('UPDATE %s SET `%s`.`%s` = NULL' %
+                              (join, owner, column))
+        elif action == pruner.DELETE:
+            statements.append('DELETE `%s` FROM %s' % (owner, join))
+    return statements
+
+
+def maintain_sql(table, partitions, now, period='day', future=7,
+                 retention_days=None, references=(), kept_since=None):
+    """Adds partitions so there are always future of them ahead of now,
+    and drops those entirely older than retention_days. partitions is the
+    table's existing (name, upper bound) pairs in order, with None as the
+    bound of the last one.
+
+    references are the rows that refer to the raw table, as for
+    reference_sql, and are cleaned up ahead of the drop. kept_since is
+    the unix time of the oldest raw a KEEP reference points at, if any;
+    no partition from then on is dropped."""
+    statements = []
+    bounded = [(name, upper) for name, upper in partitions
+               if upper is not None]
+    if not bounded:
+        raise ValueError("%s isn't partitioned by the partition manager"
+                         % table)
+
+    new = _future(bounded[-1][1], now, period, future)
+    if new:
+        definitions = [_partition(name, upper) for name, upper in new]
+        definitions.append(_partition(LAST_PARTITION, 'MAXVALUE'))
+        statements.append('ALTER TABLE `%s` REORGANIZE PARTITION %s INTO '
+                          '(%s)' % (table, LAST_PARTITION,
+                                    ', '.join(definitions)))
+
+    if retention_days is not None:
+        cutoff = _unix(now - datetime.timedelta(days=retention_days))
+        expired = [name for name, upper in bounded
+                   if upper <= cutoff and
+                   (kept_since is None or upper <= kept_since)]
+        if expired:
+            statements.extend(reference_sql(table, references, expired))
+            statements.append('ALTER TABLE `%s` DROP PARTITION %s' %
+                              (table, ', '.join(expired)))
+    return statements
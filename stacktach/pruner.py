@@ -0,0 +1,141 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Deletes expired raw data a small chunk at a time, in id order, so no
+# single transaction holds locks for long or floods the replicas. Rows
+# that point at a deleted raw are fixed up in the same transaction rather
+# than being left pointing at nothing.
+
+import time
+
+from django.db import connection
+from django.db import transaction
+
+from stacktach import models
+from stacktach import stacklog
+
+# What to do with rows that point at a raw being deleted.
+NULL = 'null'
+DELETE = 'delete'
+# The reference can't be nulled and the row is worth more than the raw,
+# so the raw is kept.
+KEEP = 'keep'
+
+REFERENCES = {
+    models.RawData: [(models.RawDataImageMeta, 'raw', DELETE),
+                     (models.Lifecycle, 'last_raw', NULL),
+                     (models.Timing, 'start_raw', NULL),
+                     (models.Timing, 'end_raw', NULL),
+                     (models.InstanceDeletes, 'raw', NULL),
+                     (models.InstanceExists, 'raw', NULL)],
+    models.GlanceRawData: [(models.ImageUsage, 'last_raw', NULL),
+                           (models.ImageDeletes, 'raw', NULL),
+                           (models.ImageExists, 'raw', KEEP)],
+    models.GenericRawData: [],
+}
+
+
+def find_raws_after(Model, after_id, limit):
+    """(id, when) of the next limit raws after after_id, in id order."""
+    query = Model.objects.filter(id__gt=after_id).order_by('id')
+    return list(query.values_list('id', 'when')[:limit])
+
+
+def delete_raws(Model, ids):
+    """Deletes the raws with the given ids and cleans up the rows that
+    refer to them, all in one transaction. Returns how many raws were
+    deleted."""
+    with transaction.commit_on_success():
+        ids = set(ids)
+        for Referrer, field, action in REFERENCES[Model]:
+            if action == KEEP:
+                kept = Referrer.objects.filter(**{'%s__in' % field: ids})
+                ids -= set(kept.values_list('%s_id' % field, flat=True))
+        if not ids:
+            return 0
+        for Referrer, field, action in REFERENCES[Model]:
+            query = Referrer.objects.filter(**{'%s__in' % field: ids})
+            if action == NULL:
+                query.update(**{field: None})
+            elif action == DELETE:
+                query.delete()
+        # Model.objects.filter().delete() would load every row, json and
+        # all, to look for cascades that have already been dealt with.
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE id IN (%s)' %
+                       (connection.ops.quote_name(Model._meta.db_table),
+                        ', '.join(['%s'] * len(ids))), sorted(ids))
+        transaction.set_dirty()
+    return len(ids)
+
+
+class Pruner(object):
+    def __init__(self, Model, checkpoint, chunk_size=1000,
+                 rows_per_second=None, sleep=0.5):
+        self.Model = Model
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        # A ceiling on the average delete rate, on top of the fixed sleep
+        # between chunks. Either way replicas get time to catch up.
+        self.rows_per_second = rows_per_second
+        self.sleep = sleep
+        self.last_id = checkpoint.read() or 0
+
+    def _pause(self, deleted, elapsed):
+        pause = self.sleep
+        if self.rows_per_second:
+            pause = max(pause, deleted / float(self.rows_per_second) -
+                        elapsed)
+        if pause > 0:
+            time.sleep(pause)
+
+    def prune_chunk(self, cutoff):
+        """Deletes the next chunk of raws, stopping at the first one that
+        isn't older than cutoff. Returns (rows deleted, done), done being
+        True once there's nothing more to prune."""
+        rows = find_raws_after(self.Model, self.last_id, self.chunk_size)
+        expired = []
+        for id, when in rows:
+            # ids only roughly follow 'when', so stop at the first row
+            # that's still wanted rather than skip past it. It will have
+            # expired by a later run.
+            if when >= cutoff:
+                break
+            expired.append(id)
+        if not expired:
+            return 0, True
+        deleted = delete_raws(self.Model, expired)
+        self.last_id = expired[-1]
+        self.checkpoint.write(self.last_id)
+        stacklog.info("Pruned %d %s up to id %d" %
+                      (deleted, self.Model.__name__, self.last_id))
+        return deleted, len(expired) < len(rows)
+
+    def prune(self, cutoff):
+        """Deletes everything older than cutoff, a unix timestamp. Returns
+        the number of raws deleted."""
+        total = 0
+        while True:
+            start = time.time()
+            deleted, done = self.prune_chunk(cutoff)
+            total += deleted
+            if done:
+                return total
+            self._pause(deleted, time.time() - start)
@@ -0,0 +1,215 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import bisect
+import json
+import os
+import time
+
+# Upper bounds, in milliseconds, of the histogram buckets. Anything slower
+# than the last one lands in a final overflow bucket.
+STAGE_BUCKETS_MS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                    500, 1000, 2500, 5000, 10000]
+
+# Ingest lag is measured in seconds rather than milliseconds.
+LAG_BUCKETS_S = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600,
+                 21600, 86400]
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value, count=1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.total += value * count
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the given percentile, or
+        the largest value seen if that's in the overflow bucket."""
+        if not self.count:
+            return 0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        mean = 0
+        if self.count:
+            mean = self.total / self.count
+        return {'count': self.count,
+                'mean': mean,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': zip(self.bounds + ['inf'], self.counts)}
+
+
+def _cache_stats(cache):
+    lookups = cache.hits + cache.misses
+    hit_ratio = 0.0
+    if lookups:
+        hit_ratio = cache.hits / float(lookups)
+    return {'size': len(cache.instances),
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'hit_ratio': hit_ratio}
+
+
+class _Timer(object):
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.stage, time.time() - self.start)
+
+
+class WorkerStats(object):
+    """Per stage timings, message rate and ingest lag for one worker
+    process, written out as json to path every interval seconds so they
+    can be polled or scraped without talking to the worker."""
+
+    def __init__(self, path, name, exchange, interval=10):
+        self.path = path
+        self.name = name
+        self.exchange = exchange
+        self.interval = interval
+        self.stages = {}
+        self.lag = Histogram(LAG_BUCKETS_S)
+        self.messages = 0
+        self.counters = {}
+        self.caches = {}
+        self.started = time.time()
+        self.last_write = self.started
+        self.last_messages = 0
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds, count=1):
+        """Adds count samples for stage. Batched stages pass the time for
+        the whole batch and are recorded as that many messages each
+        taking an equal share."""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(STAGE_BUCKETS_MS)
+        histogram.add(seconds * 1000.0 / count, count)
+
+    def count(self, counter, count=1):
+        """Adds to a running total of something that isn't timed."""
+        self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def add_cache(self, name, cache):
+        """Reports on cache, anything with hits and misses counts and an
+        instances dict, in every write."""
+        self.caches[name] = cache
+
+    def message(self, notification=None):
+        """Counts a processed message, and how far behind we are if we
+        have its notification."""
+        self.messages += 1
+        if notification is not None:
+            when = notification.when
+            if when is not None:
+                self.lag.add(max(0.0, time.time() - float(when)))
+
+    def to_dict(self):
+        now = time.time()
+        elapsed = now - self.last_write
+        rate = 0
+        if elapsed > 0:
+            rate = (self.messages - self.last_messages) / elapsed
+        return {'name': self.name,
+                'exchange': self.exchange,
+                'pid': os.getpid(),
+                'time': now,
+                'uptime': now - self.started,
+                'messages': self.messages,
+                'messages_per_second': rate,
+                'counters': self.counters,
+                'caches': dict((name, _cache_stats(cache)) for
+                               name, cache in self.caches.items()),
+                'stages_ms': dict((stage, histogram.to_dict()) for
+                                  stage, histogram in self.stages.items()),
+                'ingest_lag_s': self.lag.to_dict()}
+
+    def write(self):
+        stats = self.to_dict()
+        # Write then rename so readers never see a partial file.
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+        self.last_write = stats['time']
+        self.last_messages = self.messages
+
+    def maybe_write(self):
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullStats(object):
+    """Used when stats are turned off, so callers don't need to check."""
+
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def record(self, stage, seconds, count=1):
+        pass
+
+    def count(self, counter, count=1):
+        pass
+
+    def add_cache(self, name, cache):
+        pass
+
+    def message(self, notification=None):
+        pass
+
+    def maybe_write(self):
+        pass
+
+    def write(self):
+        pass
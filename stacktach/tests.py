@@ -19,6 +19,9 @@
 # IN THE SOFTWARE.
 
 from datetime import datetime
+import json
+
+from django.db import reset_queries
 from django.test import TransactionTestCase
 import db
 from stacktach.datetime_to_decimal import dt_to_decimal
@@ -28,6 +31,8 @@ from stacktach.models import GlanceRawData
 from stacktach.models import RawData
 from stacktach.models import get_model_fields
 from stacktach import datetime_to_decimal as dt
+from stacktach import models
+from stacktach import views
 
 
 
@@ -51,6 +56,7 @@ class RawDataImageMetaDbTestCase(TransactionTestCase):
             'host': 'host',
             'instance': '1234-5678-9012-3456',
             'request_id': '1234',
+            'message_id': 'message_id',
             'os_architecture': 'x86',
             'os_version': '1',
             'os_distro': 'windows',
@@ -89,6 +95,7 @@ class GlanceTestCase(TransactionTestCase):
             'request_id': '1234',
             'uuid': '1234-5678-0912-3456',
             'status': 'active',
+            'message_id': 'message_id',
         }
         db.create_glance_rawdata(**kwargs)
         rawdata = GlanceRawData.objects.all()[0]
@@ -240,3 +247,116 @@ class NovaRawDataSearchTestCase(TransactionTestCase):
         results = generic_raw.search_results({}, "2013-07-17 10:16:10.717219",
                                                 ' ')
         self.assertEqual(results,expected_result)
+
+
+class IngestQueryCountTestCase(TransactionTestCase):
+    """Pins down how many statements the worker issues for each kind of
+    event, so anything adding round trips to the ingest path shows up
+    here."""
+
+    def setUp(self):
+        self.deployment = db.get_or_create_deployment('depl')[0]
+
+    def _assert_ingest_queries(self, queries, exchange, event, payload,
+                               publisher='compute.host'):
+        body = {'event_type': event,
+                'publisher_id': publisher,
+                'timestamp': '2013-07-17 10:16:10.717219',
+                'message_id': 'message-%s' % event,
+                '_context_request_id': 'req-1234',
+                '_context_project_id': 'tenant',
+                'payload': payload}
+        args = ('monitor.info', body)
+        # process_raw_data() starts by emptying connection.queries, which
+        # assertNumQueries() counts from, so it has to start out empty.
+        reset_queries()
+        with self.assertNumQueries(queries):
+            raw, notif = views.process_raw_data(self.deployment, args,
+                                                json.dumps(args), exchange)
+            if exchange == 'glance':
+                views.post_process_glancerawdata(raw, notif)
+            else:
+                views.post_process_rawdata(raw, notif)
+
+    def test_get_instance_usage_is_one_query(self):
+        models.InstanceUsage(instance='instance', launched_at=1).save()
+        with self.assertNumQueries(1):
+            usage = db.get_instance_usage(instance='instance')
+        self.assertEqual(usage.launched_at, 1)
+
+    def test_nova_exists(self):
+        launched_at = '2013-07-17 09:00:00.000000'
+        models.InstanceUsage(instance='instance',
+                             launched_at=dt.dt_to_decimal(datetime(
+                                 2013, 7, 17, 9))).save()
+        models.InstanceDeletes(instance='instance',
+                               launched_at=dt.dt_to_decimal(datetime(
+                                   2013, 7, 17, 9))).save()
+        payload = {'instance_id': 'instance',
+                   'launched_at': launched_at,
+                   'deleted_at': '2013-07-17 10:00:00.000000',
+                   'audit_period_beginning': '2013-07-17 00:00:00.000000',
+                   'audit_period_ending': '2013-07-18 00:00:00.000000'}
+        # The raw and its image meta, the lifecycle lookup and insert, then
+        # the usage, the delete and the exists.
+        self._assert_ingest_queries(7, 'nova',
+                                    'compute.instance.exists', payload)
+
+    def test_glance_exists(self):
+        images = []
+        for i in range(2):
+            uuid = 'image-%d' % i
+            models.ImageUsage(uuid=uuid, created_at=1, size=10).save()
+            models.ImageDeletes(uuid=uuid, deleted_at=2).save()
+            images.append({'id': uuid, 'size': 10,
+                           'created_at': '2013-07-17 09:00:00.000000',
+                           'deleted_at': '2013-07-17 10:00:00.000000'})
+        payload = {'owner': 'tenant',
+                   'audit_period_beginning': '2013-07-17 00:00:00.000000',
+                   'audit_period_ending': '2013-07-18 00:00:00.000000',
+                   'images': images}
+        # The raw, then the usages, deletes and exists for all the images
+        # at once.
+        self._assert_ingest_queries(4, 'glance',
+                                    'image.exists', payload,
+                                    publisher='glance-api.host')
+        for exists in models.ImageExists.objects.all():
+            self.assertEqual(exists.usage.uuid, exists.uuid)
+            self.assertEqual(exists.delete.uuid, exists.uuid)
+
+    def test_nova_exists_batch(self):
+        launched = dt.dt_to_decimal(datetime(2013, 7, 17, 9))
+        messages = []
+        for i in range(3):
+            instance = 'instance-%d' % i
+            models.InstanceUsage(instance=instance,
+                                 launched_at=launched).save()
+            models.InstanceDeletes(instance=instance,
+                                   launched_at=launched).save()
+            body = {'event_type': 'compute.instance.exists',
+                    'publisher_id': 'compute.host',
+                    'timestamp': '2013-07-17 10:16:10.717219',
+                    'message_id': 'message-%d' % i,
+                    '_context_request_id': 'req-1234',
+                    '_context_project_id': 'tenant',
+                    'payload': {
+                        'instance_id': instance,
+                        'launched_at': '2013-07-17 09:00:00.000000',
+                        'deleted_at': '2013-07-17 10:00:00.000000',
+                        'audit_period_beginning': '2013-07-17 00:00:00',
+                        'audit_period_ending': '2013-07-18 00:00:00'}}
+            args = ('monitor.info', body)
+            messages.append((args, json.dumps(args)))
+        reset_queries()
+        # The raws and their image metas, a lifecycle lookup and insert
+        # for each instance, then the usages, deletes and exists for all
+        # of them at once.
+        with self.assertNumQueries(13):
+            results = views.process_raw_data_batch(self.deployment,
+                                                   messages, 'nova')
+            views.post_process_rawdata_batch(results)
+        exists = models.InstanceExists.objects.all()
+        self.assertEqual(len(exists), 3)
+        for row in exists:
+            self.assertEqual(row.usage.instance, row.instance)
+            self.assertEqual(row.delete.instance, row.instance)
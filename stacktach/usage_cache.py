@@ -0,0 +1,131 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+
+
+class _InstanceRows(object):
+    def __init__(self):
+        # request_id -> InstanceUsage
+        self.usages = {}
+        self.deletes = []
+
+
+def _launched_in(row, launched_range):
+    return (row.launched_at is not None and
+            launched_range[0] <= row.launched_at <= launched_range[1])
+
+
+class UsageCache(object):
+    """Keeps the InstanceUsage and InstanceDeletes rows of recently seen
+    instances in memory, so the usage processors don't look up a row an
+    earlier event for the instance already loaded or created. A start,
+    its end and the exists that follows find their usage with one query
+    between them.
+
+    Nothing is written behind, callers still save the rows they change,
+    and those are the same objects held here. Rows aren't looked for
+    anywhere else, so like the LifecycleStateEngine this relies on each
+    instance only being handled by one process. Only rows are cached,
+    never the absence of one.
+    """
+
+    def __init__(self, db, max_instances=10000):
+        self.db = db
+        self.max_instances = max_instances
+        self.instances = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _rows(self, instance):
+        rows = self.instances.pop(instance, None)
+        if rows is None:
+            while len(self.instances) >= self.max_instances:
+                self.instances.popitem(last=False)
+            rows = _InstanceRows()
+        # Re-inserting keeps the most recently used instance at the end.
+        self.instances[instance] = rows
+        return rows
+
+    def clear(self):
+        """Forgets everything, for when rows may have been rolled back."""
+        self.instances.clear()
+
+    def get_or_create_instance_usage(self, instance, request_id):
+        rows = self._rows(instance)
+        usage = rows.usages.get(request_id)
+        if usage is not None:
+            self.hits += 1
+            return usage, False
+        self.misses += 1
+        usage, new = self.db.get_or_create_instance_usage(
+            instance=instance, request_id=request_id)
+        rows.usages[request_id] = usage
+        return usage, new
+
+    def get_instance_usage(self, instance, launched_range):
+        """The usage launched within launched_range, as
+        db.get_instance_usage() would find it, or None."""
+        rows = self._rows(instance)
+        for usage in rows.usages.values():
+            if _launched_in(usage, launched_range):
+                self.hits += 1
+                return usage
+        self.misses += 1
+        usage = self.db.get_instance_usage(instance=instance,
+                                           launched_at__range=launched_range)
+        if usage is None:
+            return None
+        return rows.usages.setdefault(usage.request_id, usage)
+
+    def _remember_delete(self, rows, delete):
+        for known in rows.deletes:
+            if known.id == delete.id:
+                return known
+        rows.deletes.append(delete)
+        return delete
+
+    def get_or_create_instance_delete(self, instance, deleted_at,
+                                      launched_at):
+        rows = self._rows(instance)
+        for delete in rows.deletes:
+            if (delete.deleted_at == deleted_at and
+                    delete.launched_at == launched_at):
+                self.hits += 1
+                return delete, False
+        self.misses += 1
+        delete, new = self.db.get_or_create_instance_delete(
+            instance=instance, deleted_at=deleted_at, launched_at=launched_at)
+        return self._remember_delete(rows, delete), new
+
+    def get_instance_delete(self, instance, launched_range):
+        """The delete for the launch within launched_range, as
+        db.get_instance_delete() would find it, or None."""
+        rows = self._rows(instance)
+        for delete in rows.deletes:
+            if _launched_in(delete, launched_range):
+                self.hits += 1
+                return delete
+        self.misses += 1
+        delete = self.db.get_instance_delete(
+            instance=instance, launched_at__range=launched_range)
+        if delete is None:
+            return None
+        return self._remember_delete(rows, delete)
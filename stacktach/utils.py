@@ -1,10 +1,56 @@
 import datetime
+import re
 import uuid
 
 from stacktach import datetime_to_decimal as dt
 
+# Matches every format _try_parse() is given below. Anything else falls
+# back to strptime.
+_TIMESTAMP_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})[T ](\d{1,2}):(\d{1,2})'
+                           r':(\d{1,2})(?:\.(\d{1,6}))?Z?\Z')
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# The same audit period and launched_at strings turn up over and over,
+# so remember the last few we've parsed.
+_PARSED_TIMES = {}
+_PARSED_TIMES_MAX = 1024
+
 
 def str_time_to_unix(when):
+    parsed = _PARSED_TIMES.get(when)
+    if parsed is not None:
+        return parsed
+
+    parsed = _fast_parse(when)
+    if parsed is None:
+        parsed = _slow_parse(when)
+
+    if len(_PARSED_TIMES) >= _PARSED_TIMES_MAX:
+        _PARSED_TIMES.clear()
+    _PARSED_TIMES[when] = parsed
+    return parsed
+
+
+def _fast_parse(when):
+    match = _TIMESTAMP_RE.match(when)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    hour, minute, second = int(hour), int(minute), int(second)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    try:
+        days = datetime.date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+    seconds = ((days - _EPOCH_ORDINAL) * 86400 + hour * 3600 +
+               minute * 60 + second)
+    microsecond = 0
+    if fraction:
+        microsecond = int(fraction.ljust(6, '0'))
+    return dt.seconds_to_decimal(seconds, microsecond)
+
+
+def _slow_parse(when):
     if 'Z' in when:
         when = _try_parse(when, ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ"])
     elif 'T' in when:
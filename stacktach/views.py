@@ -3,6 +3,7 @@
 import datetime
 import json
 import pprint
+import time
 
 from django import db
 from django.shortcuts import render_to_response
@@ -11,10 +12,21 @@ from stacktach import datetime_to_decimal as dt
 from stacktach import db as stackdb
 from stacktach import models
 from stacktach import stacklog
+from stacktach import stats
 from stacktach import utils
 from stacktach import notification
 
 STACKDB = stackdb
+# Set by the worker to a lifecycle_engine.LifecycleStateEngine to cache
+# lifecycles and write them behind rather than on every event.
+LIFECYCLE_ENGINE = None
+# Replaced by the worker with a stats.WorkerStats when it's keeping stats.
+STATS = stats.NullStats()
+# Set by the worker to a dedup.Deduplicator to skip redelivered messages.
+DEDUP = None
+# Set by the worker to a usage_cache.UsageCache so the usage processors
+# don't look up the same usage and delete rows event after event.
+USAGE_CACHE = None
 
 
 def log_warn(msg):
@@ -58,6 +70,9 @@ def update_kpi(timing, raw):
         return
 
     tracker = trackers[0]
+    if LIFECYCLE_ENGINE is not None and timing.id is None:
+        # The tracker is about to point at this timing.
+        LIFECYCLE_ENGINE.save_now(timing)
     tracker.last_timing = timing
     tracker.duration = timing.end_when - tracker.start
     STACKDB.save(tracker)
@@ -76,18 +91,25 @@ def aggregate_lifecycle(raw):
     if not raw.instance:
         return
 
-    # While we hope only one lifecycle ever exists it's quite
-    # likely we get multiple due to the workers and threads.
-    lifecycle = None
-    lifecycles = STACKDB.find_lifecycles(instance=raw.instance)
-    if len(lifecycles) > 0:
-        lifecycle = lifecycles[0]
-    if not lifecycle:
-        lifecycle = STACKDB.create_lifecycle(instance=raw.instance)
+    engine = LIFECYCLE_ENGINE
+    if engine is not None:
+        lifecycle = engine.get_lifecycle(raw.instance)
+    else:
+        # While we hope only one lifecycle ever exists it's quite
+        # likely we get multiple due to the workers and threads.
+        lifecycle = None
+        lifecycles = STACKDB.find_lifecycles(instance=raw.instance)
+        if len(lifecycles) > 0:
+            lifecycle = lifecycles[0]
+        if not lifecycle:
+            lifecycle = STACKDB.create_lifecycle(instance=raw.instance)
     lifecycle.last_raw = raw
     lifecycle.last_state = raw.state
     lifecycle.last_task_state = raw.old_task
-    STACKDB.save(lifecycle)
+    if engine is not None:
+        engine.save_lifecycle(lifecycle)
+    else:
+        STACKDB.save(lifecycle)
 
     event = raw.event
     parts = event.split('.')
@@ -109,16 +131,20 @@ def aggregate_lifecycle(raw):
     # *shouldn't* happen).
     start = step == 'start'
     timing = None
-    timings = STACKDB.find_timings(name=name, lifecycle=lifecycle)
-    if not start:
-        for t in timings:
-            try:
-                if t.end_raw == None and t.start_raw != None:
-                    timing = t
-                    break
-            except models.RawData.DoesNotExist:
-                # Our raw data was removed.
-                pass
+    if engine is not None:
+        if not start:
+            timing = engine.find_open_timing(lifecycle, name)
+    else:
+        timings = STACKDB.find_timings(name=name, lifecycle=lifecycle)
+        if not start:
+            for t in timings:
+                try:
+                    if t.end_raw == None and t.start_raw != None:
+                        timing = t
+                        break
+                except models.RawData.DoesNotExist:
+                    # Our raw data was removed.
+                    pass
 
     if timing is None:
         timing = STACKDB.create_timing(name=name, lifecycle=lifecycle)
@@ -145,7 +171,10 @@ def aggregate_lifecycle(raw):
             timing.diff = timing.end_when - timing.start_when
             # Looks like a valid pair ...
             update_kpi(timing, raw)
-    STACKDB.save(timing)
+    if engine is not None:
+        engine.save_timing(lifecycle, timing)
+    else:
+        STACKDB.save(timing)
 
 
 INSTANCE_EVENT = {
@@ -165,12 +194,39 @@ INSTANCE_EVENT = {
 }
 
 
-def _process_usage_for_new_launch(raw, notification):
-    values = {}
-    values['instance'] = notification.instance
-    values['request_id'] = notification.request_id
+def _get_or_create_instance_usage(instance, request_id):
+    if USAGE_CACHE is not None:
+        return USAGE_CACHE.get_or_create_instance_usage(instance, request_id)
+    return STACKDB.get_or_create_instance_usage(instance=instance,
+                                                request_id=request_id)
+
+
+def _get_or_create_instance_delete(instance, deleted_at, launched_at):
+    if USAGE_CACHE is not None:
+        return USAGE_CACHE.get_or_create_instance_delete(
+            instance, deleted_at, launched_at)
+    return STACKDB.get_or_create_instance_delete(instance=instance,
+                                                 deleted_at=deleted_at,
+                                                 launched_at=launched_at)
+
 
-    (usage, new) = STACKDB.get_or_create_instance_usage(**values)
+def _get_instance_usage(instance, launched_range):
+    if USAGE_CACHE is not None:
+        return USAGE_CACHE.get_instance_usage(instance, launched_range)
+    return STACKDB.get_instance_usage(instance=instance,
+                                      launched_at__range=launched_range)
+
+
+def _get_instance_delete(instance, launched_range):
+    if USAGE_CACHE is not None:
+        return USAGE_CACHE.get_instance_delete(instance, launched_range)
+    return STACKDB.get_instance_delete(instance=instance,
+                                       launched_at__range=launched_range)
+
+
+def _process_usage_for_new_launch(raw, notification):
+    (usage, new) = _get_or_create_instance_usage(notification.instance,
+                                                 notification.request_id)
 
     if raw.event in [INSTANCE_EVENT['create_start'],
                      INSTANCE_EVENT['rebuild_start'],
@@ -216,8 +272,7 @@ def _process_usage_for_updates(raw, notification):
 
     instance_id = notification.instance
     request_id = notification.request_id
-    (usage, new) = STACKDB.get_or_create_instance_usage(instance=instance_id,
-                                                        request_id=request_id)
+    (usage, new) = _get_or_create_instance_usage(instance_id, request_id)
 
     if raw.event in [INSTANCE_EVENT['create_end'],
                      INSTANCE_EVENT['rebuild_end'],
@@ -250,62 +305,91 @@ def _process_delete(raw, notification):
         elif notification.terminated_at:
             deleted_at = utils.str_time_to_unix(notification.terminated_at)
         launched_at = utils.str_time_to_unix(notification.launched_at)
-        values = {
-            'instance': instance_id,
-            'deleted_at': deleted_at,
-            'launched_at': launched_at
-        }
-        (delete, new) = STACKDB.get_or_create_instance_delete(**values)
+        (delete, new) = _get_or_create_instance_delete(instance_id,
+                                                       deleted_at,
+                                                       launched_at)
         delete.raw = raw
 
         STACKDB.save(delete)
 
 
-def _process_exists(raw, notification):
-    instance_id = notification.instance
+def _exists_values(raw, notification):
+    """The InstanceExists fields for an exists notification, without its
+    usage and delete, or None if the exists can't be saved."""
     launched_at_str = notification.launched_at
-    if launched_at_str is not None and launched_at_str != '':
-        launched_at = utils.str_time_to_unix(notification.launched_at)
-        launched_range = (launched_at, launched_at+1)
-        usage = STACKDB.get_instance_usage(instance=instance_id,
-                                           launched_at__range=launched_range)
-        values = {}
-        values['message_id'] = notification.message_id
-        values['instance'] = instance_id
-        values['launched_at'] = launched_at
-        beginning = utils.str_time_to_unix(notification.audit_period_beginning)
-        values['audit_period_beginning'] = beginning
-        ending = utils.str_time_to_unix(notification.audit_period_ending)
-        values['audit_period_ending'] = ending
-        values['instance_type_id'] = notification.instance_type_id
-        values['instance_flavor_id'] = notification.instance_flavor_id
-        if usage:
-            values['usage'] = usage
-        values['raw'] = raw
-        values['tenant'] = notification.tenant
-        values['rax_options'] = notification.rax_options
-        values['os_architecture'] = notification.os_architecture
-        values['os_version'] = notification.os_version
-        values['os_distro'] = notification.os_distro
-        values['bandwidth_public_out'] = notification.bandwidth_public_out
-
-        deleted_at = notification.deleted_at
-        if deleted_at and deleted_at != '':
-            # We only want to pre-populate the 'delete' if we know this is in
-            #     fact an exist event for a deleted instance. Otherwise, there
-            #     is a chance we may populate it for a previous period's exist.
-            filter = {'instance': instance_id,
-                      'launched_at__range': launched_range}
-            delete = STACKDB.get_instance_delete(**filter)
-            deleted_at = utils.str_time_to_unix(deleted_at)
-            values['deleted_at'] = deleted_at
-            if delete:
-                values['delete'] = delete
-
-        exists = STACKDB.create_instance_exists(**values)
-        STACKDB.save(exists)
-    else:
+    if launched_at_str is None or launched_at_str == '':
         stacklog.warn("Ignoring exists without launched_at. RawData(%s)" % raw.id)
+        return None
+    values = {}
+    values['message_id'] = notification.message_id
+    values['instance'] = notification.instance
+    values['launched_at'] = utils.str_time_to_unix(launched_at_str)
+    beginning = utils.str_time_to_unix(notification.audit_period_beginning)
+    values['audit_period_beginning'] = beginning
+    ending = utils.str_time_to_unix(notification.audit_period_ending)
+    values['audit_period_ending'] = ending
+    values['instance_type_id'] = notification.instance_type_id
+    values['instance_flavor_id'] = notification.instance_flavor_id
+    values['raw'] = raw
+    values['tenant'] = notification.tenant
+    values['rax_options'] = notification.rax_options
+    values['os_architecture'] = notification.os_architecture
+    values['os_version'] = notification.os_version
+    values['os_distro'] = notification.os_distro
+    values['bandwidth_public_out'] = notification.bandwidth_public_out
+
+    deleted_at = notification.deleted_at
+    if deleted_at and deleted_at != '':
+        # We only want to pre-populate the 'delete' if we know this is in
+        #     fact an exist event for a deleted instance. Otherwise, there
+        #     is a chance we may populate it for a previous period's exist.
+        values['deleted_at'] = utils.str_time_to_unix(deleted_at)
+    return values
+
+
+def _process_exists(raw, notification):
+    values = _exists_values(raw, notification)
+    if values is None:
+        return
+    instance_id = values['instance']
+    launched_at = values['launched_at']
+    launched_range = (launched_at, launched_at+1)
+    usage = _get_instance_usage(instance_id, launched_range)
+    if usage:
+        values['usage'] = usage
+    if 'deleted_at' in values:
+        delete = _get_instance_delete(instance_id, launched_range)
+        if delete:
+            values['delete'] = delete
+
+    exists = STACKDB.create_instance_exists(**values)
+    STACKDB.save(exists)
+
+
+def _process_exists_batch(exists):
+    """_process_exists() for a list of (raw, notification) pairs, looking
+    up all their usages and deletes at once and saving them together."""
+    rows = []
+    for raw, notification in exists:
+        values = _exists_values(raw, notification)
+        if values is not None:
+            rows.append(values)
+    if not rows:
+        return
+    usages = STACKDB.get_instance_usages(
+        [(values['instance'], values['launched_at']) for values in rows])
+    deletes = {}
+    deleted = [(values['instance'], values['launched_at'])
+               for values in rows if 'deleted_at' in values]
+    if deleted:
+        deletes = STACKDB.get_instance_deletes(deleted)
+    for values in rows:
+        launch = (values['instance'], values['launched_at'])
+        if launch in usages:
+            values['usage'] = usages[launch]
+        if 'deleted_at' in values and launch in deletes:
+            values['delete'] = deletes[launch]
+    STACKDB.create_instance_exists_batch(rows)
 
 
 def _process_glance_usage(raw, notification):
@@ -355,24 +439,162 @@ def aggregate_glance_usage(raw, body):
         GLANCE_USAGE_PROCESS_MAPPING[raw.event](raw, body)
 
 
+def _duplicate_of(notif):
+    """The raw already saved for notif if it's a duplicate that shouldn't
+    be saved again, otherwise None."""
+    if DEDUP is None:
+        return None
+    with STATS.timer('dedup'):
+        raw = DEDUP.find_duplicate(notif)
+    if raw is None:
+        return None
+    STATS.count('duplicates')
+    if not DEDUP.drop:
+        action = ', saving anyway'
+    elif not DEDUP.transactional:
+        action = ', post processing the saved copy'
+    else:
+        action = ''
+    stacklog.warn("Duplicate %s message_id=%s%s" %
+                  (notif.event, notif.message_id, action))
+    if not DEDUP.drop:
+        return None
+    return raw
+
+
+def _resolve_duplicate(raw):
+    """What a duplicate of raw is handed to post processing as. None if
+    the first copy was post processed already."""
+    if DEDUP.transactional:
+        return None
+    # In a single worker process the first copy is acked before it's post
+    # processed, so if it wasn't acked it wasn't post processed either.
+    return raw
+
+
 def process_raw_data(deployment, args, json_args, exchange):
     """This is called directly by the worker to add the event to the db."""
     db.reset_queries()
 
     routing_key, body = args
-    notif = notification.notification_factory(body, deployment, routing_key,
-                                              json_args, exchange)
-    raw = notif.save()
+    with STATS.timer('notification'):
+        notif = notification.notification_factory(body, deployment,
+                                                  routing_key, json_args,
+                                                  exchange)
+    duplicate = _duplicate_of(notif)
+    if duplicate is not None:
+        return _resolve_duplicate(duplicate), notif
+    with STATS.timer('raw_insert'):
+        raw = notif.save()
     return raw, notif
 
 
+def process_raw_data_batch(deployment, messages, exchange):
+    """Batched version of process_raw_data(). messages is a list of
+    (args, json_args) pairs that all arrived on the same exchange."""
+    db.reset_queries()
+
+    if not messages:
+        return []
+    start = time.time()
+    notifs = []
+    for (routing_key, body), json_args in messages:
+        notifs.append(notification.notification_factory(
+            body, deployment, routing_key, json_args, exchange))
+    STATS.record('notification', time.time() - start, len(notifs))
+    if DEDUP is None:
+        saved = [None] * len(notifs)
+    else:
+        notifs, saved = _drop_duplicates(notifs)
+    new = [notif for notif, raw in zip(notifs, saved) if raw is None]
+    raws = iter([])
+    if new:
+        start = time.time()
+        raws = iter(new[0].save_batch(new))
+        STATS.record('raw_insert', time.time() - start, len(new))
+    return [(raw if raw is not None else raws.next(), notif)
+            for notif, raw in zip(notifs, saved)]
+
+
+def _drop_duplicates(notifs):
+    """Returns the notifications to keep, and with them the raw already
+    saved for each duplicate that's to be post processed again, or None
+    for those that need saving."""
+    # A message can be redelivered while its first copy is still waiting
+    # in the same batch, where the database can't see it yet. That copy
+    # is post processed along with the batch, so this one can go.
+    batch = set()
+    kept = []
+    saved = []
+    for notif in notifs:
+        message_id = notif.message_id
+        raw = None
+        if message_id and message_id in batch:
+            STATS.count('duplicates')
+            if DEDUP.drop:
+                continue
+        else:
+            raw = _duplicate_of(notif)
+            if raw is not None:
+                raw = _resolve_duplicate(raw)
+                if raw is None:
+                    continue
+        kept.append(notif)
+        saved.append(raw)
+        batch.add(message_id)
+    return kept, saved
+
+
 def post_process_rawdata(raw, notification):
-    aggregate_lifecycle(raw)
-    aggregate_usage(raw, notification)
+    with STATS.timer('lifecycle'):
+        aggregate_lifecycle(raw)
+    with STATS.timer('usage'):
+        aggregate_usage(raw, notification)
+
+
+def post_process_rawdata_batch(results, on_error=None):
+    """post_process_rawdata() for a batch of (raw, notification) pairs.
+    The exists are held back and saved together at the end, which is safe
+    as they're the last word on a launch and nothing else looks for them.
+    This is what gets the exists that follow each audit period through.
+
+    With on_error, a message that fails is handed to it as (raw,
+    notification, exception) and the rest of the batch carries on. If
+    saving the exists fails, each of them is handed over."""
+    exists = []
+    for raw, notification in results:
+        try:
+            with STATS.timer('lifecycle'):
+                aggregate_lifecycle(raw)
+            if raw.instance and raw.event == INSTANCE_EVENT['exists']:
+                exists.append((raw, notification))
+                continue
+            with STATS.timer('usage'):
+                aggregate_usage(raw, notification)
+        except Exception, e:
+            if on_error is None:
+                raise
+            on_error(raw, notification, e)
+    try:
+        if len(exists) == 1:
+            # Nothing to gain, and the usage cache may already have its
+            # rows.
+            with STATS.timer('usage'):
+                _process_exists(*exists[0])
+        elif exists:
+            start = time.time()
+            _process_exists_batch(exists)
+            STATS.record('usage', time.time() - start, len(exists))
+    except Exception, e:
+        if on_error is None:
+            raise
+        for raw, notification in exists:
+            on_error(raw, notification, e)
 
 
 def post_process_glancerawdata(raw, notification):
-    aggregate_glance_usage(raw, notification)
+    with STATS.timer('usage'):
+        aggregate_glance_usage(raw, notification)
 
 
 def post_process_genericrawdata(raw, notification):
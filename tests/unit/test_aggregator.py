@@ -0,0 +1,254 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.db import DatabaseError
+import mox
+
+from stacktach import db
+from stacktach import models
+from stacktach import notification
+from tests.unit import StacktachBaseTestCase
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from worker import aggregator
+
+
+class CheckpointTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = aggregator.Checkpoint(
+            os.path.join(self.dir, 'test.checkpoint'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_missing(self):
+        self.assertEqual(self.checkpoint.read(), None)
+
+    def test_write_then_read(self):
+        self.checkpoint.write(42)
+        self.checkpoint.write(43)
+        self.assertEqual(self.checkpoint.read(), 43)
+        self.assertEqual(os.listdir(self.dir), ['test.checkpoint'])
+
+
+class AggregatorTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.checkpoint = self.mox.CreateMockAnything()
+        self.aggregator = aggregator.Aggregator('test', 1, 'nova',
+                                                self.checkpoint,
+                                                chunk_size=10,
+                                                gap_timeout=30)
+        self.aggregator.last_id = 10
+        self.mox.StubOutWithMock(db, 'find_raw_keys_after')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _fake_shards(self, count):
+        shards = []
+        for i in range(count):
+            shards.append((self.mox.CreateMockAnything(),
+                           self.mox.CreateMockAnything()))
+        self.aggregator.shards = shards
+        self.aggregator.done = self.mox.CreateMockAnything()
+        return shards
+
+    def test_process_chunk_dispatches_by_instance(self):
+        shards = self._fake_shards(2)
+        rows = [(11, 1, INSTANCE_ID_1), (12, 2, INSTANCE_ID_1),
+                (13, 1, INSTANCE_ID_2), (14, 1, INSTANCE_ID_1)]
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn(rows)
+        by_shard = {}
+        for id, deployment_id, instance in rows:
+            if deployment_id == 1:
+                shard = self.aggregator._shard_for(instance)
+                by_shard.setdefault(shard, []).append(id)
+        for shard, ids in by_shard.items():
+            shards[shard][1].put((1, ids))
+        for shard in by_shard:
+            self.aggregator.done.get(timeout=1).AndReturn(1)
+        self.checkpoint.write(14)
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 4)
+        self.assertEqual(self.aggregator.last_id, 14)
+        self.mox.VerifyAll()
+
+    def test_process_chunk_waits_at_gap(self):
+        shards = self._fake_shards(1)
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([(11, 1, INSTANCE_ID_1), (13, 1, INSTANCE_ID_1)])
+        shards[0][1].put((1, [11]))
+        self.aggregator.done.get(timeout=1).AndReturn(1)
+        self.checkpoint.write(11)
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 1)
+        self.assertEqual(self.aggregator.last_id, 11)
+        self.assertTrue(12 in self.aggregator.gaps)
+        self.mox.VerifyAll()
+
+    def test_process_chunk_skips_expired_gap(self):
+        shards = self._fake_shards(1)
+        self.aggregator.gaps[11] = 0
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([(12, 1, INSTANCE_ID_1)])
+        shards[0][1].put((1, [12]))
+        self.aggregator.done.get(timeout=1).AndReturn(1)
+        self.checkpoint.write(12)
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 1)
+        self.assertEqual(self.aggregator.gaps, {})
+        self.assertEqual(self.aggregator.skipped.keys(), [11])
+        self.assertEqual(self.aggregator.skipped_ids, 1)
+        self.mox.VerifyAll()
+
+    def test_process_chunk_aggregates_late_rows(self):
+        shards = self._fake_shards(1)
+        self.aggregator.skipped = {8: time.time(), 9: time.time()}
+        self.mox.StubOutWithMock(db, 'find_raw_keys_by_id')
+        db.find_raw_keys_by_id(models.RawData, 'instance', [8, 9])\
+            .AndReturn([(9, 1, INSTANCE_ID_1)])
+        shards[0][1].put((1, [9]))
+        self.aggregator.done.get(timeout=1).AndReturn(1)
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([])
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 0)
+        self.assertEqual(self.aggregator.skipped.keys(), [8])
+        self.assertEqual(self.aggregator.late_rows, 1)
+        self.mox.VerifyAll()
+
+    def test_process_chunk_gives_up_on_old_skipped_ids(self):
+        self._fake_shards(1)
+        self.aggregator.skipped = {9: time.time() - 600}
+        self.mox.StubOutWithMock(db, 'find_raw_keys_by_id')
+        db.find_raw_keys_by_id(models.RawData, 'instance', [9])\
+            .AndReturn([])
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([])
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 0)
+        self.assertEqual(self.aggregator.skipped, {})
+        self.mox.VerifyAll()
+
+    def test_process_chunk_rescans_once_per_gap_timeout(self):
+        self._fake_shards(1)
+        self.aggregator.skipped = {9: time.time()}
+        self.aggregator.rescanned = time.time()
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([])
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 0)
+        self.assertEqual(self.aggregator.skipped.keys(), [9])
+        self.mox.VerifyAll()
+
+    def test_process_chunk_other_deployment_only(self):
+        self._fake_shards(1)
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([(11, 2, INSTANCE_ID_1)])
+        self.checkpoint.write(11)
+        self.mox.ReplayAll()
+        self.assertEqual(self.aggregator.process_chunk(), 1)
+        self.assertEqual(self.aggregator.last_id, 11)
+        self.mox.VerifyAll()
+
+    def test_dispatch_raises_when_shard_died(self):
+        shards = self._fake_shards(1)
+        db.find_raw_keys_after(models.RawData, 'instance', 10, 10)\
+            .AndReturn([(11, 1, INSTANCE_ID_1)])
+        shards[0][1].put((1, [11]))
+        self.aggregator.done.get(timeout=1)\
+            .AndRaise(aggregator.Queue.Empty())
+        shards[0][0].is_alive().AndReturn(False)
+        shards[0][0].pid = 1234
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, self.aggregator.process_chunk)
+        self.assertEqual(self.aggregator.last_id, 10)
+        self.mox.VerifyAll()
+
+
+class AggregateTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_aggregate(self):
+        body = {'event_type': 'compute.instance.create.start',
+                'publisher_id': 'compute.cpu1-n01.example.com'}
+        raw = self.mox.CreateMockAnything()
+        raw.json = json.dumps(['monitor.info', body])
+        raw.deployment = self.mox.CreateMockAnything()
+        raw.get_name().AndReturn('RawData')
+        self.mox.StubOutWithMock(db, 'get_raws_by_id')
+        db.get_raws_by_id(models.RawData, [1]).AndReturn([raw])
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        notif = self.mox.CreateMockAnything()
+        notification.notification_factory(body, raw.deployment,
+                                          'monitor.info', raw.json,
+                                          'nova').AndReturn(notif)
+        post_process = self.mox.CreateMockAnything()
+        post_process(raw, notif)
+        self.mox.stubs.Set(aggregator, 'POST_PROCESS_METHODS',
+                           {'RawData': post_process})
+        self.mox.ReplayAll()
+        aggregator.aggregate('nova', [1])
+        self.mox.VerifyAll()
+
+    def _raise_from_post_process(self, error):
+        body = {'event_type': 'compute.instance.create.start',
+                'publisher_id': 'compute.cpu1-n01.example.com'}
+        raw = self.mox.CreateMockAnything()
+        raw.id = 1
+        raw.json = json.dumps(['monitor.info', body])
+        raw.deployment = self.mox.CreateMockAnything()
+        raw.get_name().MultipleTimes().AndReturn('RawData')
+        self.mox.StubOutWithMock(db, 'get_raws_by_id')
+        db.get_raws_by_id(models.RawData, [1]).AndReturn([raw])
+        post_process = self.mox.CreateMockAnything()
+        post_process(raw, mox.IgnoreArg()).AndRaise(error)
+        self.mox.stubs.Set(aggregator, 'POST_PROCESS_METHODS',
+                           {'RawData': post_process})
+
+    def test_aggregate_skips_bad_row(self):
+        self._raise_from_post_process(ValueError('bad launched_at'))
+        self.mox.StubOutWithMock(aggregator, '_get_child_logger')
+        logger = self.mox.CreateMockAnything()
+        aggregator._get_child_logger().AndReturn(logger)
+        logger.exception(mox.IgnoreArg())
+        self.mox.ReplayAll()
+        aggregator.aggregate('nova', [1])
+        self.mox.VerifyAll()
+
+    def test_aggregate_raises_on_database_failure(self):
+        self._raise_from_post_process(
+            DatabaseError(2006, 'MySQL server has gone away'))
+        self.mox.ReplayAll()
+        self.assertRaises(DatabaseError, aggregator.aggregate, 'nova', [1])
+        self.mox.VerifyAll()
@@ -37,3 +37,17 @@ class DatetimeToDecimalTestCase(StacktachBaseTestCase):
         expected_datetime = datetime.datetime.utcfromtimestamp(expected_decimal)
         actual_datetime = datetime_to_decimal.dt_from_decimal(expected_decimal)
         self.assertEqual(actual_datetime, expected_datetime)
+
+    def test_datetime_to_decimal_drops_trailing_zeros(self):
+        utc_datetime = datetime.datetime(2012, 12, 21, 12, 34, 56, 120000)
+        actual_decimal = datetime_to_decimal.dt_to_decimal(utc_datetime)
+        self.assertEqual(str(actual_decimal), '1356093296.12')
+
+    def test_datetime_to_decimal_without_microseconds(self):
+        utc_datetime = datetime.datetime(2012, 12, 21, 12, 34, 56)
+        actual_decimal = datetime_to_decimal.dt_to_decimal(utc_datetime)
+        self.assertEqual(str(actual_decimal), '1356093296')
+
+    def test_seconds_to_decimal_negative(self):
+        actual_decimal = datetime_to_decimal.seconds_to_decimal(-2, 250000)
+        self.assertEqual(actual_decimal, decimal.Decimal('-1.75'))
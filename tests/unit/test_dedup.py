@@ -0,0 +1,161 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import mox
+
+from stacktach import db
+from stacktach import dedup
+from stacktach import models
+from tests.unit import StacktachBaseTestCase
+from tests.unit.utils import MESSAGE_ID_1
+from tests.unit.utils import MESSAGE_ID_2
+
+
+class BloomFilterTestCase(StacktachBaseTestCase):
+    def test_no_false_negatives(self):
+        bloom = dedup.BloomFilter(1000, error_rate=0.01)
+        keys = ['message-%d' % i for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertTrue(key in bloom)
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        bloom = dedup.BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('message-%d' % i)
+        false_positives = len([i for i in range(10000)
+                               if 'other-%d' % i in bloom])
+        self.assertTrue(false_positives < 300)
+
+    def test_unicode_keys(self):
+        bloom = dedup.BloomFilter(10)
+        bloom.add(u'caf\xe9')
+        self.assertTrue(u'caf\xe9' in bloom)
+
+
+class MessageFilterTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_add(self):
+        message_filter = dedup.MessageFilter(10)
+        self.assertFalse(message_filter.add(MESSAGE_ID_1))
+        self.assertTrue(message_filter.add(MESSAGE_ID_1))
+        self.assertFalse(message_filter.add(MESSAGE_ID_2))
+
+    def test_remembers_previous_window(self):
+        self.mox.StubOutWithMock(dedup.time, 'time')
+        dedup.time.time().AndReturn(1000.0)
+        dedup.time.time().AndReturn(1001.0)
+        dedup.time.time().MultipleTimes().AndReturn(1061.0)
+        self.mox.ReplayAll()
+
+        message_filter = dedup.MessageFilter(10, window=60)
+        self.assertFalse(message_filter.add(MESSAGE_ID_1))
+        self.assertTrue(message_filter.add(MESSAGE_ID_1))
+        self.assertTrue(message_filter.previous is not None)
+        self.mox.VerifyAll()
+
+    def test_forgets_after_two_windows(self):
+        message_filter = dedup.MessageFilter(1)
+        self.assertFalse(message_filter.add(MESSAGE_ID_1))
+        # Full, so each add starts a new filter.
+        self.assertFalse(message_filter.add(MESSAGE_ID_2))
+        self.assertFalse(message_filter.add('another'))
+        self.assertFalse(message_filter.add(MESSAGE_ID_1))
+
+
+class DeduplicatorTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.deduplicator = dedup.Deduplicator(models.RawData, 100)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _notification(self, message_id):
+        notif = self.mox.CreateMockAnything()
+        notif.message_id = message_id
+        return notif
+
+    def test_new_message_needs_no_query(self):
+        self.mox.StubOutWithMock(db, 'get_raw_by_message_id')
+        self.mox.ReplayAll()
+        self.assertIsNone(self.deduplicator.find_duplicate(
+            self._notification(MESSAGE_ID_1)))
+        self.mox.VerifyAll()
+
+    def test_without_message_id(self):
+        self.mox.StubOutWithMock(db, 'get_raw_by_message_id')
+        self.mox.ReplayAll()
+        self.assertIsNone(self.deduplicator.find_duplicate(
+            self._notification(None)))
+        self.assertIsNone(self.deduplicator.find_duplicate(
+            self._notification(None)))
+        self.mox.VerifyAll()
+
+    def test_duplicate_confirmed(self):
+        self.mox.StubOutWithMock(db, 'get_raw_by_message_id')
+        raw = self.mox.CreateMockAnything()
+        db.get_raw_by_message_id(models.RawData, MESSAGE_ID_1)\
+            .AndReturn(raw)
+        self.mox.ReplayAll()
+        self.deduplicator.find_duplicate(self._notification(MESSAGE_ID_1))
+        self.assertEqual(self.deduplicator.find_duplicate(
+            self._notification(MESSAGE_ID_1)), raw)
+        self.assertEqual(self.deduplicator.probable, 1)
+        self.assertEqual(self.deduplicator.duplicates, 1)
+        self.mox.VerifyAll()
+
+    def test_probable_duplicate_not_saved(self):
+        self.mox.StubOutWithMock(db, 'get_raw_by_message_id')
+        db.get_raw_by_message_id(models.RawData, MESSAGE_ID_1)\
+            .AndReturn(None)
+        self.mox.ReplayAll()
+        self.deduplicator.find_duplicate(self._notification(MESSAGE_ID_1))
+        self.assertIsNone(self.deduplicator.find_duplicate(
+            self._notification(MESSAGE_ID_1)))
+        self.assertEqual(self.deduplicator.probable, 1)
+        self.assertEqual(self.deduplicator.duplicates, 0)
+        self.mox.VerifyAll()
+
+    def test_seed(self):
+        self.mox.StubOutWithMock(db, 'get_recent_message_ids')
+        db.get_recent_message_ids(models.RawData, 10)\
+            .AndReturn([MESSAGE_ID_1])
+        self.mox.StubOutWithMock(db, 'get_raw_by_message_id')
+        raw = self.mox.CreateMockAnything()
+        db.get_raw_by_message_id(models.RawData, MESSAGE_ID_1)\
+            .AndReturn(raw)
+        self.mox.ReplayAll()
+        self.deduplicator.seed(10)
+        self.assertEqual(self.deduplicator.find_duplicate(
+            self._notification(MESSAGE_ID_1)), raw)
+        self.mox.VerifyAll()
+
+    def test_raw_model(self):
+        self.assertEqual(dedup.raw_model('nova'), models.RawData)
+        self.assertEqual(dedup.raw_model('glance'), models.GlanceRawData)
+        self.assertEqual(dedup.raw_model('neutron'), models.GenericRawData)
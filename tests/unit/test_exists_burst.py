@@ -0,0 +1,114 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+from tests.unit.utils import INSTANCE_ID_1
+from tests.unit.utils import INSTANCE_ID_2
+from tests.unit.utils import TIMESTAMP_1
+from worker import exists_burst
+
+
+class _Message(object):
+    def __init__(self, event, instance):
+        self.delivery_info = {'routing_key': 'monitor.info'}
+        self.body = json.dumps({
+            'event_type': event,
+            'publisher_id': 'compute.host1',
+            'timestamp': TIMESTAMP_1,
+            'payload': {'instance_id': instance}})
+
+
+def _exists(instance=INSTANCE_ID_1):
+    return _Message(exists_burst.EXISTS_EVENT, instance)
+
+
+class ExistsBurstTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(exists_burst.time, 'time')
+        self.burst = exists_burst.ExistsBurst(threshold=2, batch_size=3,
+                                              timeout=1.0)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_exists_go_straight_through_outside_a_burst(self):
+        exists_burst.time.time().AndReturn(1000.0)
+        exists_burst.time.time().AndReturn(1001.5)
+        self.mox.ReplayAll()
+        for i in range(2):
+            message = _exists()
+            self.assertEqual(self.burst.admit(message), ([], [message]))
+        self.mox.VerifyAll()
+
+    def test_holds_exists_in_a_burst_until_batch_is_full(self):
+        for now in [1000.0, 1000.1, 1000.2, 1000.3]:
+            exists_burst.time.time().AndReturn(now)
+        self.mox.ReplayAll()
+        messages = [_exists() for i in range(4)]
+        self.assertEqual(self.burst.admit(messages[0]), ([], [messages[0]]))
+        self.assertEqual(self.burst.admit(messages[1]), ([], []))
+        self.assertEqual(self.burst.admit(messages[2]), ([], []))
+        self.assertEqual(self.burst.admit(messages[3]),
+                         (messages[1:], []))
+        self.assertEqual(self.burst.held, [])
+        self.mox.VerifyAll()
+
+    def test_other_event_for_held_instance_releases_them_first(self):
+        exists_burst.time.time().AndReturn(1000.0)
+        exists_burst.time.time().AndReturn(1000.1)
+        self.mox.ReplayAll()
+        self.burst.admit(_exists(INSTANCE_ID_2))
+        held = _exists()
+        self.burst.admit(held)
+        other = _Message('compute.instance.update', INSTANCE_ID_2)
+        self.assertEqual(self.burst.admit(other), ([], [other]))
+        end = _Message('compute.instance.delete.end', INSTANCE_ID_1)
+        self.assertEqual(self.burst.admit(end), ([held], [end]))
+        self.mox.VerifyAll()
+
+    def test_expired(self):
+        exists_burst.time.time().AndReturn(1000.0)
+        exists_burst.time.time().AndReturn(1000.1)
+        exists_burst.time.time().AndReturn(1000.5)
+        exists_burst.time.time().AndReturn(1001.1)
+        self.mox.ReplayAll()
+        self.burst.admit(_exists())
+        held = _exists()
+        self.burst.admit(held)
+        self.assertEqual(self.burst.expired(), [])
+        self.assertEqual(self.burst.expired(), [held])
+        self.assertEqual(self.burst.expired(), [])
+        self.mox.VerifyAll()
+
+    def test_flush(self):
+        exists_burst.time.time().AndReturn(1000.0)
+        exists_burst.time.time().AndReturn(1000.1)
+        self.mox.ReplayAll()
+        self.burst.admit(_exists())
+        held = _exists()
+        self.burst.admit(held)
+        self.assertEqual(self.burst.flush(), [held])
+        self.assertEqual(self.burst.flush(), [])
+        self.mox.VerifyAll()
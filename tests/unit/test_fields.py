@@ -0,0 +1,71 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+
+from stacktach import fields
+from stacktach import models
+from tests.unit import StacktachBaseTestCase
+
+JSON = json.dumps(['monitor.info',
+                   {'event_type': 'compute.instance.update',
+                    'payload': {'display_name': u'caf\xe9',
+                                'state': 'active'}}])
+
+
+class CompressionTestCase(StacktachBaseTestCase):
+    def test_compress_round_trip(self):
+        compressed = fields.compress(JSON)
+        self.assertTrue(compressed.startswith(fields.COMPRESSED_MARKER))
+        self.assertEqual(fields.decompress(compressed), JSON)
+
+    def test_compress_unicode(self):
+        text = u'["monitor.info", {"name": "caf\xe9"}]'
+        self.assertEqual(fields.decompress(fields.compress(text)), text)
+
+    def test_compress_already_compressed(self):
+        compressed = fields.compress(JSON)
+        self.assertEqual(fields.compress(compressed), compressed)
+
+    def test_decompress_plain(self):
+        self.assertEqual(fields.decompress(JSON), JSON)
+        self.assertEqual(fields.decompress(None), None)
+
+
+class CompressedTextFieldTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.field = models.RawData._meta.get_field('json')
+
+    def tearDown(self):
+        fields.COMPRESS = False
+
+    def test_reads_either_format(self):
+        raw = models.RawData(json=fields.compress(JSON))
+        self.assertEqual(raw.json, JSON)
+        raw = models.RawData(json=JSON)
+        self.assertEqual(raw.json, JSON)
+
+    def test_prep_value_plain_by_default(self):
+        self.assertEqual(self.field.get_prep_value(JSON), JSON)
+
+    def test_prep_value_compressed(self):
+        fields.COMPRESS = True
+        value = self.field.get_prep_value(JSON)
+        self.assertEqual(value, fields.compress(JSON))
@@ -0,0 +1,144 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+from worker import flow_control
+
+
+class AckerTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.channel = self.mox.CreateMockAnything()
+        self.acker = flow_control.Acker()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _deliver(self, count):
+        messages = []
+        for tag in range(1, count + 1):
+            message = self.mox.CreateMockAnything()
+            message.delivery_tag = tag
+            message.channel = self.channel
+            self.acker.delivered(message)
+            messages.append(message)
+        return messages
+
+    def test_acks_unregistered_messages_alone(self):
+        message = self.mox.CreateMockAnything()
+        message.ack()
+        self.mox.ReplayAll()
+        self.assertEqual(self.acker.ack([message]), 1)
+        self.mox.VerifyAll()
+
+    def test_acks_oldest_run_with_one_multiple_ack(self):
+        messages = self._deliver(3)
+        self.channel.basic_ack(3, multiple=True)
+        self.mox.ReplayAll()
+        self.assertEqual(self.acker.ack(messages), 1)
+        self.assertEqual([m._state for m in messages], ['ACK'] * 3)
+        self.assertEqual(len(self.acker.outstanding), 0)
+        self.mox.VerifyAll()
+
+    def test_never_acks_past_an_outstanding_message(self):
+        held, first, second = self._deliver(3)
+        first.ack()
+        second.ack()
+        self.mox.ReplayAll()
+        self.assertEqual(self.acker.ack([second, first]), 2)
+        self.assertEqual(self.acker.outstanding.keys(), [1])
+        self.mox.VerifyAll()
+
+    def test_acks_the_rest_alone_after_a_run(self):
+        first, second, held, last = self._deliver(4)
+        self.channel.basic_ack(2, multiple=True)
+        last.ack()
+        self.mox.ReplayAll()
+        self.assertEqual(self.acker.ack([last, first, second]), 2)
+        self.assertEqual(self.acker.outstanding.keys(), [3])
+        self.mox.VerifyAll()
+
+    def test_reset(self):
+        message = self._deliver(1)[0]
+        self.acker.reset()
+        message.ack()
+        self.mox.ReplayAll()
+        self.acker.ack([message])
+        self.mox.VerifyAll()
+
+
+class PrefetchTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(flow_control.time, 'time')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_fixed_never_changes(self):
+        prefetch = flow_control.FixedPrefetch(100)
+        prefetch.record(1.0)
+        self.assertEqual(prefetch.update(), None)
+        self.assertEqual(prefetch.count, 100)
+
+    def test_adaptive_holds_buffer_seconds_of_work(self):
+        flow_control.time.time().AndReturn(100.0)
+        flow_control.time.time().AndReturn(111.0)
+        self.mox.ReplayAll()
+        prefetch = flow_control.AdaptivePrefetch(1000, minimum=10,
+                                                 maximum=1000, buffer=0.5)
+        prefetch.record(0.01)
+        self.assertEqual(prefetch.update(), 50)
+        self.assertEqual(prefetch.count, 50)
+        self.mox.VerifyAll()
+
+    def test_adaptive_stays_within_bounds(self):
+        flow_control.time.time().AndReturn(100.0)
+        self.mox.ReplayAll()
+        prefetch = flow_control.AdaptivePrefetch(100, minimum=10,
+                                                 maximum=200, buffer=1.0)
+        prefetch.record(5.0)
+        self.assertEqual(prefetch.wanted(), 10)
+        prefetch.latency = 0.0001
+        self.assertEqual(prefetch.wanted(), 200)
+        self.mox.VerifyAll()
+
+    def test_adaptive_waits_for_interval(self):
+        flow_control.time.time().AndReturn(100.0)
+        flow_control.time.time().AndReturn(105.0)
+        self.mox.ReplayAll()
+        prefetch = flow_control.AdaptivePrefetch(1000, buffer=0.5,
+                                                 interval=10)
+        prefetch.record(0.01)
+        self.assertEqual(prefetch.update(), None)
+        self.assertEqual(prefetch.count, 1000)
+        self.mox.VerifyAll()
+
+    def test_adaptive_ignores_small_changes(self):
+        flow_control.time.time().AndReturn(100.0)
+        flow_control.time.time().AndReturn(111.0)
+        self.mox.ReplayAll()
+        prefetch = flow_control.AdaptivePrefetch(100, buffer=1.0)
+        prefetch.record(1 / 90.0)
+        self.assertEqual(prefetch.update(), None)
+        self.assertEqual(prefetch.count, 100)
+        self.mox.VerifyAll()
@@ -0,0 +1,176 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+from tests.unit.utils import INSTANCE_ID_1
+from tests.unit.utils import INSTANCE_ID_2
+from tests.unit.utils import TIMESTAMP_1
+from worker import ingest_policy
+
+
+class _Message(object):
+    def __init__(self, event, instance, publisher='compute.host1',
+                 state='active', old_state='active', task=None,
+                 old_task=None):
+        self.delivery_info = {'routing_key': 'monitor.info'}
+        self.body = json.dumps({
+            'event_type': event,
+            'publisher_id': publisher,
+            'timestamp': TIMESTAMP_1,
+            'payload': {'instance_id': instance,
+                        'state': state,
+                        'old_state': old_state,
+                        'new_task_state': task,
+                        'old_task_state': old_task}})
+
+
+def _update(instance=INSTANCE_ID_1, **kwargs):
+    return _Message(ingest_policy.UPDATE_EVENT, instance, **kwargs)
+
+
+class StoreAllTestCase(StacktachBaseTestCase):
+    def test_admit(self):
+        policy = ingest_policy.StoreAll()
+        message = _update()
+        self.assertEqual(policy.admit(message), ([message], []))
+        self.assertEqual(policy.expired(), [])
+
+    def test_create(self):
+        self.assertTrue(isinstance(ingest_policy.create('store-all'),
+                                   ingest_policy.StoreAll))
+        self.assertTrue(isinstance(ingest_policy.create('sampled'),
+                                   ingest_policy.Sampled))
+        self.assertTrue(isinstance(ingest_policy.create('coalesce'),
+                                   ingest_policy.Coalesce))
+        self.assertRaises(ValueError, ingest_policy.create, 'bogus')
+
+
+class SampledTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.policy = ingest_policy.Sampled(rate=3)
+
+    def test_keeps_one_in_rate(self):
+        messages = [_update() for i in range(6)]
+        kept = [m for m in messages if self.policy.admit(m)[0]]
+        self.assertEqual(kept, [messages[0], messages[3]])
+
+    def test_keeps_transitions(self):
+        self.policy.admit(_update())
+        message = _update(state='stopped')
+        self.assertEqual(self.policy.admit(message), ([message], []))
+        message = _update(old_task=None, task='powering-off')
+        self.assertEqual(self.policy.admit(message), ([message], []))
+
+    def test_keeps_api_updates(self):
+        self.policy.admit(_update())
+        message = _update(publisher='api.host1')
+        self.assertEqual(self.policy.admit(message), ([message], []))
+
+    def test_keeps_other_events(self):
+        self.policy.admit(_update())
+        message = _Message('compute.instance.create.end', INSTANCE_ID_1)
+        self.assertEqual(self.policy.admit(message), ([message], []))
+
+
+class CoalesceTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.policy = ingest_policy.Coalesce(window=60)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_newer_update_replaces_held(self):
+        update1 = _update()
+        update2 = _update(state='stopped')
+        self.assertEqual(self.policy.admit(update1), ([], []))
+        self.assertEqual(self.policy.admit(update2), ([], [update1]))
+
+    def test_other_event_releases_held_update_first(self):
+        update = _update()
+        other = _update(instance=INSTANCE_ID_2)
+        end = _Message('compute.instance.create.end', INSTANCE_ID_1)
+        self.policy.admit(update)
+        self.policy.admit(other)
+        self.assertEqual(self.policy.admit(end), ([update, end], []))
+        self.assertEqual(self.policy.held.keys(), [INSTANCE_ID_2])
+
+    def test_expired_keeps_first_held_order(self):
+        self.mox.StubOutWithMock(ingest_policy.time, 'time')
+        ingest_policy.time.time().AndReturn(1000.0)
+        ingest_policy.time.time().AndReturn(1010.0)
+        ingest_policy.time.time().AndReturn(1065.0)
+        self.mox.ReplayAll()
+
+        self.policy.admit(_update())
+        self.policy.admit(_update(instance=INSTANCE_ID_2))
+        latest = _update(state='stopped')
+        self.policy.admit(latest)
+        self.assertEqual(self.policy.expired(), [latest])
+        self.assertEqual(self.policy.held.keys(), [INSTANCE_ID_2])
+        self.mox.VerifyAll()
+
+    def test_longest_held_goes_ahead_past_max_held(self):
+        policy = ingest_policy.Coalesce(window=60, max_held=2)
+        first = _update()
+        policy.admit(first)
+        policy.admit(_update(instance=INSTANCE_ID_2))
+        self.assertEqual(policy.admit(_update(instance='instance3')),
+                         ([first], []))
+        self.assertEqual(policy.held.keys(), [INSTANCE_ID_2, 'instance3'])
+
+    def test_api_update_not_held(self):
+        message = _update(publisher='api.host1')
+        self.assertEqual(self.policy.admit(message), ([message], []))
+
+    def test_expired(self):
+        self.mox.StubOutWithMock(ingest_policy.time, 'time')
+        ingest_policy.time.time().AndReturn(1000.0)
+        ingest_policy.time.time().AndReturn(1030.0)
+        ingest_policy.time.time().AndReturn(1050.0)
+        ingest_policy.time.time().AndReturn(1061.0)
+        self.mox.ReplayAll()
+
+        update1 = _update()
+        update2 = _update(instance=INSTANCE_ID_2)
+        self.policy.admit(update1)
+        self.policy.admit(update2)
+        self.assertEqual(self.policy.expired(), [])
+        self.assertEqual(self.policy.expired(), [update1])
+        self.assertEqual(self.policy.held.keys(), [INSTANCE_ID_2])
+        self.mox.VerifyAll()
+
+    def test_flush(self):
+        self.mox.StubOutWithMock(ingest_policy.time, 'time')
+        ingest_policy.time.time().AndReturn(1000.0)
+        ingest_policy.time.time().AndReturn(1030.0)
+        self.mox.ReplayAll()
+
+        update1 = _update()
+        update2 = _update(instance=INSTANCE_ID_2)
+        self.policy.admit(update1)
+        self.policy.admit(update2)
+        self.assertEqual(self.policy.flush(), [update1, update2])
+        self.assertEqual(self.policy.held, {})
+        self.mox.VerifyAll()
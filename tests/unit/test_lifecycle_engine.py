@@ -0,0 +1,237 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import datetime
+
+import mox
+
+import utils
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from stacktach import lifecycle_engine
+from stacktach import views
+from tests.unit import StacktachBaseTestCase
+
+
+class LifecycleStateEngineTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.db = self.mox.CreateMockAnything()
+        self.engine = lifecycle_engine.LifecycleStateEngine(
+            self.db, max_instances=2, flush_interval=5)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _lifecycle(self, instance, id):
+        lifecycle = utils.create_lifecycle(self.mox, instance, None, None,
+                                           None)
+        lifecycle.id = id
+        return lifecycle
+
+    def test_get_lifecycle_loads_once(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, 1)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([lifecycle])
+        self.mox.ReplayAll()
+        self.assertEqual(self.engine.get_lifecycle(INSTANCE_ID_1), lifecycle)
+        self.assertEqual(self.engine.get_lifecycle(INSTANCE_ID_1), lifecycle)
+        self.assertEqual(self.engine.hits, 1)
+        self.assertEqual(self.engine.misses, 1)
+        self.mox.VerifyAll()
+
+    def test_get_lifecycle_saves_new_lifecycle(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, None)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([])
+        self.db.create_lifecycle(instance=INSTANCE_ID_1).AndReturn(lifecycle)
+        self.db.save(lifecycle)
+        self.mox.ReplayAll()
+        self.assertEqual(self.engine.get_lifecycle(INSTANCE_ID_1), lifecycle)
+        self.mox.VerifyAll()
+
+    def test_eviction_saves_dirty_lifecycle(self):
+        lifecycle1 = self._lifecycle(INSTANCE_ID_1, 1)
+        lifecycle2 = self._lifecycle(INSTANCE_ID_2, 2)
+        lifecycle3 = self._lifecycle('instance3', 3)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1)\
+            .AndReturn([lifecycle1])
+        self.db.find_lifecycles(instance=INSTANCE_ID_2)\
+            .AndReturn([lifecycle2])
+        self.db.find_lifecycles(instance='instance3').AndReturn([lifecycle3])
+        self.db.save(lifecycle1)
+        self.mox.ReplayAll()
+        self.engine.save_lifecycle(self.engine.get_lifecycle(INSTANCE_ID_1))
+        self.engine.get_lifecycle(INSTANCE_ID_2)
+        self.engine.get_lifecycle('instance3')
+        self.assertEqual(self.engine.instances.keys(),
+                         [INSTANCE_ID_2, 'instance3'])
+        self.assertEqual(len(self.engine.dirty_lifecycles), 0)
+        self.mox.VerifyAll()
+
+    def test_find_open_timing_loads_from_db_once(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, 1)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([lifecycle])
+        raw = self.mox.CreateMockAnything()
+        closed = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle, start_raw=raw, end_raw=raw)
+        opened = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle, start_raw=raw)
+        self.db.find_timings(name='compute.instance.create',
+                             lifecycle=lifecycle).AndReturn([closed, opened])
+        self.mox.ReplayAll()
+        self.engine.get_lifecycle(INSTANCE_ID_1)
+        found = self.engine.find_open_timing(lifecycle,
+                                             'compute.instance.create')
+        self.assertEqual(found, opened)
+        found = self.engine.find_open_timing(lifecycle,
+                                             'compute.instance.create')
+        self.assertEqual(found, opened)
+        self.mox.VerifyAll()
+
+    def test_save_timing_tracks_open_timings(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, 1)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([lifecycle])
+        self.db.find_timings(name='compute.instance.create',
+                             lifecycle=lifecycle).AndReturn([])
+        self.mox.ReplayAll()
+        self.engine.get_lifecycle(INSTANCE_ID_1)
+        raw = self.mox.CreateMockAnything()
+        timing = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle, start_raw=raw)
+        self.engine.save_timing(lifecycle, timing)
+        self.assertEqual(
+            self.engine.find_open_timing(lifecycle,
+                                         'compute.instance.create'),
+            timing)
+        timing.end_raw = raw
+        self.engine.save_timing(lifecycle, timing)
+        self.assertEqual(
+            self.engine.find_open_timing(lifecycle,
+                                         'compute.instance.create'),
+            None)
+        self.assertEqual(self.engine.dirty_timings.values(), [timing])
+        self.mox.VerifyAll()
+
+    def test_flush_saves_lifecycles_then_timings(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, 1)
+        timing = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle)
+        self.engine.dirty_timings[id(timing)] = timing
+        self.engine.save_lifecycle(lifecycle)
+        transaction = self.mox.CreateMockAnything()
+        self.db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        self.db.save(lifecycle)
+        self.db.save(timing)
+        transaction.__exit__(None, None, None)
+        self.mox.ReplayAll()
+        self.assertEqual(self.engine.flush(), 2)
+        self.assertEqual(len(self.engine.dirty_lifecycles), 0)
+        self.assertEqual(len(self.engine.dirty_timings), 0)
+        self.mox.VerifyAll()
+
+    def test_discard(self):
+        lifecycle = self._lifecycle(INSTANCE_ID_1, 1)
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([lifecycle])
+        self.db.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([lifecycle])
+        self.mox.ReplayAll()
+        self.engine.get_lifecycle(INSTANCE_ID_1)
+        self.engine.save_lifecycle(lifecycle)
+        self.engine.discard()
+        self.assertEqual(self.engine.flush(), 0)
+        self.engine.get_lifecycle(INSTANCE_ID_1)
+        self.mox.VerifyAll()
+
+    def test_maybe_flush_waits_for_interval(self):
+        self.mox.StubOutWithMock(lifecycle_engine.time, 'time')
+        lifecycle_engine.time.time().AndReturn(self.engine.last_flush + 1)
+        self.mox.ReplayAll()
+        self.engine.save_lifecycle(self._lifecycle(INSTANCE_ID_1, 1))
+        self.engine.maybe_flush()
+        self.assertEqual(len(self.engine.dirty_lifecycles), 1)
+        self.mox.VerifyAll()
+
+
+class AggregateLifecycleWithEngineTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        views.STACKDB = self.mox.CreateMockAnything()
+        self.engine = self.mox.CreateMockAnything()
+        views.LIFECYCLE_ENGINE = self.engine
+
+    def tearDown(self):
+        views.LIFECYCLE_ENGINE = None
+        self.mox.UnsetStubs()
+
+    def test_aggregate_lifecycle_update(self):
+        when = datetime.datetime.utcnow()
+        raw = utils.create_raw(self.mox, when, 'compute.instance.update',
+                               old_task='reboot')
+        lifecycle = self.mox.CreateMockAnything()
+        self.engine.get_lifecycle(INSTANCE_ID_1).AndReturn(lifecycle)
+        self.engine.save_lifecycle(lifecycle)
+        self.mox.StubOutWithMock(views, "start_kpi_tracking")
+        views.start_kpi_tracking(lifecycle, raw)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(raw)
+        self.assertEqual(lifecycle.last_raw, raw)
+        self.assertEqual(lifecycle.last_task_state, 'reboot')
+        self.mox.VerifyAll()
+
+    def test_aggregate_lifecycle_end(self):
+        event_name = 'compute.instance.create'
+        start_when = datetime.datetime.utcnow()
+        end_when = start_when + datetime.timedelta(seconds=5)
+        start_raw = utils.create_raw(self.mox, start_when,
+                                     '%s.start' % event_name)
+        end_raw = utils.create_raw(self.mox, end_when, '%s.end' % event_name)
+        lifecycle = self.mox.CreateMockAnything()
+        self.engine.get_lifecycle(INSTANCE_ID_1).AndReturn(lifecycle)
+        self.engine.save_lifecycle(lifecycle)
+        timing = utils.create_timing(self.mox, event_name, lifecycle,
+                                     start_raw=start_raw,
+                                     start_when=start_when)
+        self.engine.find_open_timing(lifecycle, event_name).AndReturn(timing)
+        self.mox.StubOutWithMock(views, "update_kpi")
+        views.update_kpi(timing, end_raw)
+        self.engine.save_timing(lifecycle, timing)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(end_raw)
+        self.assertEqual(timing.end_raw, end_raw)
+        self.assertEqual(timing.diff, end_when - start_when)
+        self.mox.VerifyAll()
+
+    def test_update_kpi_saves_unsaved_timing(self):
+        lifecycle = self.mox.CreateMockAnything()
+        end = utils.decimal_utc()
+        raw = self.mox.CreateMockAnything()
+        raw.request_id = utils.REQUEST_ID_1
+        timing = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle, end_when=end)
+        timing.id = None
+        tracker = utils.create_tracker(self.mox, utils.REQUEST_ID_1,
+                                       lifecycle, end)
+        views.STACKDB.find_request_trackers(request_id=utils.REQUEST_ID_1)\
+            .AndReturn([tracker])
+        self.engine.save_now(timing)
+        views.STACKDB.save(tracker)
+        self.mox.ReplayAll()
+        views.update_kpi(timing, raw)
+        self.assertEqual(tracker.last_timing, timing)
+        self.mox.VerifyAll()
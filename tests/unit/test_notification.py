@@ -96,6 +96,7 @@ class NovaNotificationTestCase(StacktachBaseTestCase):
     def test_save_should_persist_nova_rawdata_to_database(self):
         body = {
             "event_type": "compute.instance.exists",
+            "message_id": MESSAGE_ID_1,
             '_context_request_id': REQUEST_ID_1,
             '_context_project_id': TENANT_ID_1,
             "timestamp": TIMESTAMP_1,
@@ -149,7 +150,8 @@ class NovaNotificationTestCase(StacktachBaseTestCase):
             os_version='os_version',
             rax_options='rax_opt',
             state='state',
-            task='task').AndReturn(raw)
+            task='task',
+            message_id=MESSAGE_ID_1).AndReturn(raw)
 
         self.mox.ReplayAll()
 
@@ -157,6 +159,30 @@ class NovaNotificationTestCase(StacktachBaseTestCase):
         self.assertEquals(notification.save(), raw)
         self.mox.VerifyAll()
 
+    def test_save_batch_should_persist_all_nova_rawdata(self):
+        body1 = {
+            "event_type": "compute.instance.update",
+            "timestamp": TIMESTAMP_1,
+            "publisher_id": "compute.global.preprod-ord.ohthree.com",
+            "payload": {'instance_id': INSTANCE_ID_1}
+        }
+        body2 = dict(body1, event_type="compute.instance.exists")
+        routing_key = "monitor.info"
+        notification1 = NovaNotification(body1, "1", routing_key,
+                                         json.dumps([routing_key, body1]))
+        notification2 = NovaNotification(body2, "1", routing_key,
+                                         json.dumps([routing_key, body2]))
+        raws = [self.mox.CreateMockAnything(), self.mox.CreateMockAnything()]
+        self.mox.StubOutWithMock(db, 'create_nova_rawdata_batch')
+        db.create_nova_rawdata_batch(
+            [notification1.rawdata_kwargs(),
+             notification2.rawdata_kwargs()]).AndReturn(raws)
+        self.mox.ReplayAll()
+
+        saved = NovaNotification.save_batch([notification1, notification2])
+        self.assertEquals(saved, raws)
+        self.mox.VerifyAll()
+
     def test_bandwidth_public_out_is_read_from_json(self):
         body = {
             "event_type": "compute.instance.exists",
@@ -266,6 +292,50 @@ class NovaNotificationTestCase(StacktachBaseTestCase):
                                         json_body)
         self.assertEquals(notification.bandwidth_public_out, 0)
 
+    def test_fields_default_when_image_meta_missing(self):
+        body = {
+            "event_type": "compute.instance.update",
+            "timestamp": TIMESTAMP_1,
+            "publisher_id": "compute.global.preprod-ord.ohthree.com",
+            "payload": {
+                'instance_id': INSTANCE_ID_1,
+                "state": 'state',
+            }
+        }
+        notification = NovaNotification(body, "1", "monitor.info", "{}")
+        self.assertEquals(notification.state, 'state')
+        self.assertEquals(notification.task, '')
+        self.assertEquals(notification.os_architecture, '')
+        self.assertEquals(notification.rax_options, '')
+        self.assertEquals(notification.launched_at, None)
+        self.assertEquals(notification.service, 'compute')
+        self.assertEquals(notification.host, 'global.preprod-ord.ohthree.com')
+
+    def test_when_is_parsed_once(self):
+        body = {
+            "event_type": "compute.instance.update",
+            "timestamp": TIMESTAMP_1,
+            "publisher_id": "compute",
+            "payload": {},
+        }
+        notification = NovaNotification(body, "1", "monitor.info", "{}")
+        self.mox.StubOutWithMock(utils, 'str_time_to_unix')
+        utils.str_time_to_unix(TIMESTAMP_1).AndReturn(DECIMAL_DUMMY_TIME)
+        self.mox.ReplayAll()
+        self.assertEquals(notification.when, DECIMAL_DUMMY_TIME)
+        self.assertEquals(notification.when, DECIMAL_DUMMY_TIME)
+        self.mox.VerifyAll()
+
+    def test_values_are_kept_in_slots(self):
+        body = {
+            "event_type": "compute.instance.update",
+            "timestamp": TIMESTAMP_1,
+            "publisher_id": "compute",
+            "payload": {},
+        }
+        notification = NovaNotification(body, "1", "monitor.info", "{}")
+        self.assertFalse(hasattr(notification, '__dict__'))
+
 
 class GlanceNotificationTestCase(StacktachBaseTestCase):
     def setUp(self):
@@ -308,7 +378,8 @@ class GlanceNotificationTestCase(StacktachBaseTestCase):
             request_id='',
             image_type=0,
             status="saving",
-            uuid="2df2ccf6-bc1b-4853-aab0-25fda346b3bb").AndReturn(raw)
+            uuid="2df2ccf6-bc1b-4853-aab0-25fda346b3bb",
+            message_id=None).AndReturn(raw)
 
         self.mox.ReplayAll()
 
@@ -343,7 +414,8 @@ class GlanceNotificationTestCase(StacktachBaseTestCase):
             request_id='',
             image_type=None,
             status=None,
-            uuid=None).AndReturn(raw)
+            uuid=None,
+            message_id=None).AndReturn(raw)
 
         self.mox.ReplayAll()
 
@@ -525,7 +597,8 @@ class GlanceExistsNotificationTestCase(StacktachBaseTestCase):
             request_id='',
             image_type=0,
             status=None,
-            uuid=None).AndReturn(raw)
+            uuid=None,
+            message_id=None).AndReturn(raw)
 
         self.mox.ReplayAll()
 
@@ -575,21 +648,23 @@ class GlanceExistsNotificationTestCase(StacktachBaseTestCase):
         routing_key = "glance_monitor.info"
         json_body = json.dumps([routing_key, body])
 
-        self.mox.StubOutWithMock(db, 'create_image_exists')
-        self.mox.StubOutWithMock(db, 'get_image_usage')
-
-        for i in range(0, 2):
-            db.get_image_usage(uuid=uuid).AndReturn(None)
-            db.create_image_exists(
-                created_at=utils.str_time_to_unix(created_at),
-                owner=TENANT_ID_1,
-                raw=raw,
-                audit_period_beginning=utils.str_time_to_unix(audit_period_beginning),
-                audit_period_ending=utils.str_time_to_unix(audit_period_ending),
-                size=size,
-                uuid=uuid,
-                usage=None,
-                message_id="d14cfa51-6a0e-4cf8-9130-804738be96d2").AndReturn(raw)
+        self.mox.StubOutWithMock(db, 'create_image_exists_batch')
+        self.mox.StubOutWithMock(db, 'get_image_usages')
+        self.mox.StubOutWithMock(db, 'get_image_deletes')
+
+        db.get_image_usages([uuid, uuid]).AndReturn({})
+        db.get_image_deletes([]).AndReturn({})
+        exists = dict(
+            created_at=utils.str_time_to_unix(created_at),
+            owner=TENANT_ID_1,
+            raw=raw,
+            audit_period_beginning=utils.str_time_to_unix(audit_period_beginning),
+            audit_period_ending=utils.str_time_to_unix(audit_period_ending),
+            size=size,
+            uuid=uuid,
+            usage=None,
+            message_id="d14cfa51-6a0e-4cf8-9130-804738be96d2")
+        db.create_image_exists_batch([exists, exists])
 
         self.mox.ReplayAll()
 
@@ -640,26 +715,89 @@ class GlanceExistsNotificationTestCase(StacktachBaseTestCase):
         deployment = "1"
         routing_key = "glance_monitor.info"
         json_body = json.dumps([routing_key, body])
-        self.mox.StubOutWithMock(db, 'create_image_exists')
-        self.mox.StubOutWithMock(db, 'get_image_usage')
-        self.mox.StubOutWithMock(db, 'get_image_delete')
-
-        for i in range(0, 2):
-            db.get_image_usage(uuid=uuid).AndReturn(None)
-            db.get_image_delete(uuid=uuid).AndReturn(delete)
-            db.create_image_exists(
-                created_at=utils.str_time_to_unix(created_at),
-                owner=TENANT_ID_1,
-                raw=raw,
-                audit_period_beginning=utils.str_time_to_unix(audit_period_beginning),
-                audit_period_ending=utils.str_time_to_unix(audit_period_ending),
-                size=size,
-                uuid=uuid,
-                usage=None,
-                delete=delete,
-                deleted_at=utils.str_time_to_unix(deleted_at),
-                message_id="d14cfa51-6a0e-4cf8-9130-804738be96d2").AndReturn(raw)
+        self.mox.StubOutWithMock(db, 'create_image_exists_batch')
+        self.mox.StubOutWithMock(db, 'get_image_usages')
+        self.mox.StubOutWithMock(db, 'get_image_deletes')
+
+        db.get_image_usages([uuid, uuid]).AndReturn({})
+        db.get_image_deletes([uuid, uuid]).AndReturn({uuid: delete})
+        exists = dict(
+            created_at=utils.str_time_to_unix(created_at),
+            owner=TENANT_ID_1,
+            raw=raw,
+            audit_period_beginning=utils.str_time_to_unix(audit_period_beginning),
+            audit_period_ending=utils.str_time_to_unix(audit_period_ending),
+            size=size,
+            uuid=uuid,
+            usage=None,
+            delete=delete,
+            deleted_at=utils.str_time_to_unix(deleted_at),
+            message_id="d14cfa51-6a0e-4cf8-9130-804738be96d2")
+        db.create_image_exists_batch([exists, exists])
+
+        self.mox.ReplayAll()
 
+        notification = GlanceNotification(body, deployment, routing_key,
+                                          json_body)
+        notification.save_exists(raw)
+        self.mox.VerifyAll()
+
+    def test_save_image_exists_matches_usages_and_deletes_by_uuid(self):
+        raw = self.mox.CreateMockAnything()
+        usage = self.mox.CreateMockAnything()
+        delete = self.mox.CreateMockAnything()
+        audit_period_beginning = "2013-05-20 17:31:57.939614"
+        audit_period_ending = "2013-06-20 17:31:57.939614"
+        created_at = "2013-05-20 19:31:57.939614"
+        deleted_at = "2013-05-20 21:31:57.939614"
+        body = {
+            "event_type": "image.exists",
+            "timestamp": "2013-06-20 18:31:57.939614",
+            "publisher_id": "glance-api01-r2961.global.preprod-ord.ohthree.com",
+            "message_id": "d14cfa51-6a0e-4cf8-9130-804738be96d2",
+            "payload": {
+                "audit_period_beginning": audit_period_beginning,
+                "audit_period_ending": audit_period_ending,
+                "owner": TENANT_ID_1,
+                "images":
+                [
+                    {
+                        "created_at": created_at,
+                        "id": "image1",
+                        "size": 1,
+                        "deleted_at": None,
+                    },
+                    {
+                        "created_at": created_at,
+                        "id": "image2",
+                        "size": 2,
+                        "deleted_at": deleted_at,
+                    }
+                ]
+            }
+        }
+        deployment = "1"
+        routing_key = "glance_monitor.info"
+        json_body = json.dumps([routing_key, body])
+        self.mox.StubOutWithMock(db, 'create_image_exists_batch')
+        self.mox.StubOutWithMock(db, 'get_image_usages')
+        self.mox.StubOutWithMock(db, 'get_image_deletes')
+
+        db.get_image_usages(['image1', 'image2']).AndReturn(
+            {'image1': usage})
+        db.get_image_deletes(['image2']).AndReturn({'image2': delete})
+        common = dict(
+            owner=TENANT_ID_1,
+            raw=raw,
+            audit_period_beginning=utils.str_time_to_unix(audit_period_beginning),
+            audit_period_ending=utils.str_time_to_unix(audit_period_ending),
+            created_at=utils.str_time_to_unix(created_at),
+            message_id="d14cfa51-6a0e-4cf8-9130-804738be96d2")
+        image1 = dict(common, uuid='image1', size=1, usage=usage)
+        image2 = dict(common, uuid='image2', size=2, usage=None,
+                      delete=delete,
+                      deleted_at=utils.str_time_to_unix(deleted_at))
+        db.create_image_exists_batch([image1, image2])
         self.mox.ReplayAll()
 
         notification = GlanceNotification(body, deployment, routing_key,
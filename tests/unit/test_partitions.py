@@ -0,0 +1,131 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import datetime
+
+from stacktach import partitions
+from stacktach import pruner
+from tests.unit import StacktachBaseTestCase
+
+# A Wednesday.
+NOW = datetime.datetime(2013, 5, 15, 13, 30)
+MAY_15 = 1368576000
+DAY = 86400
+
+
+class PartitionsTestCase(StacktachBaseTestCase):
+    def test_period_start(self):
+        self.assertEqual(partitions.period_start(NOW, 'day'),
+                         datetime.datetime(2013, 5, 15))
+        self.assertEqual(partitions.period_start(NOW, 'week'),
+                         datetime.datetime(2013, 5, 13))
+
+    def test_partition_table_sql(self):
+        sql = partitions.partition_table_sql('stacktach_rawdata', NOW,
+                                             future=1)
+        self.assertEqual(sql, [
+            'ALTER TABLE `stacktach_rawdata` DROP PRIMARY KEY, '
+            'ADD PRIMARY KEY (`id`, `when`) '
+            'PARTITION BY RANGE (FLOOR(`when`)) ('
+            'PARTITION pold VALUES LESS THAN (%d), '
+            'PARTITION p20130515 VALUES LESS THAN (%d), '
+            'PARTITION p20130516 VALUES LESS THAN (%d), '
+            'PARTITION pmax VALUES LESS THAN (MAXVALUE))' %
+            (MAY_15, MAY_15 + DAY, MAY_15 + 2 * DAY)])
+
+    def test_foreign_key_sql(self):
+        sql = partitions.foreign_key_sql([('stacktach_lifecycle',
+                                           'last_raw_id_refs_id_1234')])
+        self.assertEqual(sql, ['ALTER TABLE `stacktach_lifecycle` DROP '
+                               'FOREIGN KEY `last_raw_id_refs_id_1234`'])
+
+    def test_maintain_sql_adds_future_partitions(self):
+        existing = [('pold', MAY_15 - DAY), ('p20130514', MAY_15),
+                    ('pmax', None)]
+        sql = partitions.maintain_sql('stacktach_rawdata', existing, NOW,
+                                      future=1)
+        self.assertEqual(sql, [
+            'ALTER TABLE `stacktach_rawdata` REORGANIZE PARTITION pmax INTO '
+            '(PARTITION p20130515 VALUES LESS THAN (%d), '
+            'PARTITION p20130516 VALUES LESS THAN (%d), '
+            'PARTITION pmax VALUES LESS THAN (MAXVALUE))' %
+            (MAY_15 + DAY, MAY_15 + 2 * DAY)])
+
+    def test_maintain_sql_drops_expired_partitions(self):
+        existing = [('pold', MAY_15 - 2 * DAY),
+                    ('p20130513', MAY_15 - DAY),
+                    ('p20130514', MAY_15),
+                    ('p20130515', MAY_15 + DAY),
+                    ('p20130516', MAY_15 + 2 * DAY),
+                    ('pmax', None)]
+        sql = partitions.maintain_sql('stacktach_rawdata', existing, NOW,
+                                      future=1, retention_days=1)
+        self.assertEqual(sql, ['ALTER TABLE `stacktach_rawdata` DROP '
+                               'PARTITION pold, p20130513'])
+
+    def test_maintain_sql_cleans_up_references_before_drop(self):
+        existing = [('pold', MAY_15 - 2 * DAY),
+                    ('p20130513', MAY_15 - DAY),
+                    ('p20130514', MAY_15),
+                    ('p20130515', MAY_15 + DAY),
+                    ('p20130516', MAY_15 + 2 * DAY),
+                    ('pmax', None)]
+        references = [('stacktach_rawdataimagemeta', 'raw_id',
+                       pruner.DELETE),
+                      ('stacktach_lifecycle', 'last_raw_id', pruner.NULL)]
+        sql = partitions.maintain_sql('stacktach_rawdata', existing, NOW,
+                                      future=1, retention_days=1,
+                                      references=references)
+        self.assertEqual(sql, [
+            'DELETE `stacktach_rawdataimagemeta` FROM '
+            '`stacktach_rawdataimagemeta` JOIN `stacktach_rawdata` '
+            'PARTITION (pold, p20130513) ON '
+            '`stacktach_rawdataimagemeta`.`raw_id` = `stacktach_rawdata`.`id`',
+            'UPDATE `stacktach_lifecycle` JOIN `stacktach_rawdata` '
+            'PARTITION (pold, p20130513) ON '
+            '`stacktach_lifecycle`.`last_raw_id` = `stacktach_rawdata`.`id` '
+            'SET `stacktach_lifecycle`.`last_raw_id` = NULL',
+            'ALTER TABLE `stacktach_rawdata` DROP PARTITION pold, p20130513'])
+
+    def test_maintain_sql_keeps_partitions_with_kept_raws(self):
+        existing = [('pold', MAY_15 - 2 * DAY),
+                    ('p20130513', MAY_15 - DAY),
+                    ('p20130514', MAY_15),
+                    ('p20130515', MAY_15 + DAY),
+                    ('p20130516', MAY_15 + 2 * DAY),
+                    ('pmax', None)]
+        references = [('stacktach_imageexists', 'raw_id', pruner.KEEP)]
+        sql = partitions.maintain_sql('stacktach_glancerawdata', existing,
+                                      NOW, future=1, retention_days=1,
+                                      references=references,
+                                      kept_since=MAY_15 - DAY - 60)
+        self.assertEqual(sql, ['ALTER TABLE `stacktach_glancerawdata` '
+                               'DROP PARTITION pold'])
+
+    def test_maintain_sql_nothing_to_do(self):
+        existing = [('p20130515', MAY_15 + DAY),
+                    ('p20130516', MAY_15 + 2 * DAY), ('pmax', None)]
+        self.assertEqual(partitions.maintain_sql('stacktach_rawdata',
+                                                 existing, NOW, future=1),
+                         [])
+
+    def test_maintain_sql_not_partitioned(self):
+        self.assertRaises(ValueError, partitions.maintain_sql,
+                          'stacktach_rawdata', [], NOW)
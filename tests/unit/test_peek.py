@@ -0,0 +1,65 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+from tests.unit.utils import IMAGE_UUID_1
+from tests.unit.utils import INSTANCE_ID_1
+from worker import peek
+
+
+class _Message(object):
+    def __init__(self, body):
+        self.body = json.dumps(body)
+
+
+class PeekTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_body_decoded_once(self):
+        message = _Message({'event_type': 'compute.instance.update'})
+        self.mox.StubOutWithMock(peek.json, 'loads')
+        peek.json.loads(message.body).AndReturn(
+            {'event_type': 'compute.instance.update'})
+        self.mox.ReplayAll()
+        self.assertEqual(peek.event(message), 'compute.instance.update')
+        self.assertEqual(peek.body(message),
+                         {'event_type': 'compute.instance.update'})
+        self.mox.VerifyAll()
+
+    def test_key(self):
+        nova = _Message({'event_type': 'compute.instance.exists',
+                         'payload': {'instance_id': INSTANCE_ID_1}})
+        glance = _Message({'event_type': 'image.upload',
+                           'payload': {'id': IMAGE_UUID_1}})
+        self.assertEqual(peek.key(nova, 'nova'), INSTANCE_ID_1)
+        self.assertEqual(peek.key(glance, 'glance'), IMAGE_UUID_1)
+
+    def test_instance_without_payload(self):
+        message = _Message({'event_type': 'compute.instance.exists',
+                            'payload': 'oops'})
+        self.assertEqual(peek.instance(message), None)
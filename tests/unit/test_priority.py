@@ -0,0 +1,125 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+from tests.unit.utils import INSTANCE_ID_1
+from tests.unit.utils import INSTANCE_ID_2
+from worker import priority
+
+UPDATE = 'compute.instance.update'
+CREATE_END = 'compute.instance.create.end'
+
+
+class _Message(object):
+    def __init__(self, name, routing_key='monitor.info'):
+        self.name = name
+        self.delivery_info = {'routing_key': routing_key}
+
+    def __repr__(self):
+        return self.name
+
+
+class PriorityLanesTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.now = 100.0
+        self.mox.stubs.Set(priority.time, 'time', lambda: self.now)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _lanes(self, lanes=priority.DEFAULT_LANES, depth=2):
+        return priority.PriorityLanes(lanes, depth=depth, wait=0.1)
+
+    def test_usage_event_goes_ahead_of_updates(self):
+        lanes = self._lanes(depth=2)
+        update1 = _Message('update1')
+        update2 = _Message('update2')
+        end = _Message('end')
+        self.assertEqual(lanes.admit(update1, UPDATE, INSTANCE_ID_1), [])
+        self.assertEqual(lanes.admit(update2, UPDATE, INSTANCE_ID_1), [])
+        self.assertEqual(lanes.admit(end, CREATE_END, INSTANCE_ID_2), [end])
+        self.assertEqual(lanes.held, 2)
+
+    def test_earlier_messages_for_key_go_first(self):
+        lanes = self._lanes(depth=2)
+        update1 = _Message('update1')
+        update2 = _Message('update2')
+        end = _Message('end')
+        lanes.admit(update1, UPDATE, INSTANCE_ID_1)
+        lanes.admit(update2, UPDATE, INSTANCE_ID_2)
+        self.assertEqual(lanes.admit(end, CREATE_END, INSTANCE_ID_2),
+                         [update2, end])
+        self.assertEqual(lanes.held, 1)
+        self.assertEqual(lanes.keys.keys(), [INSTANCE_ID_1])
+
+    def test_lane_over_budget_yields(self):
+        lanes = self._lanes([{'name': 'usage', 'events': [CREATE_END],
+                              'budget': 1}], depth=1)
+        end1 = _Message('end1')
+        end2 = _Message('end2')
+        other = _Message('other')
+        self.assertEqual(lanes.admit(end1, CREATE_END, INSTANCE_ID_1), [])
+        self.assertEqual(lanes.admit(other, 'other', None), [end1])
+        self.assertEqual(lanes.admit(end2, CREATE_END, INSTANCE_ID_2),
+                         [other])
+        self.assertEqual([lane.name for lane in lanes.lanes],
+                         ['usage', 'default'])
+
+    def test_routing_key_lane(self):
+        lanes = self._lanes([{'name': 'errors',
+                              'routing_keys': ['monitor.error']}], depth=1)
+        info = _Message('info')
+        error = _Message('error', routing_key='monitor.error')
+        lanes.admit(info, UPDATE, INSTANCE_ID_1)
+        self.assertEqual(lanes.admit(error, UPDATE, INSTANCE_ID_2), [error])
+
+    def test_expired(self):
+        lanes = priority.PriorityLanes(depth=10, wait=0.1)
+        update = _Message('update')
+        end = _Message('end')
+        lanes.admit(update, UPDATE, INSTANCE_ID_1)
+        lanes.admit(end, CREATE_END, INSTANCE_ID_2)
+        self.now = 100.05
+        self.assertEqual(lanes.expired(), [])
+        self.now = 100.2
+        self.assertEqual(lanes.expired(), [end, update])
+        self.assertEqual(lanes.held, 0)
+
+    def test_flush(self):
+        lanes = self._lanes(depth=10)
+        update = _Message('update')
+        end = _Message('end')
+        lanes.admit(update, UPDATE, INSTANCE_ID_1)
+        lanes.admit(end, CREATE_END, INSTANCE_ID_2)
+        self.assertEqual(lanes.flush(), [end, update])
+        self.assertEqual(lanes.held, 0)
+
+    def test_lanes_for(self):
+        self.assertEqual(priority.lanes_for(None, 'nova'), None)
+        self.assertEqual(priority.lanes_for(True, 'nova'),
+                         priority.DEFAULT_LANES)
+        self.assertEqual(priority.lanes_for(True, 'glance'), None)
+        lanes = [{'name': 'deletes', 'events': ['image.delete']}]
+        self.assertEqual(priority.lanes_for({'glance': lanes}, 'glance'),
+                         lanes)
+        self.assertEqual(priority.lanes_for({'glance': lanes}, 'nova'), None)
@@ -0,0 +1,94 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import decimal
+import time
+
+import mox
+
+from stacktach import models
+from stacktach import pruner
+from stacktach import stacklog
+from tests.unit import StacktachBaseTestCase
+
+CUTOFF = 1000
+
+
+class PrunerTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.checkpoint = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(pruner, 'find_raws_after')
+        self.mox.StubOutWithMock(pruner, 'delete_raws')
+        self.mox.StubOutWithMock(stacklog, 'info')
+        self.mox.StubOutWithMock(time, 'sleep')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _pruner(self, last_id=None, **kwargs):
+        self.checkpoint.read().AndReturn(last_id)
+        self.mox.ReplayAll()
+        raw_pruner = pruner.Pruner(models.RawData, self.checkpoint,
+                                   chunk_size=3, **kwargs)
+        self.mox.ResetAll()
+        return raw_pruner
+
+    def test_prune_stops_at_unexpired_raw(self):
+        raw_pruner = self._pruner(last_id=10)
+        pruner.find_raws_after(models.RawData, 10, 3).AndReturn(
+            [(11, decimal.Decimal(10)), (12, decimal.Decimal(20)),
+             (13, decimal.Decimal(1000.5))])
+        pruner.delete_raws(models.RawData, [11, 12]).AndReturn(2)
+        self.checkpoint.write(12)
+        stacklog.info(mox.IgnoreArg())
+        self.mox.ReplayAll()
+        self.assertEqual(raw_pruner.prune(CUTOFF), 2)
+        self.assertEqual(raw_pruner.last_id, 12)
+        self.mox.VerifyAll()
+
+    def test_prune_pauses_between_chunks(self):
+        raw_pruner = self._pruner(sleep=0.5)
+        pruner.find_raws_after(models.RawData, 0, 3).AndReturn(
+            [(1, 10), (2, 10), (3, 10)])
+        pruner.delete_raws(models.RawData, [1, 2, 3]).AndReturn(3)
+        self.checkpoint.write(3)
+        stacklog.info(mox.IgnoreArg())
+        time.sleep(0.5)
+        pruner.find_raws_after(models.RawData, 3, 3).AndReturn([])
+        self.mox.ReplayAll()
+        self.assertEqual(raw_pruner.prune(CUTOFF), 3)
+        self.mox.VerifyAll()
+
+    def test_prune_nothing_expired(self):
+        raw_pruner = self._pruner(last_id=10)
+        pruner.find_raws_after(models.RawData, 10, 3).AndReturn(
+            [(11, 2000)])
+        self.mox.ReplayAll()
+        self.assertEqual(raw_pruner.prune(CUTOFF), 0)
+        self.assertEqual(raw_pruner.last_id, 10)
+        self.mox.VerifyAll()
+
+    def test_pause_keeps_to_rows_per_second(self):
+        raw_pruner = self._pruner(sleep=0, rows_per_second=100)
+        time.sleep(9.0)
+        self.mox.ReplayAll()
+        raw_pruner._pause(1000, 1.0)
+        self.mox.VerifyAll()
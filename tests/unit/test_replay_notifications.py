@@ -0,0 +1,74 @@
+# Copyright (c) 2012 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import imp
+import os
+import signal
+
+import mox
+
+from tests.unit import StacktachBaseTestCase
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts',
+                      'replay_notifications.py')
+
+
+def _load_script():
+    # The script takes ^C back from the worker when it's loaded.
+    handler = signal.getsignal(signal.SIGINT)
+    try:
+        return imp.load_source('replay_notifications', SCRIPT)
+    finally:
+        signal.signal(signal.SIGINT, handler)
+
+
+class ReplayShardedTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.replay = _load_script()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_replay_sharded_counts_failed_messages(self):
+        consumer = self.mox.CreateMockAnything()
+        consumer.in_flight = {}
+        consumer.shards = self.mox.CreateMockAnything()
+        throttle = self.mox.CreateMockAnything()
+
+        def route(message):
+            consumer.in_flight[message.delivery_tag] = message
+
+        messages = [self.replay._ReplayMessage(1, 'monitor.info', '{}'),
+                    self.replay._ReplayMessage(2, 'monitor.info', '{}')]
+        # Each message fills the one slot until its failure is collected.
+        for message in messages:
+            throttle.wait()
+            consumer._route(message).WithSideEffects(route)
+            consumer.shards.finished().AndReturn([(message.delivery_tag,
+                                                   'boom')])
+            consumer.shards.finished().AndReturn([])
+        consumer.shards.stop().AndReturn([])
+        self.mox.ReplayAll()
+        self.assertEqual(self.replay.replay_sharded(consumer, messages,
+                                                    throttle, 1),
+                         (2, 2))
+        self.assertEqual(consumer.in_flight, {})
+        self.mox.VerifyAll()
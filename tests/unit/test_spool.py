@@ -0,0 +1,121 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+
+from tests.unit import StacktachBaseTestCase
+from worker import spool
+
+
+class SpoolTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.dir)
+                      if name.endswith(spool.SEGMENT_SUFFIX))
+
+    def test_append_peek_advance(self):
+        s = spool.Spool(self.dir)
+        self.assertTrue(s.empty())
+        s.append('monitor.info', '{"a": 1}')
+        s.append('monitor.error', '{"b": 2}')
+        self.assertEqual(s.peek(10), [('monitor.info', '{"a": 1}'),
+                                      ('monitor.error', '{"b": 2}')])
+        s.advance(1)
+        self.assertEqual(s.peek(10), [('monitor.error', '{"b": 2}')])
+        s.advance(1)
+        self.assertTrue(s.empty())
+
+    def test_needs_sync(self):
+        s = spool.Spool(self.dir, sync_records=2, sync_interval=60)
+        self.assertFalse(s.needs_sync())
+        s.append('monitor.info', '{}')
+        self.assertFalse(s.needs_sync())
+        s.append('monitor.info', '{}')
+        self.assertTrue(s.needs_sync())
+        s.sync()
+        self.assertFalse(s.needs_sync())
+
+    def test_segments_roll_and_are_removed_once_read(self):
+        s = spool.Spool(self.dir, segment_bytes=1)
+        for i in range(3):
+            s.append('monitor.info', '{"i": %d}' % i)
+        self.assertEqual(len(self._segments()), 3)
+        self.assertEqual([body for key, body in s.peek(10)],
+                         ['{"i": 0}', '{"i": 1}', '{"i": 2}'])
+        s.advance(2)
+        self.assertEqual(len(self._segments()), 2)
+        self.assertEqual(s.peek(10), [('monitor.info', '{"i": 2}')])
+
+    def test_reopen_resumes_from_offset(self):
+        s = spool.Spool(self.dir)
+        for i in range(3):
+            s.append('monitor.info', '{"i": %d}' % i)
+        s.advance(1)
+        s.close()
+        s = spool.Spool(self.dir)
+        self.assertEqual([body for key, body in s.peek(10)],
+                         ['{"i": 1}', '{"i": 2}'])
+        s.append('monitor.info', '{"i": 3}')
+        self.assertEqual(len(s.peek(10)), 3)
+
+    def test_torn_tail_ends_segment(self):
+        s = spool.Spool(self.dir)
+        s.append('monitor.info', '{"i": 0}')
+        s.append('monitor.info', '{"i": 1}')
+        s.close()
+        path = os.path.join(self.dir, self._segments()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        s = spool.Spool(self.dir)
+        s.append('monitor.info', '{"i": 2}')
+        self.assertEqual([body for key, body in s.peek(10)],
+                         ['{"i": 0}', '{"i": 2}'])
+        s.advance(2)
+        self.assertTrue(s.empty())
+
+    def test_advance_syncs_offset_before_renaming_it(self):
+        s = spool.Spool(self.dir)
+        s.append('monitor.info', '{"i": 0}')
+        s.append('monitor.info', '{"i": 1}')
+        synced = []
+        fsync = os.fsync
+
+        def recording_fsync(fd):
+            synced.append(os.listdir(self.dir))
+            fsync(fd)
+
+        spool.os.fsync = recording_fsync
+        try:
+            s.advance(1)
+        finally:
+            spool.os.fsync = fsync
+        # The temp file, and then the directory once it's renamed.
+        self.assertEqual(len(synced), 2)
+        self.assertTrue('offset.tmp' in synced[0])
+        self.assertFalse('offset.tmp' in synced[1])
+        with open(os.path.join(self.dir, 'offset')) as f:
+            self.assertEqual(f.read().split()[0], '0')
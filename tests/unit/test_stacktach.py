@@ -28,11 +28,13 @@ from utils import BANDWIDTH_PUBLIC_OUTBOUND
 from utils import INSTANCE_FLAVOR_ID_1
 from utils import INSTANCE_FLAVOR_ID_2
 from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
 from utils import OS_VERSION_1
 from utils import OS_ARCH_1
 from utils import OS_DISTRO_1
 from utils import RAX_OPTIONS_1
 from utils import MESSAGE_ID_1
+from utils import MESSAGE_ID_2
 from utils import REQUEST_ID_1
 from utils import TENANT_ID_1
 from utils import INSTANCE_TYPE_ID_1
@@ -102,6 +104,204 @@ class StacktachRawParsingTestCase(StacktachBaseTestCase):
         views.process_raw_data(deployment, args, json_args, exchange)
         self.mox.VerifyAll()
 
+    def test_process_raw_data_batch(self):
+        deployment = self.mox.CreateMockAnything()
+        body1 = {'timestamp': '2013-1-25 13:38:23.123'}
+        body2 = {'timestamp': '2013-1-25 13:38:24.123'}
+        args1 = ('monitor.info', body1)
+        args2 = ('monitor.error', body2)
+        messages = [(args1, json.dumps(args1)), (args2, json.dumps(args2))]
+        exchange = 'nova'
+        notif1 = self.mox.CreateMockAnything()
+        notif2 = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        notification.notification_factory(body1, deployment, 'monitor.info',
+                                          json.dumps(args1), exchange)\
+            .AndReturn(notif1)
+        notification.notification_factory(body2, deployment, 'monitor.error',
+                                          json.dumps(args2), exchange)\
+            .AndReturn(notif2)
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        notif1.save_batch([notif1, notif2]).AndReturn([raw1, raw2])
+        self.mox.ReplayAll()
+
+        results = views.process_raw_data_batch(deployment, messages, exchange)
+        self.assertEqual(results, [(raw1, notif1), (raw2, notif2)])
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_drops_processed_duplicate(self):
+        deployment = self.mox.CreateMockAnything()
+        body = {'timestamp': '2013-1-25 13:38:23.123'}
+        args = ('monitor.info', body)
+        json_args = json.dumps(args)
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.event = 'compute.instance.exists'
+        mock_notification.message_id = MESSAGE_ID_1
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        notification.notification_factory(body, deployment, 'monitor.info',
+                                          json_args, 'nova').AndReturn(
+            mock_notification)
+        views.DEDUP = self.mox.CreateMockAnything()
+        views.DEDUP.drop = True
+        views.DEDUP.transactional = True
+        views.DEDUP.find_duplicate(mock_notification).AndReturn(
+            self.mox.CreateMockAnything())
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        stacklog.warn(mox.IgnoreArg())
+        self.mox.ReplayAll()
+
+        try:
+            self.assertEquals(
+                views.process_raw_data(deployment, args, json_args, 'nova'),
+                (None, mock_notification))
+        finally:
+            views.DEDUP = None
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_post_processes_saved_duplicate(self):
+        deployment = self.mox.CreateMockAnything()
+        body = {'timestamp': '2013-1-25 13:38:23.123'}
+        args = ('monitor.info', body)
+        json_args = json.dumps(args)
+        saved = self.mox.CreateMockAnything()
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.event = 'compute.instance.exists'
+        mock_notification.message_id = MESSAGE_ID_1
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        notification.notification_factory(body, deployment, 'monitor.info',
+                                          json_args, 'nova').AndReturn(
+            mock_notification)
+        views.DEDUP = self.mox.CreateMockAnything()
+        views.DEDUP.drop = True
+        views.DEDUP.transactional = False
+        views.DEDUP.find_duplicate(mock_notification).AndReturn(saved)
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        stacklog.warn(mox.IgnoreArg())
+        self.mox.ReplayAll()
+
+        try:
+            self.assertEquals(
+                views.process_raw_data(deployment, args, json_args, 'nova'),
+                (saved, mock_notification))
+        finally:
+            views.DEDUP = None
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_saves_duplicate_when_counting(self):
+        deployment = self.mox.CreateMockAnything()
+        body = {'timestamp': '2013-1-25 13:38:23.123'}
+        args = ('monitor.info', body)
+        json_args = json.dumps(args)
+        mock_record = self.mox.CreateMockAnything()
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.event = 'compute.instance.exists'
+        mock_notification.message_id = MESSAGE_ID_1
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        notification.notification_factory(body, deployment, 'monitor.info',
+                                          json_args, 'nova').AndReturn(
+            mock_notification)
+        views.DEDUP = self.mox.CreateMockAnything()
+        views.DEDUP.drop = False
+        views.DEDUP.find_duplicate(mock_notification).AndReturn(
+            self.mox.CreateMockAnything())
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        stacklog.warn(mox.IgnoreArg())
+        mock_notification.save().AndReturn(mock_record)
+        self.mox.ReplayAll()
+
+        try:
+            self.assertEquals(
+                views.process_raw_data(deployment, args, json_args, 'nova'),
+                (mock_record, mock_notification))
+        finally:
+            views.DEDUP = None
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_batch_drops_processed_duplicates(self):
+        deployment = self.mox.CreateMockAnything()
+        bodies = [{'timestamp': '2013-1-25 13:38:2%d.123' % i}
+                  for i in range(3)]
+        messages = [(('monitor.info', body),
+                     json.dumps(('monitor.info', body))) for body in bodies]
+        notifs = []
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        for body, message_id in zip(bodies, [MESSAGE_ID_1, MESSAGE_ID_2,
+                                             MESSAGE_ID_1]):
+            notif = self.mox.CreateMockAnything()
+            notif.event = 'compute.instance.exists'
+            notif.message_id = message_id
+            notifs.append(notif)
+            notification.notification_factory(
+                body, deployment, 'monitor.info',
+                json.dumps(('monitor.info', body)), 'nova').AndReturn(notif)
+        views.DEDUP = self.mox.CreateMockAnything()
+        views.DEDUP.drop = True
+        views.DEDUP.transactional = True
+        views.DEDUP.find_duplicate(notifs[0]).AndReturn(None)
+        views.DEDUP.find_duplicate(notifs[1]).AndReturn(
+            self.mox.CreateMockAnything())
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        stacklog.warn(mox.IgnoreArg())
+        raw = self.mox.CreateMockAnything()
+        # The second copy of MESSAGE_ID_1 isn't saved yet, so it's caught
+        # without asking the deduplicator.
+        notifs[0].save_batch([notifs[0]]).AndReturn([raw])
+        self.mox.ReplayAll()
+
+        try:
+            results = views.process_raw_data_batch(deployment, messages,
+                                                   'nova')
+        finally:
+            views.DEDUP = None
+        self.assertEqual(results, [(raw, notifs[0])])
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_batch_keeps_saved_duplicates_in_order(self):
+        deployment = self.mox.CreateMockAnything()
+        bodies = [{'timestamp': '2013-1-25 13:38:2%d.123' % i}
+                  for i in range(3)]
+        messages = [(('monitor.info', body),
+                     json.dumps(('monitor.info', body))) for body in bodies]
+        notifs = []
+        self.mox.StubOutWithMock(notification, 'notification_factory')
+        for body, message_id in zip(bodies, [MESSAGE_ID_1, MESSAGE_ID_2,
+                                             None]):
+            notif = self.mox.CreateMockAnything()
+            notif.event = 'compute.instance.exists'
+            notif.message_id = message_id
+            notifs.append(notif)
+            notification.notification_factory(
+                body, deployment, 'monitor.info',
+                json.dumps(('monitor.info', body)), 'nova').AndReturn(notif)
+        views.DEDUP = self.mox.CreateMockAnything()
+        views.DEDUP.drop = True
+        views.DEDUP.transactional = False
+        saved = self.mox.CreateMockAnything()
+        views.DEDUP.find_duplicate(notifs[0]).AndReturn(saved)
+        views.DEDUP.find_duplicate(notifs[1]).AndReturn(None)
+        views.DEDUP.find_duplicate(notifs[2]).AndReturn(None)
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        stacklog.warn(mox.IgnoreArg())
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        notifs[1].save_batch([notifs[1], notifs[2]]).AndReturn([raw1, raw2])
+        self.mox.ReplayAll()
+
+        try:
+            results = views.process_raw_data_batch(deployment, messages,
+                                                   'nova')
+        finally:
+            views.DEDUP = None
+        self.assertEqual(results, [(saved, notifs[0]), (raw1, notifs[1]),
+                                   (raw2, notifs[2])])
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_batch_empty(self):
+        self.mox.ReplayAll()
+        self.assertEqual(views.process_raw_data_batch(None, [], 'nova'), [])
+        self.mox.VerifyAll()
+
 
 class StacktachLifecycleTestCase(StacktachBaseTestCase):
     def setUp(self):
@@ -912,6 +1112,104 @@ class StacktachUsageParsingTestCase(StacktachBaseTestCase):
         self.mox.VerifyAll()
 
 
+    def test_process_exists_batch(self):
+        current_time = datetime.datetime.utcnow()
+        launch_time = current_time - datetime.timedelta(hours=23)
+        launch_decimal = utils.decimal_utc(launch_time)
+        delete_time = datetime.datetime.utcnow()
+        deleted_decimal = utils.decimal_utc(delete_time)
+        audit_beginning = current_time - datetime.timedelta(hours=20)
+        audit_beginning_decimal = utils.decimal_utc(audit_beginning)
+        audit_ending_decimal = utils.decimal_utc(current_time)
+        deleted = self._create_exists_notification(
+            audit_beginning, current_time, launch_time, delete_time)
+        running = self._create_exists_notification(
+            audit_beginning, current_time, launch_time, '')
+        running.instance = INSTANCE_ID_2
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        usage = self.mox.CreateMockAnything()
+        views.STACKDB.get_instance_usages(
+            [(INSTANCE_ID_1, launch_decimal),
+             (INSTANCE_ID_2, launch_decimal)])\
+            .AndReturn({(INSTANCE_ID_1, launch_decimal): usage})
+        delete = self.mox.CreateMockAnything()
+        views.STACKDB.get_instance_deletes([(INSTANCE_ID_1, launch_decimal)])\
+            .AndReturn({(INSTANCE_ID_1, launch_decimal): delete})
+        exists_values = {
+            'message_id': MESSAGE_ID_1,
+            'instance': INSTANCE_ID_1,
+            'launched_at': launch_decimal,
+            'audit_period_beginning': audit_beginning_decimal,
+            'audit_period_ending': audit_ending_decimal,
+            'instance_type_id': INSTANCE_TYPE_ID_1,
+            'instance_flavor_id': INSTANCE_FLAVOR_ID_1,
+            'tenant': TENANT_ID_1,
+            'rax_options': RAX_OPTIONS_1,
+            'os_architecture': OS_ARCH_1,
+            'os_version': OS_VERSION_1,
+            'os_distro': OS_DISTRO_1,
+            'bandwidth_public_out': BANDWIDTH_PUBLIC_OUTBOUND
+        }
+        deleted_values = dict(exists_values, raw=raw1, usage=usage,
+                              delete=delete, deleted_at=deleted_decimal)
+        running_values = dict(exists_values, raw=raw2,
+                              instance=INSTANCE_ID_2)
+        views.STACKDB.create_instance_exists_batch([deleted_values,
+                                                    running_values])
+        self.mox.ReplayAll()
+        views._process_exists_batch([(raw1, deleted), (raw2, running)])
+        self.mox.VerifyAll()
+
+    def test_post_process_rawdata_batch_saves_exists_together(self):
+        self.mox.StubOutWithMock(views, 'aggregate_lifecycle')
+        self.mox.StubOutWithMock(views, 'aggregate_usage')
+        self.mox.StubOutWithMock(views, '_process_exists_batch')
+        results = []
+        for event in ['compute.instance.exists', 'compute.instance.update',
+                      'compute.instance.exists']:
+            raw = self.mox.CreateMockAnything()
+            raw.instance = INSTANCE_ID_1
+            raw.event = event
+            results.append((raw, self.mox.CreateMockAnything()))
+        exists1, update, exists2 = results
+        views.aggregate_lifecycle(exists1[0])
+        views.aggregate_lifecycle(update[0])
+        views.aggregate_usage(*update)
+        views.aggregate_lifecycle(exists2[0])
+        views._process_exists_batch([exists1, exists2])
+        self.mox.ReplayAll()
+        views.post_process_rawdata_batch(results)
+        self.mox.VerifyAll()
+
+    def test_post_process_rawdata_batch_hands_failures_to_on_error(self):
+        self.mox.StubOutWithMock(views, 'aggregate_lifecycle')
+        self.mox.StubOutWithMock(views, 'aggregate_usage')
+        self.mox.StubOutWithMock(views, '_process_exists_batch')
+        results = []
+        for event in ['compute.instance.update', 'compute.instance.update',
+                      'compute.instance.exists', 'compute.instance.exists']:
+            raw = self.mox.CreateMockAnything()
+            raw.instance = INSTANCE_ID_1
+            raw.event = event
+            results.append((raw, self.mox.CreateMockAnything()))
+        update1, update2, exists1, exists2 = results
+        on_error = self.mox.CreateMockAnything()
+        lifecycle_error = Exception('lifecycle failed')
+        views.aggregate_lifecycle(update1[0]).AndRaise(lifecycle_error)
+        on_error(update1[0], update1[1], lifecycle_error)
+        views.aggregate_lifecycle(update2[0])
+        views.aggregate_usage(*update2)
+        views.aggregate_lifecycle(exists1[0])
+        views.aggregate_lifecycle(exists2[0])
+        exists_error = Exception('insert failed')
+        views._process_exists_batch([exists1, exists2]).AndRaise(exists_error)
+        on_error(exists1[0], exists1[1], exists_error)
+        on_error(exists2[0], exists2[1], exists_error)
+        self.mox.ReplayAll()
+        views.post_process_rawdata_batch(results, on_error=on_error)
+        self.mox.VerifyAll()
+
 class StacktachImageUsageParsingTestCase(StacktachBaseTestCase):
     def setUp(self):
         self.mox = mox.Mox()
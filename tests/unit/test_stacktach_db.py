@@ -18,6 +18,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import decimal
+
+from django.db import DatabaseError
+from django.db import IntegrityError
 import mox
 
 from stacktach import db
@@ -70,9 +74,8 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
         object = self.mox.CreateMockAnything()
-        results[0].AndReturn(object)
+        results[:2].AndReturn([object])
         self.mox.ReplayAll()
         returned = db._safe_get(Model, **filters)
         self.assertEqual(returned, object)
@@ -85,7 +88,7 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(0)
+        results[:2].AndReturn([])
         log = self.mox.CreateMockAnything()
         self.setup_mock_log()
         self.log.warn('No records found for Model get.')
@@ -101,11 +104,10 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(2)
+        object = self.mox.CreateMockAnything()
+        results[:2].AndReturn([object, self.mox.CreateMockAnything()])
         self.setup_mock_log()
         self.log.warn('Multiple records found for Model get.')
-        object = self.mox.CreateMockAnything()
-        results[0].AndReturn(object)
         self.mox.ReplayAll()
         returned = db._safe_get(Model, **filters)
         self.assertEqual(returned, object)
@@ -150,6 +152,155 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         self._test_db_create_func(models.InstanceExists,
                                   db.create_instance_exists)
 
+    def test_create_nova_rawdata_batch(self):
+        self.mox.StubOutWithMock(models, 'RawDataImageMeta',
+                                 use_mock_anything=True)
+        models.RawDataImageMeta.objects = self.mox.CreateMockAnything()
+        raw1 = self.mox.CreateMockAnything()
+        raw1.id = 1
+        raw2 = self.mox.CreateMockAnything()
+        raw2.id = 2
+        models.RawData(event='event1').AndReturn(raw1)
+        raw1.save()
+        meta1 = self.mox.CreateMockAnything()
+        models.RawDataImageMeta(raw_id=1, os_distro='distro1')\
+            .AndReturn(meta1)
+        models.RawData(event='event2').AndReturn(raw2)
+        raw2.save()
+        meta2 = self.mox.CreateMockAnything()
+        models.RawDataImageMeta(raw_id=2, os_distro='distro2')\
+            .AndReturn(meta2)
+        models.RawDataImageMeta.objects.bulk_create([meta1, meta2])
+        self.mox.ReplayAll()
+        rows = [{'event': 'event1', 'os_distro': 'distro1'},
+                {'event': 'event2', 'os_distro': 'distro2'}]
+        returned = db.create_nova_rawdata_batch(rows)
+        self.assertEqual(returned, [raw1, raw2])
+        self.mox.VerifyAll()
+
+    def test_create_generic_rawdata_batch(self):
+        self.mox.StubOutWithMock(models, 'GenericRawData',
+                                 use_mock_anything=True)
+        models.GenericRawData.objects = self.mox.CreateMockAnything()
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        models.GenericRawData(event='event1').AndReturn(raw1)
+        models.GenericRawData(event='event2').AndReturn(raw2)
+        models.GenericRawData.objects.bulk_create([raw1, raw2])
+        self.mox.ReplayAll()
+        returned = db.create_generic_rawdata_batch([{'event': 'event1'},
+                                                    {'event': 'event2'}])
+        self.assertEqual(returned, [raw1, raw2])
+        self.mox.VerifyAll()
+
+    def test_get_image_usages(self):
+        self.mox.stubs.Set(db, 'BULK_CHUNK_SIZE', 2)
+        self.mox.StubOutWithMock(models, 'ImageUsage',
+                                 use_mock_anything=True)
+        models.ImageUsage.objects = self.mox.CreateMockAnything()
+        models.ImageUsage.__name__ = 'ImageUsage'
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        usage1 = self.mox.CreateMockAnything()
+        usage1.uuid = 'uuid1'
+        older2 = self.mox.CreateMockAnything()
+        older2.uuid = 'uuid2'
+        newer2 = self.mox.CreateMockAnything()
+        newer2.uuid = 'uuid2'
+        first = self.mox.CreateMockAnything()
+        models.ImageUsage.objects.filter(
+            uuid__in=['uuid1', 'uuid2']).AndReturn(first)
+        first.order_by('id').AndReturn([usage1, older2, newer2])
+        second = self.mox.CreateMockAnything()
+        models.ImageUsage.objects.filter(uuid__in=['uuid3']).AndReturn(second)
+        second.order_by('id').AndReturn([])
+        stacklog.warn('Multiple records found for 1 ImageUsage gets.')
+        stacklog.warn('No records found for 1 of 3 ImageUsage gets.')
+        self.mox.ReplayAll()
+        returned = db.get_image_usages(['uuid3', 'uuid1', 'uuid2', 'uuid1'])
+        self.assertEqual(returned, {'uuid1': usage1, 'uuid2': older2})
+        self.mox.VerifyAll()
+
+    def test_get_image_deletes_without_uuids_is_no_queries(self):
+        self.mox.StubOutWithMock(models, 'ImageDeletes',
+                                 use_mock_anything=True)
+        models.ImageDeletes.objects = self.mox.CreateMockAnything()
+        self.mox.ReplayAll()
+        self.assertEqual(db.get_image_deletes([]), {})
+        self.mox.VerifyAll()
+
+    def test_create_image_exists_batch(self):
+        self.mox.stubs.Set(db, 'BULK_CHUNK_SIZE', 2)
+        self.mox.StubOutWithMock(models, 'ImageExists',
+                                 use_mock_anything=True)
+        models.ImageExists.objects = self.mox.CreateMockAnything()
+        exists = [self.mox.CreateMockAnything() for i in range(3)]
+        for i in range(3):
+            models.ImageExists(uuid='uuid%d' % i).AndReturn(exists[i])
+        models.ImageExists.objects.bulk_create(exists[:2])
+        models.ImageExists.objects.bulk_create(exists[2:])
+        self.mox.ReplayAll()
+        returned = db.create_image_exists_batch(
+            [{'uuid': 'uuid%d' % i} for i in range(3)])
+        self.assertEqual(returned, exists)
+        self.mox.VerifyAll()
+
+    def test_get_instance_usages(self):
+        self.mox.stubs.Set(db, 'BULK_CHUNK_SIZE', 1)
+        models.InstanceUsage.__name__ = 'InstanceUsage'
+        self.mox.StubOutWithMock(stacklog, 'warn')
+        launched_at = decimal.Decimal('1373000000.5')
+        earlier = self.mox.CreateMockAnything()
+        earlier.instance = 'instance1'
+        earlier.launched_at = launched_at - 100
+        usage1 = self.mox.CreateMockAnything()
+        usage1.instance = 'instance1'
+        usage1.launched_at = launched_at
+        unlaunched = self.mox.CreateMockAnything()
+        unlaunched.instance = 'instance1'
+        unlaunched.launched_at = None
+        older2 = self.mox.CreateMockAnything()
+        older2.instance = 'instance2'
+        older2.launched_at = launched_at + 1
+        newer2 = self.mox.CreateMockAnything()
+        newer2.instance = 'instance2'
+        newer2.launched_at = launched_at
+        first = self.mox.CreateMockAnything()
+        models.InstanceUsage.objects.filter(
+            instance__in=['instance1']).AndReturn(first)
+        first.order_by('id').AndReturn([earlier, usage1, unlaunched])
+        second = self.mox.CreateMockAnything()
+        models.InstanceUsage.objects.filter(
+            instance__in=['instance2']).AndReturn(second)
+        second.order_by('id').AndReturn([older2, newer2])
+        third = self.mox.CreateMockAnything()
+        models.InstanceUsage.objects.filter(
+            instance__in=['instance3']).AndReturn(third)
+        third.order_by('id').AndReturn([])
+        stacklog.warn('Multiple records found for 1 InstanceUsage gets.')
+        stacklog.warn('No records found for 1 of 3 InstanceUsage gets.')
+        self.mox.ReplayAll()
+        returned = db.get_instance_usages([('instance3', launched_at),
+                                           ('instance1', launched_at),
+                                           ('instance2', launched_at),
+                                           ('instance1', launched_at)])
+        self.assertEqual(returned, {('instance1', launched_at): usage1,
+                                    ('instance2', launched_at): older2})
+        self.mox.VerifyAll()
+
+    def test_create_instance_exists_batch(self):
+        self.mox.stubs.Set(db, 'BULK_CHUNK_SIZE', 2)
+        exists = [self.mox.CreateMockAnything() for i in range(3)]
+        for i in range(3):
+            models.InstanceExists(instance='instance%d' % i)\
+                .AndReturn(exists[i])
+        models.InstanceExists.objects.bulk_create(exists[:2])
+        models.InstanceExists.objects.bulk_create(exists[2:])
+        self.mox.ReplayAll()
+        returned = db.create_instance_exists_batch(
+            [{'instance': 'instance%d' % i} for i in range(3)])
+        self.assertEqual(returned, exists)
+        self.mox.VerifyAll()
+
     def _test_db_find_func(self, Model, func, select_related=True):
         params = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
@@ -195,9 +346,8 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         models.InstanceUsage.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
         usage = self.mox.CreateMockAnything()
-        results[0].AndReturn(usage)
+        results[:2].AndReturn([usage])
         self.mox.ReplayAll()
         returned = db.get_instance_usage(**filters)
         self.assertEqual(returned, usage)
@@ -207,9 +357,8 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         models.InstanceDeletes.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
         usage = self.mox.CreateMockAnything()
-        results[0].AndReturn(usage)
+        results[:2].AndReturn([usage])
         self.mox.ReplayAll()
         returned = db.get_instance_delete(**filters)
         self.assertEqual(returned, usage)
@@ -221,3 +370,22 @@ class StacktachDBTestCase(StacktachBaseTestCase):
         self.mox.ReplayAll()
         db.save(o)
         self.mox.VerifyAll()
+
+
+class DatabaseFailureTestCase(StacktachBaseTestCase):
+    def test_outage(self):
+        self.assertTrue(db.is_database_failure(
+            DatabaseError(2006, 'MySQL server has gone away')))
+        self.assertTrue(db.is_database_failure(
+            DatabaseError(1205, 'Lock wait timeout exceeded')))
+        self.assertTrue(db.is_database_failure(
+            DatabaseError('database is locked')))
+
+    def test_rejected(self):
+        self.assertFalse(db.is_database_failure(
+            DatabaseError(1406, "Data too long for column 'json'")))
+        self.assertFalse(db.is_database_failure(
+            DatabaseError('no such table: stacktach_rawdata')))
+        self.assertFalse(db.is_database_failure(
+            IntegrityError(1062, 'Duplicate entry')))
+        self.assertFalse(db.is_database_failure(ValueError('bad value')))
@@ -91,3 +91,38 @@ class StacktachUtilsTestCase(StacktachBaseTestCase):
         with self.assertRaises(Exception):
             stacktach_utils.str_time_to_unix("invalid date"),
             decimal.Decimal('1368618671')
+
+    def test_str_time_to_unix_microseconds(self):
+        self.assertEqual(
+            str(stacktach_utils.str_time_to_unix("2013-05-15 11:51:11.123450")),
+            '1368618671.12345')
+
+        self.assertEqual(
+            str(stacktach_utils.str_time_to_unix("2013-05-15T11:51:11.000001Z")),
+            '1368618671.000001')
+
+        self.assertEqual(
+            str(stacktach_utils.str_time_to_unix("2013-05-15T11:51:11.000000")),
+            '1368618671')
+
+    def test_str_time_to_unix_unpadded_fields(self):
+        self.assertEqual(
+            stacktach_utils.str_time_to_unix("2013-5-15 1:51:11"),
+            decimal.Decimal('1368582671'))
+
+    def test_str_time_to_unix_before_epoch(self):
+        self.assertEqual(
+            stacktach_utils.str_time_to_unix("1969-12-31 23:59:59.5"),
+            decimal.Decimal('-0.5'))
+
+    def test_str_time_to_unix_remembers_parsed_times(self):
+        when = "2013-05-15 00:00:00"
+        first = stacktach_utils.str_time_to_unix(when)
+        self.mox.StubOutWithMock(stacktach_utils, '_fast_parse')
+        self.mox.ReplayAll()
+        self.assertIs(stacktach_utils.str_time_to_unix(when), first)
+        self.mox.VerifyAll()
+
+    def test_str_time_to_unix_invalid_day(self):
+        with self.assertRaises(Exception):
+            stacktach_utils.str_time_to_unix("2013-02-30 11:51:11")
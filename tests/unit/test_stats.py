@@ -0,0 +1,122 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import os
+import shutil
+import tempfile
+
+import mox
+
+from stacktach import stats
+from stacktach import usage_cache
+from tests.unit import StacktachBaseTestCase
+
+
+class HistogramTestCase(StacktachBaseTestCase):
+    def test_percentiles(self):
+        histogram = stats.Histogram([1, 10, 100])
+        for value in [0.5] * 90 + [5] * 9 + [50]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(0.5), 1)
+        self.assertEqual(histogram.percentile(0.9), 1)
+        self.assertEqual(histogram.percentile(0.99), 10)
+        self.assertEqual(histogram.percentile(1), 50)
+        self.assertEqual(histogram.counts, [90, 9, 1, 0])
+
+    def test_overflow_reports_max(self):
+        histogram = stats.Histogram([1, 10])
+        histogram.add(500)
+        self.assertEqual(histogram.counts, [0, 0, 1])
+        self.assertEqual(histogram.percentile(0.5), 500)
+
+    def test_empty(self):
+        histogram = stats.Histogram([1, 10])
+        self.assertEqual(histogram.to_dict()['p99'], 0)
+        self.assertEqual(histogram.to_dict()['mean'], 0)
+
+
+class WorkerStatsTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'stats.json')
+        self.stats = stats.WorkerStats(self.path, 'test', 'nova',
+                                       interval=10)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        shutil.rmtree(self.dir)
+
+    def test_record_batch_as_equal_shares(self):
+        self.stats.record('raw_insert', 0.1, count=10)
+        histogram = self.stats.stages['raw_insert']
+        self.assertEqual(histogram.count, 10)
+        self.assertAlmostEqual(histogram.max, 10.0)
+
+    def test_message_records_lag(self):
+        self.mox.StubOutWithMock(stats.time, 'time')
+        stats.time.time().AndReturn(1000.0)
+        notification = self.mox.CreateMockAnything()
+        notification.when = 995
+        self.mox.ReplayAll()
+        self.stats.message(notification)
+        self.stats.message()
+        self.assertEqual(self.stats.messages, 2)
+        self.assertEqual(self.stats.lag.count, 1)
+        self.assertEqual(self.stats.lag.max, 5.0)
+        self.mox.VerifyAll()
+
+    def test_write(self):
+        with self.stats.timer('decode'):
+            pass
+        self.stats.message()
+        self.stats.count('duplicates')
+        self.stats.count('duplicates', 2)
+        self.stats.write()
+        with open(self.path) as f:
+            written = json.load(f)
+        self.assertEqual(written['name'], 'test')
+        self.assertEqual(written['counters'], {'duplicates': 3})
+        self.assertEqual(written['exchange'], 'nova')
+        self.assertEqual(written['messages'], 1)
+        self.assertEqual(written['stages_ms']['decode']['count'], 1)
+        self.assertEqual(os.listdir(self.dir), ['stats.json'])
+
+    def test_write_reports_caches(self):
+        cache = usage_cache.UsageCache(None, max_instances=10)
+        cache.instances['inst-1'] = None
+        cache.hits = 3
+        cache.misses = 1
+        self.stats.add_cache('usage', cache)
+        self.stats.write()
+        with open(self.path) as f:
+            written = json.load(f)
+        self.assertEqual(written['caches'],
+                         {'usage': {'size': 1, 'hits': 3, 'misses': 1,
+                                    'hit_ratio': 0.75}})
+
+    def test_maybe_write_waits_for_interval(self):
+        self.stats.maybe_write()
+        self.assertFalse(os.path.exists(self.path))
+        self.stats.last_write -= 10
+        self.stats.maybe_write()
+        self.assertTrue(os.path.exists(self.path))
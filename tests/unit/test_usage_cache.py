@@ -0,0 +1,215 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import decimal
+
+import mox
+
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from utils import REQUEST_ID_1
+from utils import REQUEST_ID_2
+from stacktach import usage_cache
+from stacktach import views
+from tests.unit import StacktachBaseTestCase
+
+LAUNCHED_AT = decimal.Decimal('1373000000.123456')
+LAUNCHED_RANGE = (LAUNCHED_AT, LAUNCHED_AT + 1)
+
+
+class _Row(object):
+    def __init__(self, id, request_id=None, launched_at=None,
+                 deleted_at=None):
+        self.id = id
+        self.request_id = request_id
+        self.launched_at = launched_at
+        self.deleted_at = deleted_at
+
+
+class UsageCacheTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.db = self.mox.CreateMockAnything()
+        self.cache = usage_cache.UsageCache(self.db, max_instances=2)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_get_or_create_usage_loads_once(self):
+        usage = _Row(1, request_id=REQUEST_ID_1)
+        self.db.get_or_create_instance_usage(
+            instance=INSTANCE_ID_1, request_id=REQUEST_ID_1)\
+            .AndReturn((usage, True))
+        self.mox.ReplayAll()
+        self.assertEqual(self.cache.get_or_create_instance_usage(
+            INSTANCE_ID_1, REQUEST_ID_1), (usage, True))
+        self.assertEqual(self.cache.get_or_create_instance_usage(
+            INSTANCE_ID_1, REQUEST_ID_1), (usage, False))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+        self.mox.VerifyAll()
+
+    def test_exists_finds_usage_launched_since_it_was_cached(self):
+        usage = _Row(1, request_id=REQUEST_ID_1)
+        self.db.get_or_create_instance_usage(
+            instance=INSTANCE_ID_1, request_id=REQUEST_ID_1)\
+            .AndReturn((usage, True))
+        self.mox.ReplayAll()
+        self.cache.get_or_create_instance_usage(INSTANCE_ID_1, REQUEST_ID_1)
+        # As the .end event would, before the exists comes in.
+        usage.launched_at = LAUNCHED_AT
+        self.assertEqual(self.cache.get_instance_usage(INSTANCE_ID_1,
+                                                       LAUNCHED_RANGE),
+                         usage)
+        self.mox.VerifyAll()
+
+    def test_get_usage_outside_range_goes_to_db(self):
+        cached = _Row(1, request_id=REQUEST_ID_1, launched_at=LAUNCHED_AT - 5)
+        loaded = _Row(2, request_id=REQUEST_ID_2, launched_at=LAUNCHED_AT)
+        self.db.get_or_create_instance_usage(
+            instance=INSTANCE_ID_1, request_id=REQUEST_ID_1)\
+            .AndReturn((cached, False))
+        self.db.get_instance_usage(instance=INSTANCE_ID_1,
+                                   launched_at__range=LAUNCHED_RANGE)\
+            .AndReturn(loaded)
+        self.mox.ReplayAll()
+        self.cache.get_or_create_instance_usage(INSTANCE_ID_1, REQUEST_ID_1)
+        self.assertEqual(self.cache.get_instance_usage(INSTANCE_ID_1,
+                                                       LAUNCHED_RANGE),
+                         loaded)
+        self.assertEqual(self.cache.get_or_create_instance_usage(
+            INSTANCE_ID_1, REQUEST_ID_2), (loaded, False))
+        self.mox.VerifyAll()
+
+    def test_missing_usage_is_not_cached(self):
+        self.db.get_instance_usage(instance=INSTANCE_ID_1,
+                                   launched_at__range=LAUNCHED_RANGE)\
+            .AndReturn(None)
+        self.db.get_instance_usage(instance=INSTANCE_ID_1,
+                                   launched_at__range=LAUNCHED_RANGE)\
+            .AndReturn(None)
+        self.mox.ReplayAll()
+        for i in range(2):
+            self.assertEqual(self.cache.get_instance_usage(INSTANCE_ID_1,
+                                                           LAUNCHED_RANGE),
+                             None)
+        self.assertEqual(self.cache.misses, 2)
+        self.mox.VerifyAll()
+
+    def test_delete_is_found_by_exists(self):
+        delete = _Row(1, launched_at=LAUNCHED_AT, deleted_at=LAUNCHED_AT + 60)
+        self.db.get_or_create_instance_delete(
+            instance=INSTANCE_ID_1, deleted_at=LAUNCHED_AT + 60,
+            launched_at=LAUNCHED_AT).AndReturn((delete, True))
+        self.mox.ReplayAll()
+        self.assertEqual(self.cache.get_or_create_instance_delete(
+            INSTANCE_ID_1, LAUNCHED_AT + 60, LAUNCHED_AT), (delete, True))
+        self.assertEqual(self.cache.get_or_create_instance_delete(
+            INSTANCE_ID_1, LAUNCHED_AT + 60, LAUNCHED_AT), (delete, False))
+        self.assertEqual(self.cache.get_instance_delete(INSTANCE_ID_1,
+                                                        LAUNCHED_RANGE),
+                         delete)
+        self.assertEqual(self.cache.hits, 2)
+        self.mox.VerifyAll()
+
+    def test_loaded_delete_is_remembered_once(self):
+        delete = _Row(1, launched_at=LAUNCHED_AT, deleted_at=LAUNCHED_AT + 60)
+        self.db.get_instance_delete(instance=INSTANCE_ID_1,
+                                    launched_at__range=LAUNCHED_RANGE)\
+            .AndReturn(delete)
+        self.mox.ReplayAll()
+        self.cache.get_instance_delete(INSTANCE_ID_1, LAUNCHED_RANGE)
+        self.cache.get_instance_delete(INSTANCE_ID_1, LAUNCHED_RANGE)
+        self.assertEqual(self.cache.instances[INSTANCE_ID_1].deletes,
+                         [delete])
+        self.mox.VerifyAll()
+
+    def test_evicts_least_recently_used(self):
+        for instance in [INSTANCE_ID_1, INSTANCE_ID_2, INSTANCE_ID_1,
+                         'instance3']:
+            self.db.get_instance_usage(instance=instance,
+                                       launched_at__range=LAUNCHED_RANGE)\
+                .AndReturn(None)
+        self.mox.ReplayAll()
+        for instance in [INSTANCE_ID_1, INSTANCE_ID_2, INSTANCE_ID_1,
+                         'instance3']:
+            self.cache.get_instance_usage(instance, LAUNCHED_RANGE)
+        self.assertEqual(self.cache.instances.keys(),
+                         [INSTANCE_ID_1, 'instance3'])
+        self.mox.VerifyAll()
+
+    def test_clear(self):
+        usage = _Row(1, request_id=REQUEST_ID_1)
+        self.db.get_or_create_instance_usage(
+            instance=INSTANCE_ID_1, request_id=REQUEST_ID_1)\
+            .AndReturn((usage, True))
+        self.db.get_or_create_instance_usage(
+            instance=INSTANCE_ID_1, request_id=REQUEST_ID_1)\
+            .AndReturn((usage, False))
+        self.mox.ReplayAll()
+        self.cache.get_or_create_instance_usage(INSTANCE_ID_1, REQUEST_ID_1)
+        self.cache.clear()
+        self.cache.get_or_create_instance_usage(INSTANCE_ID_1, REQUEST_ID_1)
+        self.mox.VerifyAll()
+
+
+class ViewsWithUsageCacheTestCase(StacktachBaseTestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.cache = self.mox.CreateMock(usage_cache.UsageCache)
+        views.USAGE_CACHE = self.cache
+        views.STACKDB = self.mox.CreateMockAnything()
+
+    def tearDown(self):
+        views.USAGE_CACHE = None
+        self.mox.UnsetStubs()
+
+    def test_process_exists_looks_up_through_cache(self):
+        raw = self.mox.CreateMockAnything()
+        notification = self.mox.CreateMockAnything()
+        notification.instance = INSTANCE_ID_1
+        notification.launched_at = '2013-07-05 04:53:20.123456'
+        notification.deleted_at = '2013-07-05 05:53:20.123456'
+        notification.audit_period_beginning = '2013-07-05 00:00:00'
+        notification.audit_period_ending = '2013-07-06 00:00:00'
+        values = {}
+        for attr in ['message_id', 'instance_type_id', 'instance_flavor_id',
+                     'tenant', 'rax_options', 'os_architecture',
+                     'os_version', 'os_distro', 'bandwidth_public_out']:
+            setattr(notification, attr, None)
+            values[attr] = None
+        usage = self.mox.CreateMockAnything()
+        delete = self.mox.CreateMockAnything()
+        launched_range = (LAUNCHED_AT, LAUNCHED_AT + 1)
+        self.cache.get_instance_usage(INSTANCE_ID_1, launched_range)\
+            .AndReturn(usage)
+        self.cache.get_instance_delete(INSTANCE_ID_1, launched_range)\
+            .AndReturn(delete)
+        exists = self.mox.CreateMockAnything()
+        values.update(
+            instance=INSTANCE_ID_1, raw=raw, usage=usage, delete=delete,
+            launched_at=LAUNCHED_AT, deleted_at=LAUNCHED_AT + 3600,
+            audit_period_beginning=decimal.Decimal('1372982400'),
+            audit_period_ending=decimal.Decimal('1373068800'))
+        views.STACKDB.create_instance_exists(**values).AndReturn(exists)
+        views.STACKDB.save(exists)
+        self.mox.ReplayAll()
+        views._process_exists(raw, notification)
+        self.mox.VerifyAll()
@@ -20,11 +20,14 @@
 
 import json
 
+from django.db import DatabaseError
 import kombu
 import mox
 
 from stacktach import db, stacklog
+from stacktach import lifecycle_engine
 from stacktach import views
+from worker import ingest_policy
 import worker.worker as worker
 from tests.unit import StacktachBaseTestCase
 
@@ -52,9 +55,9 @@ class ConsumerTestCase(StacktachBaseTestCase):
         created_queues = []
         created_callbacks = []
         created_consumers = []
-        def Consumer(queues=None, callbacks=None):
+        def Consumer(queues=None, on_message=None):
             created_queues.extend(queues)
-            created_callbacks.extend(callbacks)
+            created_callbacks.append(on_message)
             consumer = self.mox.CreateMockAnything()
             created_consumers.append(consumer)
             return consumer
@@ -78,7 +81,40 @@ class ConsumerTestCase(StacktachBaseTestCase):
         self.assertTrue(info_queue in created_queues)
         self.assertTrue(error_queue in created_queues)
         self.assertEqual(len(created_callbacks), 1)
-        self.assertTrue(consumer.on_nova in created_callbacks)
+        self.assertTrue(consumer.on_message in created_callbacks)
+        self.mox.VerifyAll()
+
+    def test_get_consumers_sets_prefetch(self):
+        prefetch = worker.flow_control.FixedPrefetch(200)
+        self.mox.StubOutWithMock(worker.Consumer, '_create_exchange')
+        self.mox.StubOutWithMock(worker.Consumer, '_create_queue')
+        consumer = worker.Consumer('test', None, None, True, {}, "nova",
+                                   self._test_topics(), prefetch=prefetch)
+        consumer.acker.outstanding[1] = self.mox.CreateMockAnything()
+        channel = self.mox.CreateMockAnything()
+        consumer._create_exchange('nova', 'topic')
+        consumer._create_queue('queue1', mox.IgnoreArg(), 'monitor.info')
+        consumer._create_queue('queue2', mox.IgnoreArg(), 'monitor.error')
+        channel.basic_qos(0, 200, True)
+        Consumer = self.mox.CreateMockAnything()
+        Consumer(queues=mox.IgnoreArg(), on_message=consumer.on_message)
+        self.mox.ReplayAll()
+        consumer.get_consumers(Consumer, channel)
+        self.assertEqual(consumer.channel, channel)
+        self.assertEqual(len(consumer.acker.outstanding), 0)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_updates_prefetch(self):
+        mock_logger = self._setup_mock_logger()
+        prefetch = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, "nova",
+                                   self._test_topics(), prefetch=prefetch)
+        consumer.channel = self.mox.CreateMockAnything()
+        prefetch.update().AndReturn(50)
+        mock_logger.info('test nova: prefetch now 50')
+        consumer.channel.basic_qos(0, 50, True)
+        self.mox.ReplayAll()
+        consumer.on_iteration()
         self.mox.VerifyAll()
 
     def test_create_exchange(self):
@@ -161,6 +197,879 @@ class ConsumerTestCase(StacktachBaseTestCase):
         self.mox.VerifyAll()
         worker.POST_PROCESS_METHODS["RawData"] = old_handler
 
+    def test_process_without_post_processing(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(),
+                                   post_process=False)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = ('monitor.info', {u'key': u'value'})
+        views.process_raw_data(deployment, args, json.dumps(args), 'nova') \
+            .AndReturn((raw, None))
+        message.ack()
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_process_duplicate_is_acked_without_post_processing(self):
+        deployment = self.mox.CreateMockAnything()
+        mock_notification = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics())
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = ('monitor.info', {u'key': u'value'})
+        views.process_raw_data(deployment, args, json.dumps(args), 'nova') \
+            .AndReturn((None, mock_notification))
+        message.ack()
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_on_message_routes_to_shard(self):
+        shards = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), shards=shards)
+        body = {'event_type': 'compute.instance.update',
+                'publisher_id': 'compute.cpu1-n01.example.com',
+                'payload': {'instance_id': 'inst-1'}}
+        message = self._create_message('monitor.info', body)
+        message.delivery_tag = 7
+        shards.put('inst-1', (7, 'monitor.info', json.dumps(body)))
+        self.mox.ReplayAll()
+        consumer.on_message(message)
+        self.assertEqual(consumer.in_flight, {7: message})
+        self.mox.VerifyAll()
+
+    def test_on_message_goes_through_lanes(self):
+        lanes = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), lanes=lanes)
+        self.mox.StubOutWithMock(consumer, 'on_nova')
+        body = {'event_type': 'compute.instance.create.end',
+                'publisher_id': 'compute.cpu1-n01.example.com',
+                'payload': {'instance_id': 'inst-1'}}
+        message = self._create_message('monitor.info', body)
+        message.delivery_tag = 7
+        held = self.mox.CreateMockAnything()
+        lanes.admit(message, 'compute.instance.create.end', 'inst-1')\
+            .AndReturn([held, message])
+        consumer.on_nova(None, held)
+        consumer.on_nova(None, message)
+        self.mox.ReplayAll()
+        consumer.on_message(message)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_acks_finished(self):
+        shards = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), shards=shards)
+        message1 = self.mox.CreateMockAnything()
+        message2 = self.mox.CreateMockAnything()
+        consumer.in_flight = {1: message1, 2: message2}
+        shards.finished().AndReturn([(2, None)])
+        message2.ack()
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.assertEqual(consumer.in_flight, {1: message1})
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_raises_on_shard_error(self):
+        shards = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), shards=shards)
+        message = self.mox.CreateMockAnything()
+        consumer.in_flight = {1: message}
+        shards.finished().AndReturn([(None, 'boom')])
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, consumer.on_iteration)
+        self.assertEqual(consumer.in_flight, {1: message})
+        self.mox.VerifyAll()
+
+    def test_shard_pool_keeps_instance_on_one_shard(self):
+        pool = worker.ShardPool(4, (), {})
+        pool.inboxes = [self.mox.CreateMockAnything() for i in range(4)]
+        shard = pool.inboxes[worker.zlib.crc32('inst-1') % 4]
+        shard.put('first')
+        shard.put('second')
+        pool.inboxes[0].put('no key 1')
+        pool.inboxes[1].put('no key 2')
+        self.mox.ReplayAll()
+        pool.put('inst-1', 'first')
+        pool.put(None, 'no key 1')
+        pool.put('inst-1', 'second')
+        pool.put(None, 'no key 2')
+        self.mox.VerifyAll()
+
+    def test_shard_pool_restarts_recycled_shard(self):
+        pool = worker.ShardPool(2, (), {})
+        pool.done = self.mox.CreateMockAnything()
+        running = self.mox.CreateMockAnything()
+        recycled = self.mox.CreateMockAnything()
+        recycled.exitcode = worker.RECYCLE_EXIT_CODE
+        replacement = self.mox.CreateMockAnything()
+        pool.processes = [running, recycled]
+        pool.done.get_nowait().AndRaise(worker.Queue.Empty())
+        running.is_alive().AndReturn(True)
+        recycled.is_alive().AndReturn(False)
+        self.mox.StubOutWithMock(worker, 'close_connection')
+        worker.close_connection()
+        self.mox.StubOutWithMock(pool, '_start_shard')
+        pool._start_shard(1).AndReturn(replacement)
+        self.mox.ReplayAll()
+        self.assertEqual(pool.finished(), [])
+        self.assertEqual(pool.processes, [running, replacement])
+        self.mox.VerifyAll()
+
+    def test_shard_pool_stop_returns_what_shards_finish(self):
+        pool = worker.ShardPool(1, (), {})
+        pool.done = self.mox.CreateMockAnything()
+        process = self.mox.CreateMockAnything()
+        inbox = self.mox.CreateMockAnything()
+        pool.processes = [process]
+        pool.inboxes = [inbox]
+        process.is_alive().AndReturn(True)
+        inbox.put(None)
+        process.is_alive().AndReturn(True)
+        pool.done.get_nowait().AndReturn((1, None))
+        pool.done.get_nowait().AndRaise(worker.Queue.Empty())
+        process.join(0.1)
+        process.is_alive().AndReturn(False)
+        pool.done.get_nowait().AndReturn((2, None))
+        pool.done.get_nowait().AndRaise(worker.Queue.Empty())
+        self.mox.ReplayAll()
+        self.assertEqual(pool.stop(), [(1, None), (2, None)])
+        self.assertEqual(pool.processes, [])
+        self.mox.VerifyAll()
+
+    def test_shard_pool_terminate_drops_queued_messages(self):
+        pool = worker.ShardPool(2, (), {})
+        running = self.mox.CreateMockAnything()
+        dead = self.mox.CreateMockAnything()
+        pool.processes = [running, dead]
+        pool.inboxes = [self.mox.CreateMockAnything(),
+                        self.mox.CreateMockAnything()]
+        running.is_alive().AndReturn(True)
+        running.terminate()
+        dead.is_alive().AndReturn(False)
+        running.join()
+        dead.join()
+        self.mox.ReplayAll()
+        pool.terminate()
+        self.assertEqual(pool.processes, [])
+        self.assertEqual(pool.inboxes, [])
+        self.mox.VerifyAll()
+
+    def test_shard_main_can_be_terminated(self):
+        for name in ('STATS', 'DEDUP', 'LIFECYCLE_ENGINE', 'USAGE_CACHE'):
+            self.mox.stubs.Set(views, name, getattr(views, name))
+        self.mox.StubOutWithMock(worker, '_create_stats')
+        worker._create_stats(None, 10, 'test', 'nova', shard=0)
+        consumer = self.mox.CreateMockAnything()
+        consumer.batch_timeout = 1
+        consumer.recycling = False
+        self.mox.StubOutWithMock(worker, 'Consumer')
+        worker.Consumer('test', None, None, True, {}, 'nova', [],
+                        lifecycle_engine=None).AndReturn(consumer)
+        self.mox.StubOutWithMock(worker.signal, 'signal')
+        worker.signal.signal(worker.signal.SIGTERM, worker.signal.SIG_DFL)
+        inbox = self.mox.CreateMockAnything()
+        inbox.get(timeout=1).AndReturn(None)
+        consumer._drain()
+        self.mox.ReplayAll()
+        worker._shard_main(('test', None, None, True, {}, 'nova', []), {},
+                           0, 5, None, 10, 0, inbox, None)
+        self.mox.VerifyAll()
+
+    def test_shard_main_drops_redelivered_duplicates(self):
+        for name in ('STATS', 'DEDUP', 'LIFECYCLE_ENGINE', 'USAGE_CACHE'):
+            self.mox.stubs.Set(views, name, getattr(views, name))
+        deduplicator = self.mox.CreateMockAnything()
+        deduplicator.transactional = False
+        self.mox.StubOutWithMock(worker, '_create_stats')
+        worker._create_stats(None, 10, 'test', 'nova', shard=0)
+        consumer = self.mox.CreateMockAnything()
+        consumer.batch_timeout = 1
+        consumer.recycling = False
+        self.mox.StubOutWithMock(worker, 'Consumer')
+        worker.Consumer('test', None, None, True, {}, 'nova', [],
+                        lifecycle_engine=None).AndReturn(consumer)
+        self.mox.StubOutWithMock(worker.signal, 'signal')
+        worker.signal.signal(worker.signal.SIGTERM, worker.signal.SIG_DFL)
+        inbox = self.mox.CreateMockAnything()
+        inbox.get(timeout=1).AndReturn(None)
+        consumer._drain()
+        self.mox.ReplayAll()
+        worker._shard_main(('test', None, None, True, {}, 'nova', []), {},
+                           0, 5, None, 10, 0, inbox, None,
+                           deduplicator=deduplicator)
+        self.assertIs(views.DEDUP, deduplicator)
+        self.assertIsNone(views._resolve_duplicate(
+            self.mox.CreateMockAnything()))
+        self.mox.VerifyAll()
+
+    def test_shard_main_reports_failed_messages(self):
+        for name in ('STATS', 'DEDUP', 'LIFECYCLE_ENGINE', 'USAGE_CACHE'):
+            self.mox.stubs.Set(views, name, getattr(views, name))
+        self.mox.StubOutWithMock(worker, '_create_stats')
+        worker._create_stats(None, 10, 'test', 'nova', shard=0)
+        consumer = self.mox.CreateMockAnything()
+        consumer.batch_timeout = 1
+        consumer.recycling = False
+        self.mox.StubOutWithMock(worker, 'Consumer')
+        worker.Consumer('test', None, None, True, {}, 'nova', [],
+                        lifecycle_engine=None).AndReturn(consumer)
+        self.mox.StubOutWithMock(worker.signal, 'signal')
+        worker.signal.signal(worker.signal.SIGTERM, worker.signal.SIG_DFL)
+        inbox = self.mox.CreateMockAnything()
+        done = self.mox.CreateMockAnything()
+        inbox.get(timeout=1).AndReturn((1, 'monitor.info', '{}'))
+        consumer.on_nova(None, mox.IsA(worker._ShardMessage))
+        consumer.on_iteration()
+        inbox.get(timeout=1).AndReturn((2, 'monitor.info', '{}'))
+        consumer.on_nova(None, mox.IsA(worker._ShardMessage))\
+            .AndRaise(Exception('boom'))
+        consumer._discard_held()
+        done.put((1, 'boom'))
+        done.put((2, 'boom'))
+        inbox.get(timeout=1).AndReturn((3, 'monitor.info', '{}'))
+        consumer.on_nova(None, mox.IsA(worker._ShardMessage))\
+            .WithSideEffects(lambda body, message: message.ack())
+        done.put((3, None))
+        consumer.on_iteration()
+        inbox.get(timeout=1).AndReturn(None)
+        consumer._drain()
+        self.mox.ReplayAll()
+        worker._shard_main(('test', None, None, True, {}, 'nova', []), {},
+                           0, 5, None, 10, 0, inbox, done)
+        self.mox.VerifyAll()
+
+    def test_shard_message_ack(self):
+        done = self.mox.CreateMockAnything()
+        done.put((5, None))
+        self.mox.ReplayAll()
+        message = worker._ShardMessage(5, 'monitor.info', '{}', done)
+        self.assertEqual(message.delivery_info,
+                         {'routing_key': 'monitor.info'})
+        message.ack()
+        self.mox.VerifyAll()
+
+    def test_process_records_stats(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        notif = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(),
+                                   post_process=False)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(views, 'STATS')
+        timer = self.mox.CreateMockAnything()
+        views.STATS.timer('decode').AndReturn(timer)
+        timer.__enter__()
+        timer.__exit__(None, None, None)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = ('monitor.info', {u'key': u'value'})
+        views.process_raw_data(deployment, args, json.dumps(args), 'nova') \
+            .AndReturn((raw, notif))
+        views.STATS.timer('ack').AndReturn(timer)
+        timer.__enter__()
+        message.ack()
+        timer.__exit__(None, None, None)
+        views.STATS.message(notif)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.mox.VerifyAll()
+
+    def test_create_stats(self):
+        self.assertTrue(isinstance(worker._create_stats(None, 10, 'n', 'nova'),
+                                   worker.stats.NullStats))
+        shard_stats = worker._create_stats('/tmp', 5, 'east', 'nova', shard=2)
+        self.assertEqual(shard_stats.path, '/tmp/east_nova_shard2.json')
+        self.assertEqual(shard_stats.interval, 5)
+
+    def _expect_logs(self, *levels):
+        self.mox.StubOutWithMock(stacklog, 'get_logger')
+        for level in levels:
+            mock_logger = self.mox.CreateMockAnything()
+            stacklog.get_logger('worker', is_parent=False)\
+                .AndReturn(mock_logger)
+            getattr(mock_logger, level)(mox.IgnoreArg())
+
+    def _spooling_consumer(self, deployment=None, **kwargs):
+        spool = self.mox.CreateMockAnything()
+        spool.directory = '/tmp/spool'
+        spool.empty().AndReturn(True)
+        self.mox.ReplayAll()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(), spool=spool,
+                                   **kwargs)
+        self.mox.VerifyAll()
+        self.mox.ResetAll()
+        return consumer, spool
+
+    def test_on_nova_spools_on_database_failure(self):
+        consumer, spool = self._spooling_consumer()
+        self._expect_logs('debug', 'warn')
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        message.acknowledged = False
+        self.mox.StubOutWithMock(consumer, '_process')
+        error = DatabaseError(2006, 'MySQL server has gone away')
+        consumer._process(message).AndRaise(error)
+        self.mox.StubOutWithMock(worker, 'close_connection')
+        worker.close_connection()
+        spool.append('monitor.info', message.body)
+        spool.needs_sync().AndReturn(True)
+        spool.sync()
+        message.ack()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message)
+        self.assertTrue(consumer.spooling)
+        self.assertEqual(consumer.spooled, [])
+        self.mox.VerifyAll()
+
+    def test_on_nova_raises_other_errors_with_spool(self):
+        consumer, spool = self._spooling_consumer()
+        self._expect_logs('debug')
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(consumer, '_process')
+        consumer._process(message).AndRaise(KeyError('event_type'))
+        self.mox.ReplayAll()
+        self.assertRaises(KeyError, consumer.on_nova, None, message)
+        self.assertFalse(consumer.spooling)
+        self.mox.VerifyAll()
+
+    def test_on_nova_spools_when_too_slow(self):
+        consumer, spool = self._spooling_consumer(spool_latency=0.5)
+        self._expect_logs('warn')
+        consumer.latency = 1.0
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(consumer, '_process')
+        consumer._process(message)
+        self.mox.StubOutWithMock(worker, 'close_connection')
+        worker.close_connection()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message)
+        self.assertTrue(consumer.spooling)
+        self.mox.VerifyAll()
+
+    def test_on_nova_while_spooling(self):
+        consumer, spool = self._spooling_consumer()
+        consumer.spooling = True
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        message.acknowledged = False
+        spool.append('monitor.info', message.body)
+        spool.needs_sync().AndReturn(False)
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message)
+        self.assertEqual(consumer.spooled, [message])
+        self.mox.VerifyAll()
+
+    def test_on_iteration_drains_spool(self):
+        consumer, spool = self._spooling_consumer()
+        self._expect_logs('info')
+        consumer.spooling = True
+        spool.sync()
+        spool.peek(100).AndReturn([('monitor.info', '{"a": 1}'),
+                                   ('monitor.info', '{"a": 2}')])
+        self.mox.StubOutWithMock(consumer, '_process')
+        consumer._process(mox.IsA(worker._SpooledMessage))
+        consumer._process(mox.IsA(worker._SpooledMessage))
+        spool.advance(2)
+        spool.peek(100).AndReturn([])
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.assertFalse(consumer.spooling)
+        self.mox.VerifyAll()
+
+    def test_drain_stops_on_database_failure(self):
+        consumer, spool = self._spooling_consumer()
+        consumer.spooling = True
+        spool.sync()
+        spool.peek(100).AndReturn([('monitor.info', '{"a": 1}'),
+                                   ('monitor.info', '{"a": 2}')])
+        self.mox.StubOutWithMock(consumer, '_process')
+        consumer._process(mox.IsA(worker._SpooledMessage))
+        consumer._process(mox.IsA(worker._SpooledMessage))\
+            .AndRaise(DatabaseError(2006, 'MySQL server has gone away'))
+        spool.advance(1)
+        self.mox.StubOutWithMock(worker, 'close_connection')
+        worker.close_connection()
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.assertTrue(consumer.spooling)
+        self.assertTrue(consumer.retry_at > 0)
+        self.mox.VerifyAll()
+
+    def test_decode_keeps_original_body(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics())
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': 'monitor.info'}
+        message.body = '{"b": [1, 2],   "a": "value"}'
+        self.mox.ReplayAll()
+        args, json_args = consumer._decode(message)
+        self.assertEqual(args, ('monitor.info', {'a': 'value', 'b': [1, 2]}))
+        self.assertEqual(json_args,
+                         '["monitor.info", {"b": [1, 2],   "a": "value"}]')
+        self.assertEqual(json.loads(json_args),
+                         ['monitor.info', {'a': 'value', 'b': [1, 2]}])
+        self.mox.VerifyAll()
+
+    def test_on_message(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics())
+        message = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(consumer, '_process')
+        consumer._process(message)
+        self.mox.ReplayAll()
+        consumer.on_message(message)
+        self.mox.VerifyAll()
+
+    def test_process_transactional(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        exchange = 'nova'
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   exchange, self._test_topics(),
+                                   transactional=True)
+        routing_key = 'monitor.info'
+        body_dict = {u'key': u'value'}
+        message = self._create_message(routing_key, body_dict)
+
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        mock_notification = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = (routing_key, body_dict)
+        views.process_raw_data(deployment, args, json.dumps(args), exchange) \
+            .AndReturn((raw, mock_notification))
+        raw.get_name().AndReturn('RawData')
+        mock_post_process_method = self.mox.CreateMockAnything()
+        mock_post_process_method(raw, mock_notification)
+        old_handler = worker.POST_PROCESS_METHODS["RawData"]
+        worker.POST_PROCESS_METHODS["RawData"] = mock_post_process_method
+        transaction.__exit__(None, None, None)
+        message.ack()
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        try:
+            consumer._process(message)
+        finally:
+            worker.POST_PROCESS_METHODS["RawData"] = old_handler
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_process_transactional_does_not_ack_on_failure(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        exchange = 'nova'
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   exchange, self._test_topics(),
+                                   transactional=True)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        mock_notification = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, mox.IgnoreArg(), mox.IgnoreArg(),
+                               exchange).AndReturn((raw, mock_notification))
+        raw.get_name().AndReturn('RawData')
+        mock_post_process_method = self.mox.CreateMockAnything()
+        error = Exception('lifecycle failed')
+        mock_post_process_method(raw, mock_notification).AndRaise(error)
+        old_handler = worker.POST_PROCESS_METHODS["RawData"]
+        worker.POST_PROCESS_METHODS["RawData"] = mock_post_process_method
+        transaction.__exit__(Exception, error, mox.IgnoreArg())
+        self.mox.ReplayAll()
+        try:
+            self.assertRaises(Exception, consumer._process, message)
+        finally:
+            worker.POST_PROCESS_METHODS["RawData"] = old_handler
+        self.assertEqual(consumer.processed, 0)
+        self.mox.VerifyAll()
+
+    def test_post_process_carries_on_past_failure(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'glance',
+                                   self._test_topics())
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        notif1 = self.mox.CreateMockAnything()
+        notif2 = self.mox.CreateMockAnything()
+        # Once to look for a batch method.
+        raw1.get_name().AndReturn('GlanceRawData')
+        raw1.get_name().AndReturn('GlanceRawData')
+        mock_post_process_method = self.mox.CreateMockAnything()
+        error = Exception('usage failed')
+        mock_post_process_method(raw1, notif1).AndRaise(error)
+        raw2.get_name().AndReturn('GlanceRawData')
+        mock_post_process_method(raw2, notif2)
+        old_handler = worker.POST_PROCESS_METHODS['GlanceRawData']
+        worker.POST_PROCESS_METHODS['GlanceRawData'] = \
+            mock_post_process_method
+        on_error = self.mox.CreateMockAnything()
+        on_error(raw1, notif1, error)
+        self.mox.ReplayAll()
+        try:
+            consumer._post_process([(raw1, notif1), (raw2, notif2)],
+                                   on_error=on_error)
+        finally:
+            worker.POST_PROCESS_METHODS['GlanceRawData'] = old_handler
+        self.mox.VerifyAll()
+
+    def test_post_process_failed_logs_and_counts(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics())
+        raw = self.mox.CreateMockAnything()
+        raw.id = 1
+        notif = self.mox.CreateMockAnything()
+        notif.message_id = 'message-1'
+        mock_logger = self._setup_mock_logger()
+        mock_logger.exception(mox.StrContains('message-1'))
+        self.mox.StubOutWithMock(views, 'STATS')
+        views.STATS.count('post_process_failures')
+        self.mox.ReplayAll()
+        consumer._post_process_failed(raw, notif, Exception('boom'))
+        self.mox.VerifyAll()
+
+    def _create_message(self, routing_key, body_dict):
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': routing_key}
+        message.body = json.dumps(body_dict)
+        return message
+
+    def test_on_nova_acks_dropped_updates(self):
+        policy = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=2,
+                                   update_policy=policy)
+        message1 = self.mox.CreateMockAnything()
+        message2 = self.mox.CreateMockAnything()
+        policy.admit(message2).AndReturn(([message2], [message1]))
+        message1.ack()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message2)
+        self.assertEqual(consumer.batch, [message2])
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_handles_expired_updates(self):
+        policy = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=2,
+                                   update_policy=policy)
+        message = self.mox.CreateMockAnything()
+        policy.expired().AndReturn([message])
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.assertEqual(consumer.batch, [message])
+        self.mox.VerifyAll()
+
+    def test_check_recycle_after_messages(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), recycle_after=10)
+        consumer.total_processed = 8
+        consumer.processed = 1
+        consumer._check_recycle()
+        self.assertFalse(consumer.should_stop)
+        consumer.processed = 2
+        consumer._check_recycle()
+        self.assertTrue(consumer.recycling)
+        self.assertTrue(consumer.should_stop)
+
+    def test_check_recycle_on_rss_growth(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(),
+                                   recycle_rss_growth=1000000)
+        consumer.pmi = self.mox.CreateMockAnything()
+        consumer.initial_rss = 5000000
+        consumer.pmi.rss = 5999999
+        consumer._check_recycle()
+        self.assertFalse(consumer.recycling)
+        consumer.pmi.rss = 6000000
+        consumer._check_recycle()
+        self.assertTrue(consumer.recycling)
+
+    def test_on_consume_end_drains(self):
+        policy = self.mox.CreateMockAnything()
+        engine = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=5,
+                                   update_policy=policy,
+                                   lifecycle_engine=engine)
+        mock_logger = self._setup_mock_logger()
+        mock_logger.info('test nova: drained 2 held messages, 0 from shards')
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        batched = self.mox.CreateMockAnything()
+        held = self.mox.CreateMockAnything()
+        consumer.batch = [batched]
+        policy.flush().AndReturn([held])
+        consumer._process_batch()
+        engine.flush()
+        self.mox.ReplayAll()
+        consumer.on_consume_end(None, None)
+        self.assertEqual(consumer.batch, [batched, held])
+        self.mox.VerifyAll()
+
+    def test_on_consume_end_acks_what_shards_finish(self):
+        shards = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), shards=shards)
+        message1 = self.mox.CreateMockAnything()
+        message2 = self.mox.CreateMockAnything()
+        consumer.in_flight = {1: message1, 2: message2}
+        shards.stop().AndReturn([(2, None), (None, 'boom')])
+        message2.ack()
+        mock_logger = self._setup_mock_logger()
+        mock_logger.error('test nova: shard failed while stopping: boom')
+        stacklog.get_logger('worker', is_parent=False).AndReturn(mock_logger)
+        mock_logger.info('test nova: drained 0 held messages, 1 from shards')
+        self.mox.ReplayAll()
+        consumer.on_consume_end(None, None)
+        self.assertEqual(consumer.in_flight, {1: message1})
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_on_nova_processes_exists_burst_together(self):
+        burst = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), exists_burst=burst)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        self.mox.StubOutWithMock(consumer, '_process')
+        exists1 = self.mox.CreateMockAnything()
+        exists2 = self.mox.CreateMockAnything()
+        end = self.mox.CreateMockAnything()
+        burst.admit(exists1).AndReturn(([], []))
+        burst.admit(exists2).AndReturn(([], []))
+        burst.admit(end).AndReturn(([exists1, exists2], [end]))
+        consumer._process_batch([exists1, exists2])
+        consumer._process(end)
+        self.mox.ReplayAll()
+        for message in [exists1, exists2, end]:
+            consumer.on_nova(None, message)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_processes_expired_exists(self):
+        burst = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), exists_burst=burst)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        message = self.mox.CreateMockAnything()
+        burst.expired().AndReturn([message])
+        consumer._process_batch([message])
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.mox.VerifyAll()
+
+    def test_on_nova_batches_until_batch_size(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=2)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        message1 = self.mox.CreateMockAnything()
+        message2 = self.mox.CreateMockAnything()
+        consumer._process_batch()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message1)
+        self.assertEqual(consumer.batch, [message1])
+        consumer.on_nova(None, message2)
+        self.assertEqual(consumer.batch, [message1, message2])
+        self.mox.VerifyAll()
+
+    def test_on_iteration_processes_expired_batch(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=10,
+                                   batch_timeout=0.5)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        consumer.batch = [self.mox.CreateMockAnything()]
+        self.mox.StubOutWithMock(worker.time, 'time')
+        worker.time.time().AndReturn(100.0)
+        consumer._process_batch()
+        self.mox.ReplayAll()
+        consumer.batch_started = 99.0
+        consumer.on_iteration()
+        self.mox.VerifyAll()
+
+    def test_on_iteration_leaves_fresh_batch(self):
+        consumer = worker.Consumer('test', None, None, True, {}, 'nova',
+                                   self._test_topics(), batch_size=10,
+                                   batch_timeout=0.5)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        consumer.batch = [self.mox.CreateMockAnything()]
+        self.mox.StubOutWithMock(worker.time, 'time')
+        worker.time.time().AndReturn(100.0)
+        self.mox.ReplayAll()
+        consumer.batch_started = 99.9
+        consumer.on_iteration()
+        self.mox.VerifyAll()
+
+    def test_process_batch(self):
+        deployment = self.mox.CreateMockAnything()
+        exchange = 'nova'
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   exchange, self._test_topics(),
+                                   batch_size=2)
+        body1 = {u'key': u'value1'}
+        body2 = {u'key': u'value2'}
+        message1 = self._create_message('monitor.info', body1)
+        message2 = self._create_message('monitor.error', body2)
+        consumer.batch = [message1, message2]
+
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        notif1 = self.mox.CreateMockAnything()
+        notif2 = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        args1 = ('monitor.info', body1)
+        args2 = ('monitor.error', body2)
+        views.process_raw_data_batch(
+            deployment, [(args1, json.dumps(args1)),
+                         (args2, json.dumps(args2))], exchange)\
+            .AndReturn([(raw1, notif1), (raw2, notif2)])
+        transaction.__exit__(None, None, None)
+        message1.ack()
+        message2.ack()
+        mock_post_process_method = self.mox.CreateMockAnything()
+        old_handler = worker.BATCH_POST_PROCESS_METHODS["RawData"]
+        worker.BATCH_POST_PROCESS_METHODS["RawData"] = \
+            mock_post_process_method
+        raw1.get_name().AndReturn('RawData')
+        mock_post_process_method([(raw1, notif1), (raw2, notif2)],
+                                 on_error=consumer._post_process_failed)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        try:
+            consumer._process_batch()
+        finally:
+            worker.BATCH_POST_PROCESS_METHODS["RawData"] = old_handler
+        self.assertEqual(consumer.processed, 2)
+        self.assertEqual(consumer.batch, [])
+        self.mox.VerifyAll()
+
+    def test_process_batch_acks_delivered_messages_together(self):
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(),
+                                   batch_size=2, post_process=False)
+        channel = self.mox.CreateMockAnything()
+        messages = []
+        for tag in (1, 2):
+            message = self._create_message('monitor.info', {u'key': tag})
+            message.delivery_tag = tag
+            message.channel = channel
+            consumer.acker.delivered(message)
+            messages.append(message)
+        consumer.batch = list(messages)
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, mox.IgnoreArg(), 'nova')\
+            .AndReturn([])
+        transaction.__exit__(None, None, None)
+        channel.basic_ack(2, multiple=True)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.processed, 2)
+        self.assertEqual(len(consumer.acker.outstanding), 0)
+        self.mox.VerifyAll()
+
+    def test_process_batch_does_not_ack_on_failure(self):
+        mock_logger = self._setup_mock_logger()
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(),
+                                   batch_size=2)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        consumer.batch = [message]
+
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        error = Exception('db went away')
+        views.process_raw_data_batch(deployment, mox.IgnoreArg(), 'nova')\
+            .AndRaise(error)
+        transaction.__exit__(Exception, error, mox.IgnoreArg())
+        mock_logger.debug('Problem: db went away\nFailed batch of 1 '
+                          'messages')
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, consumer._process_batch)
+        self.assertEqual(consumer.processed, 0)
+        self.mox.VerifyAll()
+
+    def test_rolled_back_batch_leaves_nothing_to_flush(self):
+        mock_logger = self._setup_mock_logger()
+        deployment = self.mox.CreateMockAnything()
+        engine_db = self.mox.CreateMockAnything()
+        engine = lifecycle_engine.LifecycleStateEngine(engine_db)
+        consumer = worker.Consumer('test', None, deployment, True, {},
+                                   'nova', self._test_topics(),
+                                   batch_size=2, transactional=True,
+                                   lifecycle_engine=engine)
+        consumer.batch = [self._create_message('monitor.info',
+                                               {u'key': u'value'})]
+        lifecycle = self.mox.CreateMockAnything()
+        lifecycle.instance = 'instance1'
+
+        def post_process(*args):
+            # As aggregate_lifecycle() would, before the batch fails.
+            engine.save_lifecycle(lifecycle)
+
+        self.mox.StubOutWithMock(db, 'commit_on_success')
+        transaction = self.mox.CreateMockAnything()
+        db.commit_on_success().AndReturn(transaction)
+        transaction.__enter__()
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        error = Exception('deadlock')
+        views.process_raw_data_batch(deployment, mox.IgnoreArg(), 'nova')\
+            .WithSideEffects(post_process).AndRaise(error)
+        transaction.__exit__(Exception, error, mox.IgnoreArg())
+        mock_logger.debug('Problem: deadlock\nFailed batch of 1 messages')
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, consumer._process_batch)
+        self.assertEqual(engine.flush(), 0)
+        self.mox.VerifyAll()
+
     def test_run(self):
         mock_logger = self._setup_mock_logger()
         self.mox.StubOutWithMock(mock_logger, 'info')
@@ -203,8 +1112,19 @@ class ConsumerTestCase(StacktachBaseTestCase):
         exchange = 'nova'
         consumer = worker.Consumer(config['name'], conn, deployment,
                                    config['durable_queue'], {}, exchange,
-                                   self._test_topics())
+                                   self._test_topics(), batch_size=1,
+                                   batch_timeout=1.0, transactional=False,
+                                   lifecycle_engine=None,
+                                   post_process=True, shards=None,
+                                   spool=None, spool_latency=None,
+                                   spool_retry_interval=5,
+                                   update_policy=mox.IsA(
+                                       ingest_policy.StoreAll),
+                                   prefetch=None, exists_burst=None,
+                                   lanes=None, recycle_after=0,
+                                   recycle_rss_growth=0)
         consumer.run()
+        consumer.recycling = False
         worker.continue_running().AndReturn(False)
         self.mox.ReplayAll()
         worker.run(config, deployment.id, exchange)
@@ -255,8 +1175,19 @@ class ConsumerTestCase(StacktachBaseTestCase):
         consumer = worker.Consumer(config['name'], conn, deployment,
                                    config['durable_queue'],
                                    config['queue_arguments'], exchange,
-                                   self._test_topics())
+                                   self._test_topics(), batch_size=1,
+                                   batch_timeout=1.0, transactional=False,
+                                   lifecycle_engine=None,
+                                   post_process=True, shards=None,
+                                   spool=None, spool_latency=None,
+                                   spool_retry_interval=5,
+                                   update_policy=mox.IsA(
+                                       ingest_policy.StoreAll),
+                                   prefetch=None, exists_burst=None,
+                                   lanes=None, recycle_after=0,
+                                   recycle_rss_growth=0)
         consumer.run()
+        consumer.recycling = False
         worker.continue_running().AndReturn(False)
         self.mox.ReplayAll()
         worker.run(config, deployment.id, exchange)
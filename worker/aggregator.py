@@ -0,0 +1,372 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# The second stage of the ingest pipeline. When a deployment has
+# aggregation_pipeline turned on its workers only save raw rows and ack,
+# and this process does the lifecycle and usage aggregation by walking the
+# new raw ids in order. Rows are sharded over a set of child processes by
+# instance (or image), so events for any one instance are still handled
+# in the order they were saved.
+
+import multiprocessing
+import os
+import Queue
+import signal
+import sys
+import time
+import zlib
+
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+from django.db import close_connection
+
+from stacktach import db
+from stacktach import lifecycle_engine
+from stacktach import models
+from stacktach import notification
+from stacktach import stacklog
+from stacktach import usage_cache
+from stacktach import views
+
+stacklog.set_default_logger_name('worker')
+shutdown_soon = False
+
+# exchange -> (raw model, field the work is sharded on)
+AGGREGATED_MODELS = {
+    'nova': (models.RawData, 'instance'),
+    'glance': (models.GlanceRawData, 'uuid'),
+}
+
+POST_PROCESS_METHODS = {
+    'RawData': views.post_process_rawdata,
+    'GlanceRawData': views.post_process_glancerawdata,
+}
+
+
+def _get_child_logger():
+    return stacklog.get_logger('worker', is_parent=False)
+
+
+class Checkpoint(object):
+    """The id of the last raw row that has been fully aggregated, kept in
+    a file so a restarted aggregator picks up where it left off."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return int(f.read().strip())
+
+    def write(self, last_id):
+        # Write then rename so a crash never leaves a half written file.
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            f.write('%d\n' % last_id)
+        os.rename(tmp, self.path)
+
+
+def aggregate(exchange, ids):
+    """Post processes the raws with the given ids, in id order."""
+    Model, key = AGGREGATED_MODELS[exchange]
+    for raw in db.get_raws_by_id(Model, ids):
+        try:
+            routing_key, body = json.loads(raw.json)
+            notif = notification.notification_factory(
+                body, raw.deployment, routing_key, raw.json, exchange)
+            POST_PROCESS_METHODS[raw.get_name()](raw, notif)
+        except Exception, e:
+            if db.is_database_failure(e):
+                # Let the shard die, so the chunk is never reported done
+                # and the checkpoint stays put until it's retried.
+                raise
+            # A bad row can't be retried into success, so log it and
+            # carry on rather than stall the whole pipeline behind it.
+            _get_child_logger().exception(
+                "Problem: %s\nFailed to aggregate %s %s" %
+                (e, raw.get_name(), raw.id))
+
+
+def _shard_main(exchange, inbox, done, lifecycle_cache_size,
+                lifecycle_flush_interval, usage_cache_size=0):
+    engine = None
+    if lifecycle_cache_size:
+        # Each shard owns its instances outright, so its cache can't go
+        # stale behind another process' back.
+        engine = lifecycle_engine.LifecycleStateEngine(
+            db, max_instances=lifecycle_cache_size,
+            flush_interval=lifecycle_flush_interval)
+    views.LIFECYCLE_ENGINE = engine
+    cache = None
+    if usage_cache_size:
+        cache = usage_cache.UsageCache(db, max_instances=usage_cache_size)
+    views.USAGE_CACHE = cache
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        chunk, ids = item
+        aggregate(exchange, ids)
+        if engine is not None:
+            # Everything needs to be on disk before the chunk is
+            # reported done and the checkpoint moves past it.
+            engine.flush()
+        done.put(chunk)
+    if engine is not None:
+        engine.flush()
+
+
+class Aggregator(object):
+    def __init__(self, name, deployment_id, exchange, checkpoint, workers=4,
+                 chunk_size=1000, poll_interval=1, gap_timeout=5,
+                 gap_retry=600, lifecycle_cache_size=0,
+                 lifecycle_flush_interval=5, usage_cache_size=0):
+        self.name = name
+        self.deployment_id = deployment_id
+        self.exchange = exchange
+        self.Model, self.key = AGGREGATED_MODELS[exchange]
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.gap_timeout = gap_timeout
+        self.gap_retry = gap_retry
+        self.lifecycle_cache_size = lifecycle_cache_size
+        self.lifecycle_flush_interval = lifecycle_flush_interval
+        self.usage_cache_size = usage_cache_size
+        self.shards = []
+        self.done = None
+        self.chunks = 0
+        self.last_id = None
+        # The id at the start of each hole we're waiting on -> when we
+        # first saw it.
+        self.gaps = {}
+        # Ids we've moved past without seeing -> when we gave up waiting,
+        # looked for again every gap_timeout seconds for gap_retry.
+        self.skipped = {}
+        self.rescanned = 0
+        self.skipped_ids = 0
+        self.late_rows = 0
+
+    def start(self):
+        self.last_id = self.checkpoint.read()
+        if self.last_id is None:
+            # Rows from before the pipeline was turned on were already
+            # aggregated by the worker.
+            self.last_id = db.get_last_raw_id(self.Model)
+            self.checkpoint.write(self.last_id)
+
+        # The shards must not share our db connection.
+        close_connection()
+        self.done = multiprocessing.Queue()
+        for i in range(self.workers):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_shard_main,
+                args=(self.exchange, inbox, self.done,
+                      self.lifecycle_cache_size,
+                      self.lifecycle_flush_interval, self.usage_cache_size))
+            process.daemon = True
+            process.start()
+            self.shards.append((process, inbox))
+
+    def stop(self):
+        for process, inbox in self.shards:
+            if process.is_alive():
+                inbox.put(None)
+        for process, inbox in self.shards:
+            process.join()
+        self.shards = []
+
+    def _shard_for(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(key) % len(self.shards)
+
+    def _ready(self, rows):
+        """Returns the leading run of rows that can be aggregated now.
+
+        Ids are handed out before the inserting transaction commits, so a
+        hole in the ids usually means a row that isn't visible yet and we
+        wait for it. Ids from rolled back inserts never show up, so a hole
+        is skipped once it's been there for gap_timeout seconds, and its
+        ids looked for again later in case the insert was just slow.
+        """
+        ready = []
+        previous = self.last_id
+        now = time.time()
+        for row in rows:
+            if row[0] != previous + 1:
+                first_seen = self.gaps.setdefault(previous + 1, now)
+                if now - first_seen < self.gap_timeout:
+                    break
+                del self.gaps[previous + 1]
+                self._skip(previous + 1, row[0] - 1, now)
+            ready.append(row)
+            previous = row[0]
+        return ready
+
+    def _skip(self, first, last, now):
+        for id in xrange(first, last + 1):
+            self.skipped[id] = now
+        self.skipped_ids += last - first + 1
+        _get_child_logger().warning(
+            "%s %s: skipping raw ids %d to %d after %ds, %d skipped so far" %
+            (self.name, self.exchange, first, last, self.gap_timeout,
+             self.skipped_ids))
+
+    def _late(self):
+        """Rows that have turned up since their ids were skipped. Ids
+        skipped more than gap_retry seconds ago are given up on, as
+        they're from inserts that were rolled back."""
+        now = time.time()
+        if not self.skipped or now - self.rescanned < self.gap_timeout:
+            return []
+        self.rescanned = now
+        rows = db.find_raw_keys_by_id(self.Model, self.key,
+                                      sorted(self.skipped))
+        for row in rows:
+            del self.skipped[row[0]]
+        expired = [id for id, skipped in self.skipped.iteritems()
+                   if now - skipped >= self.gap_retry]
+        for id in expired:
+            del self.skipped[id]
+        if rows:
+            self.late_rows += len(rows)
+            _get_child_logger().warning(
+                "%s %s: aggregating %d raws that turned up after their ids "
+                "were skipped, out of order: %s" %
+                (self.name, self.exchange, len(rows),
+                 ', '.join(str(row[0]) for row in rows)))
+        return rows
+
+    def _dispatch(self, rows):
+        by_shard = {}
+        for id, deployment_id, key in rows:
+            if deployment_id == self.deployment_id:
+                by_shard.setdefault(self._shard_for(key), []).append(id)
+
+        self.chunks += 1
+        for shard, ids in by_shard.iteritems():
+            self.shards[shard][1].put((self.chunks, ids))
+
+        pending = len(by_shard)
+        while pending:
+            try:
+                self.done.get(timeout=1)
+                pending -= 1
+            except Queue.Empty:
+                for process, inbox in self.shards:
+                    if not process.is_alive():
+                        raise Exception("Aggregator shard %s died" %
+                                        process.pid)
+
+    def process_chunk(self):
+        """Aggregates the next chunk of raws and moves the checkpoint past
+        them. Returns how many rows were consumed."""
+        late = self._late()
+        if late:
+            self._dispatch(late)
+        rows = db.find_raw_keys_after(self.Model, self.key, self.last_id,
+                                      self.chunk_size)
+        ready = self._ready(rows)
+        if ready:
+            self._dispatch(ready)
+            self.last_id = ready[-1][0]
+            self.checkpoint.write(self.last_id)
+            self.gaps = dict((start, seen) for start, seen
+                             in self.gaps.iteritems() if start > self.last_id)
+        return len(ready)
+
+    def run(self):
+        while continue_running():
+            # Keep going without sleeping while there's a backlog.
+            if self.process_chunk() < self.chunk_size:
+                time.sleep(self.poll_interval)
+
+    def _shutdown(self, signal, stackframe=False):
+        global shutdown_soon
+        shutdown_soon = True
+
+
+def continue_running():
+    return not shutdown_soon
+
+
+def exit_or_sleep(exit=False):
+    if exit:
+        sys.exit(1)
+    time.sleep(5)
+
+
+def run(deployment_config, deployment_id, exchange):
+    name = deployment_config['name']
+    exit_on_exception = deployment_config.get('exit_on_exception', False)
+    workers = deployment_config.get('aggregation_workers', 4)
+    chunk_size = deployment_config.get('aggregation_chunk_size', 1000)
+    poll_interval = deployment_config.get('aggregation_poll_interval', 1)
+    gap_timeout = deployment_config.get('aggregation_gap_timeout', 5)
+    gap_retry = deployment_config.get('aggregation_gap_retry', 600)
+    checkpoint_dir = deployment_config.get('aggregation_checkpoint_dir',
+                                           '/var/log/stacktach')
+    lifecycle_cache_size = deployment_config.get('lifecycle_cache_size', 0)
+    lifecycle_flush_interval = deployment_config.get(
+        'lifecycle_flush_interval', 5)
+    usage_cache_size = deployment_config.get('usage_cache_size', 0)
+    logger = _get_child_logger()
+
+    checkpoint = Checkpoint(os.path.join(
+        checkpoint_dir, '%s_%s.checkpoint' % (name, exchange)))
+
+    print "Starting aggregator for '%s %s'" % (name, exchange)
+    logger.info("%s: aggregating %s with %d workers" %
+                (name, exchange, workers))
+
+    while continue_running():
+        aggregator = Aggregator(
+            name, deployment_id, exchange, checkpoint, workers=workers,
+            chunk_size=chunk_size, poll_interval=poll_interval,
+            gap_timeout=gap_timeout, gap_retry=gap_retry,
+            lifecycle_cache_size=lifecycle_cache_size,
+            lifecycle_flush_interval=lifecycle_flush_interval,
+            usage_cache_size=usage_cache_size)
+        signal.signal(signal.SIGTERM, aggregator._shutdown)
+        try:
+            aggregator.start()
+            aggregator.run()
+        except Exception, e:
+            logger.error("!!!!Exception!!!!")
+            logger.exception("name=%s, exchange=%s, exception=%s. "
+                             "Restarting in 5s" % (name, exchange, e))
+            exit_or_sleep(exit_on_exception)
+        finally:
+            aggregator.stop()
+    close_connection()
+    logger.info("Aggregator exiting, %s checkpoint at id %s." %
+                (exchange, checkpoint.read()))
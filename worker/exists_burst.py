@@ -0,0 +1,98 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Every instance sends a compute.instance.exists right after the audit
+# period ends, so once a day they come in far faster than anything else.
+# Handled one at a time each costs two lookups and an insert, so during
+# the burst the worker gathers them up and saves them in batches instead
+# (see views.post_process_rawdata_batch()).
+
+from __future__ import absolute_import
+
+import collections
+import time
+
+from worker import peek
+
+EXISTS_EVENT = 'compute.instance.exists'
+# Looked for in the undecoded body, so most messages needn't be parsed.
+EXISTS_MARKER = '"%s"' % EXISTS_EVENT
+
+
+class ExistsBurst(object):
+    """Holds exists once more than threshold of them have arrived within
+    a second, until there are batch_size held or the first has waited
+    timeout seconds. Any other event for an instance with a held exists
+    has them all processed first, so each instance's events are still
+    handled in order. Outside a burst exists go straight through."""
+
+    def __init__(self, threshold=100, batch_size=500, timeout=1.0):
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # When the last threshold exists arrived.
+        self.recent = collections.deque(maxlen=threshold)
+        self.held = []
+        self.instances = set()
+        self.held_since = None
+
+    def _bursting(self, now):
+        self.recent.append(now)
+        return (len(self.recent) == self.recent.maxlen and
+                now - self.recent[0] < 1.0)
+
+    def _release(self):
+        held = self.held
+        self.held = []
+        self.instances = set()
+        self.held_since = None
+        return held
+
+    def admit(self, message):
+        """Returns (exists to process together, messages to process one
+        at a time), to be processed in that order."""
+        if EXISTS_MARKER not in str(message.body) and not self.held:
+            return [], [message]
+        instance = peek.instance(message)
+        if peek.event(message) != EXISTS_EVENT or not instance:
+            if instance in self.instances:
+                return self._release(), [message]
+            return [], [message]
+
+        now = time.time()
+        if not self._bursting(now) and not self.held:
+            return [], [message]
+        if not self.held:
+            self.held_since = now
+        self.held.append(message)
+        self.instances.add(instance)
+        if len(self.held) >= self.batch_size:
+            return self._release(), []
+        return [], []
+
+    def expired(self):
+        """Returns the held exists if they're due to be processed."""
+        if self.held and time.time() - self.held_since >= self.timeout:
+            return self._release()
+        return []
+
+    def flush(self):
+        """Returns every held exists, for when the worker is stopping."""
+        return self._release()
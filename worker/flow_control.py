@@ -0,0 +1,139 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Keeps the broker from costing a round trip per message. A run of messages
+# acked together goes out as one cumulative ack, and the channel's prefetch
+# window can be fixed or sized from how long messages take to process.
+
+import collections
+import math
+import time
+
+
+class Acker(object):
+    """Acks messages for one channel. Messages registered with delivered()
+    are tracked in delivery order, and when the oldest of them are acked
+    together one ack with multiple=True covers the lot. A multiple ack
+    covers every earlier delivery on the channel, so it's only used when
+    nothing older is still waiting, like an update the ingest policy is
+    holding. Everything else is acked on its own."""
+
+    def __init__(self):
+        # delivery tag -> message, oldest first
+        self.outstanding = collections.OrderedDict()
+
+    def reset(self):
+        # Delivery tags start over with every channel.
+        self.outstanding.clear()
+
+    def delivered(self, message):
+        self.outstanding[message.delivery_tag] = message
+
+    def ack(self, messages):
+        """Acks messages, returning how many acks were sent."""
+        if not self.outstanding:
+            for message in messages:
+                message.ack()
+            return len(messages)
+
+        done = set()
+        alone = []
+        for message in messages:
+            tag = getattr(message, 'delivery_tag', None)
+            if self.outstanding.get(tag) is message:
+                done.add(tag)
+            else:
+                alone.append(message)
+
+        run = []
+        for tag in self.outstanding:
+            if tag not in done:
+                break
+            run.append(tag)
+        sent = 0
+        if len(run) > 1:
+            last = self.outstanding[run[-1]]
+            last.channel.basic_ack(last.delivery_tag, multiple=True)
+            sent += 1
+            for tag in run:
+                # kombu only knows about acks it sent itself.
+                self.outstanding.pop(tag)._state = 'ACK'
+            done.difference_update(run)
+
+        alone.extend(self.outstanding.pop(tag) for tag in sorted(done))
+        for message in alone:
+            message.ack()
+        return sent + len(alone)
+
+
+class FixedPrefetch(object):
+    def __init__(self, count):
+        self.count = count
+
+    def record(self, seconds, messages=1):
+        pass
+
+    def update(self):
+        """The new prefetch count, or None to leave it as it is."""
+        return None
+
+
+class AdaptivePrefetch(FixedPrefetch):
+    """Sizes the prefetch window to hold about buffer seconds of work,
+    going by a moving average of how long each message takes. Fast
+    messages get a deep window so the next one is always here already,
+    slow ones a shallow window so messages aren't stuck waiting on us
+    while other workers are idle. Each change is a round trip to the
+    broker, so the count only changes every interval seconds and by at
+    least a fifth."""
+
+    def __init__(self, count, minimum=1, maximum=1000, buffer=1.0,
+                 interval=10):
+        super(AdaptivePrefetch, self).__init__(count)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buffer = buffer
+        self.interval = interval
+        self.latency = None
+        self.checked = time.time()
+
+    def record(self, seconds, messages=1):
+        per_message = seconds / messages
+        if self.latency is None:
+            self.latency = per_message
+        else:
+            self.latency = 0.9 * self.latency + 0.1 * per_message
+
+    def wanted(self):
+        if not self.latency:
+            return self.maximum
+        wanted = int(math.ceil(self.buffer / self.latency))
+        return min(self.maximum, max(self.minimum, wanted))
+
+    def update(self):
+        now = time.time()
+        if self.latency is None or now - self.checked < self.interval:
+            return None
+        self.checked = now
+        wanted = self.wanted()
+        if abs(wanted - self.count) < max(1, self.count / 5.0):
+            return None
+        self.count = wanted
+        return wanted
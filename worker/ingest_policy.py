@@ -0,0 +1,169 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Decides which compute.instance.update messages the worker bothers to
+# save. They're most of the nova traffic and nearly all of it is an
+# instance saying nothing has changed.
+#
+# Only updates from compute nodes are ever dropped. Updates from the api
+# nodes start the KPI clock (see views.start_kpi_tracking()) and every
+# other event, including everything in views.USAGE_PROCESS_MAPPING, is
+# always kept. Dropped messages are acked by the worker like any other.
+
+from __future__ import absolute_import
+
+import collections
+import time
+
+from stacktach import notification
+from worker import peek
+
+UPDATE_EVENT = 'compute.instance.update'
+# Looked for in the undecoded body, so most messages needn't be parsed.
+UPDATE_MARKER = '"%s"' % UPDATE_EVENT
+
+
+def _notification(message):
+    return notification.NovaNotification(
+        peek.body(message), None, message.delivery_info['routing_key'], None)
+
+
+def _droppable_update(message):
+    """The notification for message if it's an update that can be
+    dropped, otherwise None."""
+    if UPDATE_MARKER not in str(message.body):
+        return None
+    if peek.event(message) != UPDATE_EVENT:
+        return None
+    notif = _notification(message)
+    if not notif.instance:
+        return None
+    if 'api' in notif.service:
+        return None
+    return notif
+
+
+def _is_transition(notif):
+    return notif.state != notif.old_state or notif.task != notif.old_task
+
+
+class StoreAll(object):
+    def admit(self, message):
+        """Returns (messages to process now, messages to drop)."""
+        return [message], []
+
+    def expired(self):
+        """Returns held messages that are due to be processed."""
+        return []
+
+    def flush(self):
+        """Returns every held message, for when the worker is stopping."""
+        return []
+
+
+class Sampled(StoreAll):
+    """Keeps one in every rate updates, along with every update where
+    the instance's state or task changed, so the lifecycle still sees
+    each transition."""
+
+    def __init__(self, rate=10):
+        self.rate = rate
+        self.seen = 0
+
+    def admit(self, message):
+        notif = _droppable_update(message)
+        if notif is None or _is_transition(notif):
+            return [message], []
+        keep = self.seen % self.rate == 0
+        self.seen += 1
+        if keep:
+            return [message], []
+        return [], [message]
+
+
+class Coalesce(StoreAll):
+    """Holds the latest update for each instance for up to window seconds.
+    A newer update for the instance replaces the held one, which is
+    dropped. Any other event for the instance has the held update
+    processed first, so the lifecycle sees everything in order. Held
+    updates stay unacked, so no more than max_held are held at once and
+    the longest held goes ahead to make room."""
+
+    def __init__(self, window=60, max_held=1000):
+        self.window = window
+        self.max_held = max_held
+        # instance -> (message, when it was first held), in the order they
+        # were first held, so the ones due are always at the front.
+        self.held = collections.OrderedDict()
+
+    def admit(self, message):
+        notif = _droppable_update(message)
+        if notif is not None:
+            held = self.held.get(notif.instance)
+            if held is None:
+                self.held[notif.instance] = (message, time.time())
+                if len(self.held) > self.max_held:
+                    return [self.held.popitem(last=False)[1][0]], []
+                return [], []
+            # Keep the original time, and with it the instance's place in
+            # line, so a steady stream of updates can't hold an instance
+            # off forever.
+            self.held[notif.instance] = (message, held[1])
+            return [], [held[0]]
+
+        if not self.held:
+            return [message], []
+        held = self.held.pop(peek.instance(message), None)
+        if held is None:
+            return [message], []
+        return [held[0], message], []
+
+    def expired(self):
+        cutoff = time.time() - self.window
+        ready = []
+        while self.held:
+            instance, (message, since) = next(self.held.iteritems())
+            if since > cutoff:
+                break
+            del self.held[instance]
+            ready.append(message)
+        return ready
+
+    def flush(self):
+        ready = [message for message, since in self.held.itervalues()]
+        self.held.clear()
+        return ready
+
+
+POLICIES = {
+    'store-all': StoreAll,
+    'sampled': Sampled,
+    'coalesce': Coalesce,
+}
+
+
+def create(name, sample_rate=10, coalesce_window=60, coalesce_max=1000):
+    if name == 'sampled':
+        return Sampled(rate=sample_rate)
+    if name == 'coalesce':
+        return Coalesce(window=coalesce_window, max_held=coalesce_max)
+    if name not in POLICIES:
+        raise ValueError("Unknown update_policy '%s'" % name)
+    return StoreAll()
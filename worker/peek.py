@@ -0,0 +1,71 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# A quick look at a message before it's processed, for the parts of the
+# worker that decide what to do with it by its event and instance. The body
+# is decoded the first time anything asks and kept on the message, so it is
+# only ever decoded once however many of them look.
+
+from __future__ import absolute_import
+
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+from stacktach import notification
+
+
+def body(message):
+    """The decoded body of message."""
+    # Looked up in the instance dict so a stand-in message that makes up
+    # attributes on demand can't fool us.
+    decoded = vars(message).get('decoded_body')
+    if decoded is None:
+        decoded = json.loads(str(message.body))
+        message.decoded_body = decoded
+    return decoded
+
+
+def event(message):
+    return body(message).get('event_type')
+
+
+def _payload(message):
+    payload = body(message).get('payload', {})
+    if not isinstance(payload, dict):
+        return {}
+    return payload
+
+
+def instance(message):
+    """The instance a nova message is about, or None."""
+    return notification.find_instance(_payload(message))
+
+
+def key(message, exchange):
+    """What has to be handled in order with message: the image for
+    glance, the instance for everything else."""
+    if exchange == 'glance':
+        return _payload(message).get('id')
+    return instance(message)
@@ -0,0 +1,184 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Every event on an exchange comes in on the same queue, so a storm of
+# compute.instance.update holds up the events billing depends on. The
+# worker can't ask rabbit for them by event type, but it can read ahead
+# and pick what to process next out of the messages it's been sent.
+
+from __future__ import absolute_import
+
+import collections
+import time
+
+from stacktach import views
+
+UPDATE_EVENT = 'compute.instance.update'
+
+DEFAULT_LANES = [
+    {'name': 'usage', 'events': sorted(views.USAGE_PROCESS_MAPPING)},
+    {'name': 'default'},
+    {'name': 'updates', 'events': [UPDATE_EVENT]},
+]
+
+
+class _Entry(object):
+    def __init__(self, message, key, lane, when):
+        self.message = message
+        self.key = key
+        self.lane = lane
+        self.when = when
+        self.done = False
+
+
+class _Lane(object):
+    """Messages for some event types or routing keys, taken no faster
+    than budget a second while other lanes have messages waiting. A lane
+    with neither takes everything the others don't."""
+
+    def __init__(self, name, events=None, routing_keys=None, budget=0):
+        self.name = name
+        self.events = set(events or [])
+        self.routing_keys = set(routing_keys or [])
+        self.budget = budget
+        self.tokens = budget
+        self.refilled = time.time()
+        self.entries = collections.deque()
+
+    def catch_all(self):
+        return not self.events and not self.routing_keys
+
+    def matches(self, event, routing_key):
+        return event in self.events or routing_key in self.routing_keys
+
+    def head(self):
+        # Entries taken early, to keep an instance in order, are left
+        # where they are until they get to the front.
+        while self.entries and self.entries[0].done:
+            self.entries.popleft()
+        if self.entries:
+            return self.entries[0]
+        return None
+
+    def has_budget(self, now):
+        if not self.budget:
+            return True
+        self.tokens = min(self.budget,
+                          self.tokens + (now - self.refilled) * self.budget)
+        self.refilled = now
+        return self.tokens >= 1
+
+    def spend(self):
+        if self.budget:
+            self.tokens -= 1
+
+
+class PriorityLanes(object):
+    """Holds up to depth messages and hands them over highest lane first,
+    so a usage event near the back of what rabbit has sent us doesn't
+    wait for every update ahead of it. Messages with the same key (the
+    instance, or the image for glance) still come out in the order they
+    arrived, with any earlier ones taken along ahead of the one picked.
+    Everything held is handed over once the oldest has waited wait
+    seconds, which is what happens whenever the queue goes quiet."""
+
+    def __init__(self, lanes=DEFAULT_LANES, depth=100, wait=0.1):
+        self.lanes = [_Lane(**lane) for lane in lanes]
+        if not [lane for lane in self.lanes if lane.catch_all()]:
+            self.lanes.append(_Lane('default'))
+        self.depth = depth
+        self.wait = wait
+        self.held = 0
+        # key -> entries held for it, oldest first
+        self.keys = {}
+
+    def _lane(self, event, routing_key):
+        for lane in self.lanes:
+            if lane.matches(event, routing_key) or lane.catch_all():
+                return lane
+
+    def admit(self, message, event, key):
+        """Holds message, returning the messages to process now."""
+        routing_key = message.delivery_info['routing_key']
+        lane = self._lane(event, routing_key)
+        entry = _Entry(message, key, lane, time.time())
+        lane.entries.append(entry)
+        if key is not None:
+            self.keys.setdefault(key, []).append(entry)
+        self.held += 1
+
+        ready = []
+        while self.held > self.depth:
+            ready.extend(self._next(entry.when))
+        return ready
+
+    def expired(self):
+        """Returns everything held if anything has waited too long."""
+        now = time.time()
+        heads = [lane.head() for lane in self.lanes]
+        oldest = min([head.when for head in heads if head is not None] or
+                     [now])
+        if now - oldest >= self.wait:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Returns everything held, highest lane first."""
+        now = time.time()
+        ready = []
+        while self.held:
+            ready.extend(self._next(now))
+        return ready
+
+    def _next(self, now):
+        waiting = [lane for lane in self.lanes if lane.head() is not None]
+        chosen = waiting[0]
+        for lane in waiting:
+            if lane.has_budget(now):
+                chosen = lane
+                break
+        entry = chosen.entries.popleft()
+        taken = [entry]
+        if entry.key is not None:
+            held = self.keys[entry.key]
+            index = held.index(entry)
+            taken = held[:index + 1]
+            if index + 1 == len(held):
+                del self.keys[entry.key]
+            else:
+                del held[:index + 1]
+        for entry in taken:
+            entry.done = True
+            entry.lane.spend()
+        self.held -= len(taken)
+        return [entry.message for entry in taken]
+
+
+def lanes_for(setting, exchange):
+    """The lanes for exchange from the priority_lanes setting, which can
+    be true for the DEFAULT_LANES on nova, a list of lanes, or a map from
+    exchange to either. None if there aren't any."""
+    if isinstance(setting, dict):
+        setting = setting.get(exchange)
+    if setting is True:
+        if exchange != 'nova':
+            return None
+        return DEFAULT_LANES
+    return setting or None
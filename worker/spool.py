@@ -0,0 +1,194 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# A local, append only spool of message bodies for the worker to fall back
+# on while the database is down or too slow to keep up. Messages are acked
+# once they're safely on disk, so they stop piling up in RabbitMQ, and are
+# replayed in order once the database recovers.
+#
+# The spool is a directory of numbered segment files. Each record is a
+# header of crc32, routing key length and body length followed by the
+# routing key and body. A record with a short read or a bad crc can only
+# be the tail of a write cut off by a crash, so it marks the end of that
+# segment. The read position is kept in an 'offset' file.
+
+import os
+import struct
+import time
+import zlib
+
+HEADER = struct.Struct('>III')
+SEGMENT_SUFFIX = '.seg'
+
+
+def _segment_name(seq):
+    return '%012d%s' % (seq, SEGMENT_SUFFIX)
+
+
+class Spool(object):
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 sync_records=100, sync_interval=0.2):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        # fsync is the expensive part, so records are synced in groups:
+        # once sync_records are waiting or the oldest has waited
+        # sync_interval seconds.
+        self.sync_records = sync_records
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        self.first_unsynced = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        segments = self._segments()
+        self.read_seq, self.read_offset = self._read_offset(segments)
+        # Never append to a segment left over from before, its tail may
+        # be torn.
+        self.write_seq = (segments[-1] + 1) if segments else self.read_seq
+        self.writer = None
+        self._open_writer()
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_offset(self, segments):
+        path = self._path('offset')
+        if os.path.exists(path):
+            with open(path) as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        if segments:
+            return segments[0], 0
+        return 0, 0
+
+    def _write_offset(self):
+        # Synced before it's renamed into place, and the rename synced
+        # after, so a crash leaves either the old offset or the new one.
+        tmp = self._path('offset.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % (self.read_seq, self.read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path('offset'))
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _open_writer(self):
+        self.writer = open(self._path(_segment_name(self.write_seq)), 'ab')
+
+    def append(self, routing_key, body):
+        if self.writer.tell() >= self.segment_bytes:
+            self.sync()
+            self.writer.close()
+            self.write_seq += 1
+            self._open_writer()
+        crc = zlib.crc32(routing_key)
+        crc = zlib.crc32(body, crc) & 0xffffffff
+        self.writer.write(HEADER.pack(crc, len(routing_key), len(body)))
+        self.writer.write(routing_key)
+        self.writer.write(body)
+        if not self.unsynced:
+            self.first_unsynced = time.time()
+        self.unsynced += 1
+
+    def needs_sync(self):
+        return self.unsynced and (
+            self.unsynced >= self.sync_records or
+            time.time() - self.first_unsynced >= self.sync_interval)
+
+    def sync(self):
+        """Makes everything appended so far durable."""
+        if self.unsynced:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.unsynced = 0
+            self.first_unsynced = None
+
+    def _read_records(self, seq, offset, limit):
+        records = []
+        path = self._path(_segment_name(seq))
+        if not os.path.exists(path):
+            return records, offset
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while len(records) < limit:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                crc, key_length, body_length = HEADER.unpack(header)
+                data = f.read(key_length + body_length)
+                if len(data) < key_length + body_length or \
+                        zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                records.append((data[:key_length], data[key_length:]))
+                offset += HEADER.size + key_length + body_length
+        return records, offset
+
+    def peek(self, limit):
+        """Returns up to limit (routing_key, body) pairs from the read
+        position, oldest first, without moving past them."""
+        self.writer.flush()
+        records = []
+        seq, offset = self.read_seq, self.read_offset
+        while len(records) < limit:
+            found, offset = self._read_records(seq, offset,
+                                               limit - len(records))
+            records.extend(found)
+            if len(records) < limit:
+                if seq >= self.write_seq:
+                    break
+                seq, offset = seq + 1, 0
+        return records
+
+    def advance(self, count):
+        """Moves the read position past count records and removes the
+        segments that have been fully read."""
+        self.writer.flush()
+        while count:
+            found, offset = self._read_records(self.read_seq,
+                                               self.read_offset, count)
+            self.read_offset = offset
+            count -= len(found)
+            if count or not found:
+                if self.read_seq >= self.write_seq:
+                    break
+                self._remove(self.read_seq)
+                self.read_seq, self.read_offset = self.read_seq + 1, 0
+        self._write_offset()
+
+    def _remove(self, seq):
+        path = self._path(_segment_name(seq))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def empty(self):
+        return not self.peek(1)
+
+    def close(self):
+        self.sync()
+        self.writer.close()
@@ -1,6 +1,7 @@
 import os
 import signal
 import sys
+import time
 
 from multiprocessing import Process
 
@@ -13,10 +14,16 @@ from stacktach import db, stacklog
 from django.db import close_connection
 
 import worker.worker as worker
+from worker import aggregator
 from worker import config
 
 processes = []
+# What each of processes was started with, so it can be started again.
+process_specs = []
 log_listener = None
+# How long the workers get to finish what they're holding when stopped,
+# the longest of any deployment's drain_timeout.
+drain_timeout = 0
 stacklog.set_default_logger_name('worker')
 
 
@@ -24,13 +31,55 @@ def _get_parent_logger():
     return stacklog.get_logger('worker', is_parent=True)
 
 
-def kill_time(signal, frame):
+def _run_child(target, args):
+    # A child started after kill_time was installed would inherit it, and
+    # run it on a Ctrl-C to the process group. Stopping is up to us, and
+    # the workers install their own SIGTERM handler.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    target(*args)
+
+
+def _spawn(target, args, daemon):
+    process = Process(target=_run_child, args=(target, args))
+    process.daemon = daemon
+    process.start()
+    return process
+
+
+def start_process(target, args, daemon):
+    processes.append(_spawn(target, args, daemon))
+    process_specs.append((target, args, daemon))
+
+
+def restart_recycled():
+    """Starts a new process in place of each one that exited to be
+    recycled. Anything else that exits is left for the operator."""
+    for index, process in enumerate(processes):
+        if process.exitcode != worker.RECYCLE_EXIT_CODE:
+            continue
+        target, args, daemon = process_specs[index]
+        _get_parent_logger().info("Restarting recycled worker %s" %
+                                  process.pid)
+        processes[index] = _spawn(target, args, daemon)
+
+
+def kill_time(signum, frame):
     print "dying ..."
     for process in processes:
+        # SIGTERM, which has the workers stop consuming and process and ack
+        # whatever they're holding before they exit.
         process.terminate()
     print "rose"
+    deadline = time.time() + drain_timeout
     for process in processes:
-        process.join()
+        process.join(max(0, deadline - time.time()))
+        if process.is_alive():
+            _get_parent_logger().warn("Worker %s still draining after %ds, "
+                                      "killing it" %
+                                      (process.pid, drain_timeout))
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
     log_listener.end()
     print "bud"
     sys.exit(0)
@@ -41,6 +90,8 @@ if __name__ == '__main__':
     log_listener.start()
     for deployment in config.deployments():
         if deployment.get('enabled', True):
+            drain_timeout = max(drain_timeout,
+                                deployment.get('drain_timeout', 60))
             db_deployment, new = db.get_or_create_deployment(deployment['name'])
             # NOTE (apmelton)
             # Close the connection before spinning up the child process,
@@ -48,12 +99,18 @@ if __name__ == '__main__':
             # the parent process opened up to get/create the deployment.
             close_connection()
             for exchange in deployment.get('topics').keys():
-                process = Process(target=worker.run, args=(deployment,
-                                                           db_deployment.id,
-                                                           exchange,))
-                process.daemon = True
-                process.start()
-                processes.append(process)
+                # Daemonic processes can't start children of their own.
+                start_process(worker.run,
+                              (deployment, db_deployment.id, exchange),
+                              deployment.get('worker_processes', 1) == 1)
+                if (deployment.get('aggregation_pipeline', False) and
+                        exchange in aggregator.AGGREGATED_MODELS):
+                    # The aggregator has children of its own too.
+                    start_process(aggregator.run,
+                                  (deployment, db_deployment.id, exchange),
+                                  False)
     signal.signal(signal.SIGINT, kill_time)
     signal.signal(signal.SIGTERM, kill_time)
-    signal.pause()
+    while True:
+        time.sleep(1)
+        restart_recycled()
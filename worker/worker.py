@@ -16,10 +16,16 @@
 # This is the worker you run in your OpenStack environment. You need
 # to set TENANT_ID and URL to point to your StackTach web server.
 
+from __future__ import absolute_import
+
 import datetime
+import multiprocessing
+import os
+import Queue
 import sys
 import time
 import signal
+import zlib
 
 import kombu
 import kombu.mixins
@@ -33,15 +39,30 @@ except ImportError:
     except ImportError:
         import json
 
+from django.db import close_connection
 from pympler.process import ProcessMemoryInfo
 
 from stacktach import db
+from stacktach import dedup
+from stacktach import fields
+from stacktach import lifecycle_engine
 from stacktach import message_service
 from stacktach import stacklog
+from stacktach import stats
+from stacktach import usage_cache
 from stacktach import views
+from worker import exists_burst
+from worker import flow_control
+from worker import ingest_policy
+from worker import peek
+from worker import priority
+from worker import spool as disk_spool
 
 stacklog.set_default_logger_name('worker')
 shutdown_soon = False
+# What a worker exits with when it has asked to be replaced, which
+# start_workers.py (or the ShardPool, for a shard) does straight away.
+RECYCLE_EXIT_CODE = 75
 
 
 def _get_child_logger():
@@ -50,7 +71,12 @@ def _get_child_logger():
 
 class Consumer(kombu.mixins.ConsumerMixin):
     def __init__(self, name, connection, deployment, durable, queue_arguments,
-                 exchange, topics):
+                 exchange, topics, batch_size=1, batch_timeout=1.0,
+                 transactional=False, lifecycle_engine=None,
+                 post_process=True, shards=None, spool=None,
+                 spool_latency=None, spool_retry_interval=5,
+                 update_policy=None, prefetch=None, exists_burst=None,
+                 lanes=None, recycle_after=0, recycle_rss_growth=0):
         self.connection = connection
         self.deployment = deployment
         self.durable = durable
@@ -62,6 +88,53 @@ class Consumer(kombu.mixins.ConsumerMixin):
         self.total_processed = 0
         self.topics = topics
         self.exchange = exchange
+        # With a batch_size above 1 messages are held until the batch is
+        # full or batch_timeout seconds have passed, then saved in a
+        # single transaction and acked together.
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch = []
+        self.batch_started = None
+        # When transactional, post processing happens in the same
+        # transaction as the raw insert and the ack waits for the commit.
+        self.transactional = transactional
+        self.lifecycle_engine = lifecycle_engine
+        # Turned off when the aggregator process does the post processing
+        # and we only need to get the raws saved.
+        self.post_process = post_process
+        # With shards, messages are handed to a ShardPool to be processed
+        # and acked here once a shard reports them done.
+        self.shards = shards
+        self.in_flight = {}
+        # With a spool, messages go to local disk while the database is
+        # failing or slower than spool_latency seconds a message, and are
+        # replayed in order once it recovers.
+        self.spool = spool
+        self.spool_latency = spool_latency
+        self.spool_retry_interval = spool_retry_interval
+        self.spooled = []
+        self.latency = 0.0
+        self.retry_at = 0
+        # Anything left in the spool from last time has to go first.
+        self.spooling = spool is not None and not spool.empty()
+        # Decides which compute.instance.update messages are worth saving.
+        self.update_policy = update_policy or ingest_policy.StoreAll()
+        # With an exists_burst, the exists that follow each audit period
+        # are gathered up and saved in batches while they're pouring in.
+        self.exists_burst = exists_burst
+        # With lanes, messages are read ahead and usage events processed
+        # before the updates that arrived ahead of them.
+        self.lanes = lanes
+        # Without a prefetch the broker sends us everything it has.
+        self.prefetch = prefetch
+        self.channel = None
+        self.acker = flow_control.Acker()
+        # Long running workers fragment their memory, so once this many
+        # messages are processed, or RSS has grown by this many bytes, we
+        # finish what we're holding and exit to be started afresh.
+        self.recycle_after = recycle_after
+        self.recycle_rss_growth = recycle_rss_growth
+        self.recycling = False
         signal.signal(signal.SIGTERM, self._shutdown)
 
     def _create_exchange(self, name, type, exclusive=False, auto_delete=False):
@@ -84,29 +157,372 @@ class Consumer(kombu.mixins.ConsumerMixin):
                                      topic['routing_key'])
                   for topic in self.topics]
 
-        return [Consumer(queues=queues, callbacks=[self.on_nova])]
+        # Called for every new channel, including when kombu reconnects.
+        self.channel = channel
+        self.acker.reset()
+        if self.prefetch is not None:
+            self._set_prefetch(self.prefetch.count)
 
-    def _process(self, message):
+        return [Consumer(queues=queues, on_message=self.on_message)]
+
+    def _set_prefetch(self, count):
+        # Global, so the window is shared by all our queues on the channel
+        # rather than each getting one of its own.
+        self.channel.basic_qos(0, count, True)
+
+    def consume(self, *args, **kwargs):
+        # Wake up often enough to honour the batch timeout, ack what the
+        # shards have finished or sync the spool when the queue goes quiet.
+        intervals = [1]
+        if self.lanes is not None:
+            intervals.append(self.lanes.wait)
+        if self.shards is not None:
+            intervals.append(0.1)
+        elif self.batch_size > 1 or self.exists_burst is not None:
+            intervals.append(self.batch_timeout)
+        if self.spool is not None:
+            intervals.append(self.spool.sync_interval)
+        kwargs.setdefault('safety_interval', min(intervals))
+        return super(Consumer, self).consume(*args, **kwargs)
+
+    def _decode(self, message):
         routing_key = message.delivery_info['routing_key']
 
         body = str(message.body)
-        args = (routing_key, json.loads(body))
-        asJson = json.dumps(args)
-        # save raw and ack the message
-        raw, notif = views.process_raw_data(
-            self.deployment, args, asJson, self.exchange)
+        with views.STATS.timer('decode'):
+            args = (routing_key, peek.body(message))
+        # Rather than serializing the parsed body all over again, wrap the
+        # body we were sent. It loads back into the same (routing_key, body)
+        # pair that json.dumps(args) would have given us.
+        asJson = '[%s, %s]' % (json.dumps(routing_key), body)
+        return args, asJson
+
+    def _post_process(self, results, on_error=None):
+        """Post processes (raw, notification) pairs. With on_error, one
+        that fails is handed to it along with the exception rather than
+        stopping the rest."""
+        if not self.post_process:
+            return
+        # Duplicates were processed the first time round.
+        results = [(raw, notif) for raw, notif in results if raw is not None]
+        if len(results) > 1:
+            # A batch all comes from the one exchange.
+            name = results[0][0].get_name()
+            if name in BATCH_POST_PROCESS_METHODS:
+                BATCH_POST_PROCESS_METHODS[name](results, on_error=on_error)
+                return
+        for raw, notif in results:
+            try:
+                POST_PROCESS_METHODS[raw.get_name()](raw, notif)
+            except Exception, e:
+                if on_error is None:
+                    raise
+                on_error(raw, notif, e)
+
+    def _post_process_failed(self, raw, notif, e):
+        # The message was acked before it was post processed, so it won't
+        # be redelivered. All that's left is to say what was lost.
+        _get_child_logger().exception(
+            "%s %s: post processing raw %s (message_id %s) failed after "
+            "it was acked: %s" % (self.name, self.exchange, raw.id,
+                                  notif.message_id, e))
+        views.STATS.count('post_process_failures')
+
+    def _process(self, message):
+        args, asJson = self._decode(message)
+        if self.transactional:
+            # save raw, post process and only ack once it's all committed
+            with db.commit_on_success():
+                raw, notif = views.process_raw_data(
+                    self.deployment, args, asJson, self.exchange)
+                self._post_process([(raw, notif)])
+
+            self.processed += 1
+            self._ack(message)
+        else:
+            # save raw and ack the message
+            raw, notif = views.process_raw_data(
+                self.deployment, args, asJson, self.exchange)
+
+            self.processed += 1
+            self._ack(message)
+            self._post_process([(raw, notif)])
 
-        self.processed += 1
-        message.ack()
-        POST_PROCESS_METHODS[raw.get_name()](raw, notif)
+        views.STATS.message(notif)
+        self._check_memory()
+
+    def _ack(self, message):
+        with views.STATS.timer('ack'):
+            self.acker.ack([message])
+
+    def _ack_all(self, messages):
+        start = time.time()
+        self.acker.ack(messages)
+        views.STATS.record('ack', time.time() - start, len(messages))
+
+    def _add_to_batch(self, message):
+        if not self.batch:
+            self.batch_started = time.time()
+        self.batch.append(message)
+        if len(self.batch) >= self.batch_size:
+            self._process_batch()
+
+    def _batch_expired(self):
+        return (self.batch and
+                time.time() - self.batch_started >= self.batch_timeout)
+
+    def _process_batch(self, messages=None):
+        if messages is None:
+            messages = self.batch
+            self.batch = []
+            self.batch_started = None
 
+        try:
+            start = time.time()
+            decoded = [self._decode(message) for message in messages]
+            # save all the raws in one transaction, only ack once committed
+            with db.commit_on_success():
+                results = views.process_raw_data_batch(
+                    self.deployment, decoded, self.exchange)
+                if self.transactional:
+                    self._post_process(results)
+
+            self.processed += len(messages)
+            self._ack_all(messages)
+            if not self.transactional:
+                # Past the ack a failure can't get the batch redelivered,
+                # and would only cost the messages after it.
+                self._post_process(results,
+                                   on_error=self._post_process_failed)
+            for raw, notif in results:
+                views.STATS.message(notif)
+        except Exception, e:
+            _get_child_logger().debug("Problem: %s\nFailed batch of %d "
+                                      "messages" % (e, len(messages)))
+            self._discard_cached_rows()
+            if not self._should_spool(e):
+                raise
+            self._start_spooling(e)
+            self._spool(messages)
+            return
+
+        self._record_latency((time.time() - start) / len(messages))
+        if self._too_slow():
+            self._start_spooling("averaging %.0fms a message" %
+                                 (self.latency * 1000))
         self._check_memory()
 
+    def _route(self, message):
+        routing_key = message.delivery_info['routing_key']
+        body = str(message.body)
+        # What has to be handled in order, and by the same shard.
+        key = peek.key(message, self.exchange)
+        self.in_flight[message.delivery_tag] = message
+        self.shards.put(key, (message.delivery_tag, routing_key, body))
+
+    def _ack_finished(self):
+        finished = []
+        for tag, error in self.shards.finished():
+            if error is not None:
+                # Bail out like a failure here would, so the connection is
+                # dropped and anything unacked gets redelivered.
+                raise Exception("Shard failed: %s" % error)
+            finished.append(self.in_flight.pop(tag))
+        if not finished:
+            return
+        self._ack_all(finished)
+        self.processed += len(finished)
+        for message in finished:
+            views.STATS.message()
+
+    def on_iteration(self):
+        if self.lanes is not None:
+            for message in self.lanes.expired():
+                self._dispatch(message)
+        if self.shards is not None:
+            self._ack_finished()
+        for message in self.update_policy.expired():
+            self._admit(message)
+        if self.exists_burst is not None:
+            held = self.exists_burst.expired()
+            if held:
+                self._handle_bulk(held)
+        if self._batch_expired():
+            self._process_batch()
+        if self.lifecycle_engine is not None:
+            self.lifecycle_engine.maybe_flush()
+        if self.prefetch is not None and self.channel is not None:
+            count = self.prefetch.update()
+            if count is not None:
+                _get_child_logger().info("%s %s: prefetch now %d" %
+                                         (self.name, self.exchange, count))
+                self._set_prefetch(count)
+        if self.spool is not None:
+            if self.spooled and self.spool.needs_sync():
+                self._sync_spool()
+            if self.spooling and time.time() >= self.retry_at:
+                self._drain_spool()
+        views.STATS.maybe_write()
+
+    def on_consume_end(self, connection, channel):
+        # We only stop consuming when told to, by SIGTERM or to be
+        # recycled, and either way the channel is still open to ack on.
+        self._drain()
+        # Ack what's already safely on disk while we still can.
+        if self.spooled:
+            self._sync_spool()
+
+    def _drain(self):
+        """Processes and acks everything held back, so nothing is left to
+        be redelivered once we're gone."""
+        held = len(self.batch)
+        if self.lanes is not None:
+            messages = self.lanes.flush()
+            held += len(messages)
+            for message in messages:
+                self._dispatch(message)
+        messages = self.update_policy.flush()
+        held += len(messages)
+        for message in messages:
+            self._admit(message)
+        if self.exists_burst is not None:
+            messages = self.exists_burst.flush()
+            held += len(messages)
+            if messages:
+                self._handle_bulk(messages)
+        if self.batch:
+            self._process_batch()
+        finished = 0
+        if self.shards is not None:
+            finished = self._stop_shards()
+        if self.lifecycle_engine is not None:
+            self.lifecycle_engine.flush()
+        _get_child_logger().info("%s %s: drained %d held messages, %d from "
+                                 "shards" % (self.name, self.exchange, held,
+                                             finished))
+
+    def _discard_held(self):
+        """Forgets everything held back without processing it."""
+        self.batch = []
+        self.batch_started = None
+        if self.lanes is not None:
+            self.lanes.flush()
+        self.update_policy.flush()
+        if self.exists_burst is not None:
+            self.exists_burst.flush()
+
+    def _stop_shards(self):
+        """Has the shards finish everything they were handed and acks it,
+        returning how many messages that was."""
+        finished = []
+        for tag, error in self.shards.stop():
+            if error is not None:
+                _get_child_logger().error("%s %s: shard failed while "
+                                          "stopping: %s" %
+                                          (self.name, self.exchange, error))
+                continue
+            finished.append(self.in_flight.pop(tag))
+        if finished:
+            self._ack_all(finished)
+            self.processed += len(finished)
+        return len(finished)
+
+    def _discard_cached_rows(self):
+        # Rows created in a transaction that failed aren't in the database,
+        # so they mustn't be handed out again.
+        if views.USAGE_CACHE is not None:
+            views.USAGE_CACHE.clear()
+        if self.lifecycle_engine is not None:
+            self.lifecycle_engine.discard()
+
+    def _should_spool(self, e):
+        return self.spool is not None and db.is_database_failure(e)
+
+    def _record_latency(self, seconds):
+        # A moving average, so one slow message doesn't trip the spool.
+        self.latency = 0.9 * self.latency + 0.1 * seconds
+        if self.prefetch is not None:
+            self.prefetch.record(seconds)
+
+    def _too_slow(self):
+        return (self.spool is not None and self.spool_latency and
+                self.latency > self.spool_latency)
+
+    def _start_spooling(self, reason):
+        if not self.spooling:
+            _get_child_logger().warn("%s %s: spooling to %s (%s)" %
+                                     (self.name, self.exchange,
+                                      self.spool.directory, reason))
+        self.spooling = True
+        self.latency = 0.0
+        self.retry_at = time.time() + self.spool_retry_interval
+        # Start over with a fresh connection when we retry.
+        close_connection()
+
+    def _spool(self, messages):
+        for message in messages:
+            if message.acknowledged:
+                # Already saved, only post processing failed.
+                continue
+            self.spool.append(message.delivery_info['routing_key'],
+                              str(message.body))
+            self.spooled.append(message)
+        if self.spool.needs_sync():
+            self._sync_spool()
+
+    def _sync_spool(self):
+        self.spool.sync()
+        if self.spooled:
+            self._ack_all(self.spooled)
+        self.processed += len(self.spooled)
+        self.spooled = []
+
+    def _drain_spool(self):
+        # What we're holding has to be on disk, and acked, before anything
+        # is replayed or new messages could overtake it.
+        self._sync_spool()
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            records = self.spool.peek(100)
+            if not records:
+                self.spooling = False
+                _get_child_logger().info("%s %s: spool drained" %
+                                         (self.name, self.exchange))
+                return
+            replayed = 0
+            try:
+                for routing_key, body in records:
+                    self._replay(routing_key, body)
+                    replayed += 1
+            except Exception, e:
+                self.spool.advance(replayed)
+                self._start_spooling(e)
+                return
+            self.spool.advance(replayed)
+            if self._too_slow():
+                self._start_spooling("still averaging %.0fms a message" %
+                                     (self.latency * 1000))
+                return
+
+    def _replay(self, routing_key, body):
+        start = time.time()
+        try:
+            self._process(_SpooledMessage(routing_key, body))
+        except Exception, e:
+            if db.is_database_failure(e):
+                raise
+            # Replaying won't fix this one, skip it.
+            _get_child_logger().exception(
+                "Problem: %s\nDropping spooled message body:\n%s" %
+                (e, body))
+        self._record_latency(time.time() - start)
+
     def _check_memory(self):
         if not self.pmi:
             self.pmi = ProcessMemoryInfo()
             self.last_vsz = self.pmi.vsz
             self.initial_vsz = self.pmi.vsz
+            self.initial_rss = self.pmi.rss
 
         utc = datetime.datetime.utcnow()
         check = self.last_time is None
@@ -129,14 +545,93 @@ class Consumer(kombu.mixins.ConsumerMixin):
                       self.total_processed, per_message))
             self.last_vsz = self.pmi.vsz
             self.processed = 0
+        self._check_recycle()
+
+    def _check_recycle(self):
+        if self.recycling:
+            return
+        reason = None
+        processed = self.total_processed + self.processed
+        if self.recycle_after and processed >= self.recycle_after:
+            reason = "processed %d messages" % processed
+        elif self.recycle_rss_growth:
+            growth = self.pmi.rss - self.initial_rss
+            if growth >= self.recycle_rss_growth:
+                reason = "RSS grew %dk" % (growth / 1000)
+        if reason is None:
+            return
+        _get_child_logger().info("%s %s: recycling, %s" %
+                                 (self.name, self.exchange, reason))
+        self.recycling = True
+        self.should_stop = True
+
+    def on_message(self, message):
+        # Registered with kombu as on_message rather than as a callback so
+        # we're handed the message undecoded. Whatever looks at the body
+        # goes through peek, which keeps it on the message once decoded,
+        # so it's still only parsed once.
+        self.acker.delivered(message)
+        if self.lanes is None:
+            self._dispatch(message)
+            return
+        for message in self.lanes.admit(message, peek.event(message),
+                                        peek.key(message, self.exchange)):
+            self._dispatch(message)
+
+    def _dispatch(self, message):
+        if self.shards is not None:
+            self._route(message)
+        else:
+            self.on_nova(None, message)
 
     def on_nova(self, body, message):
+        ready, dropped = self.update_policy.admit(message)
+        for message in dropped:
+            self._ack(message)
+            self.processed += 1
+            views.STATS.count('dropped_updates')
+        for message in ready:
+            self._admit(message)
+
+    def _admit(self, message):
+        if self.exists_burst is None:
+            self._handle(message)
+            return
+        held, ready = self.exists_burst.admit(message)
+        if held:
+            self._handle_bulk(held)
+        for message in ready:
+            self._handle(message)
+
+    def _handle_bulk(self, messages):
+        if self.spooling:
+            self._spool(messages)
+            return
+        self._process_batch(messages)
+
+    def _handle(self, message):
+        if self.spooling:
+            self._spool([message])
+            return
+        if self.batch_size > 1:
+            self._add_to_batch(message)
+            return
         try:
+            start = time.time()
             self._process(message)
         except Exception, e:
             _get_child_logger().debug("Problem: %s\nFailed message body:\n%s" %
-                      (e, json.loads(str(message.body))))
-            raise
+                      (e, message.body))
+            self._discard_cached_rows()
+            if not self._should_spool(e):
+                raise
+            self._start_spooling(e)
+            self._spool([message])
+            return
+        self._record_latency(time.time() - start)
+        if self._too_slow():
+            self._start_spooling("averaging %.0fms a message" %
+                                 (self.latency * 1000))
 
     def _shutdown(self, signal, stackframe = False):
         global shutdown_soon
@@ -144,6 +639,227 @@ class Consumer(kombu.mixins.ConsumerMixin):
         shutdown_soon = True
 
 
+class _SpooledMessage(object):
+    """Stands in for the kombu message when replaying from the spool.
+    It was acked when it went into the spool."""
+
+    acknowledged = False
+
+    def __init__(self, routing_key, body):
+        self.delivery_info = {'routing_key': routing_key}
+        self.body = body
+
+    def ack(self):
+        pass
+
+
+class _ShardMessage(object):
+    """Stands in for the kombu message inside a shard. Acking it tells
+    the consumer process to ack the real message."""
+
+    def __init__(self, delivery_tag, routing_key, body, done,
+                 unfinished=None):
+        self.delivery_tag = delivery_tag
+        self.delivery_info = {'routing_key': routing_key}
+        self.body = body
+        self.done = done
+        # The delivery tags the shard has yet to report.
+        self.unfinished = unfinished
+
+    def ack(self):
+        if self.unfinished is not None:
+            self.unfinished.discard(self.delivery_tag)
+        self.done.put((self.delivery_tag, None))
+
+
+def _create_stats(stats_dir, stats_interval, name, exchange, shard=None):
+    if not stats_dir:
+        return stats.NullStats()
+    filename = '%s_%s' % (name, exchange)
+    if shard is not None:
+        filename = '%s_shard%d' % (filename, shard)
+    return stats.WorkerStats(os.path.join(stats_dir, '%s.json' % filename),
+                             name, exchange, interval=stats_interval)
+
+
+def _shard_main(consumer_args, consumer_kwargs, lifecycle_cache_size,
+                lifecycle_flush_interval, stats_dir, stats_interval, shard,
+                inbox, done, deduplicator=None, usage_cache_size=0):
+    name, exchange = consumer_args[0], consumer_args[5]
+    views.STATS = _create_stats(stats_dir, stats_interval, name, exchange,
+                                shard=shard)
+    # Redeliveries go to the same shard as the first copy, so each shard
+    # only needs to remember its own messages.
+    if deduplicator is not None:
+        # We only ack a message once its shard has reported it, and the
+        # shard goes straight on to post process it. So a redelivered
+        # copy has almost certainly been post processed, and doing it
+        # again would count it twice.
+        deduplicator.transactional = True
+    views.DEDUP = deduplicator
+    engine = None
+    if lifecycle_cache_size:
+        # A shard owns its instances outright, so its cache can't go
+        # stale behind another process' back.
+        engine = lifecycle_engine.LifecycleStateEngine(
+            db, max_instances=lifecycle_cache_size,
+            flush_interval=lifecycle_flush_interval)
+        views.STATS.add_cache('lifecycle', engine)
+    views.LIFECYCLE_ENGINE = engine
+    cache = None
+    if usage_cache_size:
+        cache = usage_cache.UsageCache(db, max_instances=usage_cache_size)
+        views.STATS.add_cache('usage', cache)
+    views.USAGE_CACHE = cache
+    consumer = Consumer(*consumer_args, lifecycle_engine=engine,
+                        **consumer_kwargs)
+    # The Consumer takes SIGTERM as a request to finish up, which this
+    # loop never looks at. The pool only terminates a shard to throw away
+    # what it's doing, and stops it through the inbox otherwise.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    unfinished = set()
+    while True:
+        try:
+            try:
+                item = inbox.get(timeout=min(1, consumer.batch_timeout))
+            except Queue.Empty:
+                consumer.on_iteration()
+                continue
+            if item is None:
+                break
+            delivery_tag, routing_key, body = item
+            unfinished.add(delivery_tag)
+            consumer.on_nova(None, _ShardMessage(delivery_tag, routing_key,
+                                                 body, done, unfinished))
+            consumer.on_iteration()
+        except Exception, e:
+            # As when a worker fails, everything not yet acked has failed
+            # with it: the consumer gives up what it was holding, and each
+            # message is reported so it can be accounted for.
+            consumer._discard_held()
+            for tag in sorted(unfinished):
+                done.put((tag, str(e)))
+            unfinished.clear()
+        if consumer.recycling:
+            break
+
+    # Everything we've been handed is reported done before we go, so the
+    # consumer can ack it. When recycling, the pool starts a new shard on
+    # the same inbox and anything still in it is picked up from there.
+    consumer._drain()
+    if consumer.recycling:
+        sys.exit(RECYCLE_EXIT_CODE)
+
+
+class ShardPool(object):
+    """A set of processes that save and post process messages for a
+    single consumer. Each message goes to the process picked by its
+    instance (or image), so the events for an instance are still handled
+    one at a time and in order while different instances run in
+    parallel."""
+
+    def __init__(self, count, consumer_args, consumer_kwargs,
+                 lifecycle_cache_size=0, lifecycle_flush_interval=5,
+                 stats_dir=None, stats_interval=10, deduplicator=None,
+                 usage_cache_size=0):
+        self.count = count
+        self.consumer_args = consumer_args
+        self.consumer_kwargs = consumer_kwargs
+        self.lifecycle_cache_size = lifecycle_cache_size
+        self.lifecycle_flush_interval = lifecycle_flush_interval
+        self.stats_dir = stats_dir
+        self.stats_interval = stats_interval
+        self.deduplicator = deduplicator
+        self.usage_cache_size = usage_cache_size
+        self.processes = []
+        self.inboxes = []
+        self.done = None
+        self.next_shard = 0
+
+    def start(self):
+        # The shards must not share our db connection.
+        close_connection()
+        self.done = multiprocessing.Queue()
+        for i in range(self.count):
+            self.inboxes.append(multiprocessing.Queue())
+            self.processes.append(self._start_shard(i))
+
+    def _start_shard(self, shard):
+        process = multiprocessing.Process(
+            target=_shard_main,
+            args=(self.consumer_args, self.consumer_kwargs,
+                  self.lifecycle_cache_size,
+                  self.lifecycle_flush_interval, self.stats_dir,
+                  self.stats_interval, shard, self.inboxes[shard],
+                  self.done, self.deduplicator, self.usage_cache_size))
+        process.daemon = True
+        process.start()
+        return process
+
+    def stop(self):
+        """Waits for the shards to finish what they've been handed and
+        returns (delivery_tag, error) for everything finished since the
+        last call to finished()."""
+        for process, inbox in zip(self.processes, self.inboxes):
+            if process.is_alive():
+                inbox.put(None)
+        results = []
+        for process in self.processes:
+            # A process won't exit with results still buffered for the
+            # done queue, so keep emptying it.
+            while process.is_alive():
+                results.extend(self._drain())
+                process.join(0.1)
+        if self.processes:
+            results.extend(self._drain())
+        self.processes = []
+        self.inboxes = []
+        return results
+
+    def terminate(self):
+        """Stops the shards where they are, dropping whatever is still
+        queued for them."""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.inboxes = []
+
+    def _drain(self):
+        results = []
+        while True:
+            try:
+                results.append(self.done.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def put(self, key, item):
+        if key is None:
+            # Nothing to keep in order, so just spread these around.
+            shard = self.next_shard
+            self.next_shard = (self.next_shard + 1) % self.count
+        else:
+            shard = zlib.crc32(key) % self.count
+        self.inboxes[shard].put(item)
+
+    def finished(self):
+        """Returns (delivery_tag, error) for everything the shards have
+        finished since the last call."""
+        results = self._drain()
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if process.exitcode == RECYCLE_EXIT_CODE:
+                close_connection()
+                self.processes[shard] = self._start_shard(shard)
+            elif not results:
+                raise Exception("Shard %s died" % process.pid)
+        return results
+
+
 def continue_running():
     return not shutdown_soon
 
@@ -165,9 +881,130 @@ def run(deployment_config, deployment_id, exchange):
     queue_arguments = deployment_config.get('queue_arguments', {})
     exit_on_exception = deployment_config.get('exit_on_exception', False)
     topics = deployment_config.get('topics', {})
+    batch_size = deployment_config.get('batch_size', 1)
+    batch_timeout = deployment_config.get('batch_timeout_ms', 1000) / 1000.0
+    transactional = deployment_config.get('transactional_ingest', False)
+    lifecycle_cache_size = deployment_config.get('lifecycle_cache_size', 0)
+    lifecycle_flush_interval = deployment_config.get(
+        'lifecycle_flush_interval', 5)
+    usage_cache_size = deployment_config.get('usage_cache_size', 0)
+    pipeline = deployment_config.get('aggregation_pipeline', False)
+    worker_processes = deployment_config.get('worker_processes', 1)
+    stats_dir = deployment_config.get('stats_dir', None)
+    stats_interval = deployment_config.get('stats_interval', 10)
+    spool_dir = deployment_config.get('spool_dir', None)
+    spool_latency_ms = deployment_config.get('spool_latency_ms', None)
+    spool_retry_interval = deployment_config.get('spool_retry_interval', 5)
+    spool_segment_mb = deployment_config.get('spool_segment_mb', 64)
+    compress_raw_json = deployment_config.get('compress_raw_json', False)
+    dedup_capacity = deployment_config.get('dedup_capacity', 0)
+    dedup_error_rate = deployment_config.get('dedup_error_rate', 0.001)
+    dedup_window = deployment_config.get('dedup_window', 86400)
+    dedup_drop = deployment_config.get('dedup_drop', True)
+    dedup_seed = deployment_config.get('dedup_seed', 10000)
+    update_policy = deployment_config.get('update_policy', 'store-all')
+    update_sample_rate = deployment_config.get('update_sample_rate', 10)
+    update_coalesce_window = deployment_config.get('update_coalesce_window',
+                                                   60)
+    update_coalesce_max = deployment_config.get('update_coalesce_max', 1000)
+    prefetch_count = deployment_config.get('prefetch_count', 0)
+    if isinstance(prefetch_count, dict):
+        prefetch_count = prefetch_count.get(exchange, 0)
+    adaptive_prefetch = deployment_config.get('adaptive_prefetch', False)
+    prefetch_min = deployment_config.get('prefetch_min', 1)
+    prefetch_max = deployment_config.get('prefetch_max', 1000)
+    prefetch_buffer_ms = deployment_config.get('prefetch_buffer_ms', 1000)
+    exists_burst_threshold = deployment_config.get('exists_burst_threshold',
+                                                   0)
+    exists_batch_size = deployment_config.get('exists_batch_size', 500)
+    lane_config = priority.lanes_for(
+        deployment_config.get('priority_lanes', None), exchange)
+    priority_depth = deployment_config.get('priority_depth', 100)
+    priority_wait = deployment_config.get('priority_wait_ms', 100) / 1000.0
+    recycle_after = deployment_config.get('recycle_after_messages', 0)
+    recycle_rss_growth = deployment_config.get('recycle_rss_growth_mb',
+                                               0) * 1000 * 1000
     logger = _get_child_logger()
 
     deployment = db.get_deployment(deployment_id)
+    views.STATS = _create_stats(stats_dir, stats_interval, name, exchange)
+    fields.COMPRESS = compress_raw_json
+
+    spool = None
+    if spool_dir and worker_processes == 1:
+        spool = disk_spool.Spool(
+            os.path.join(spool_dir, '%s_%s' % (name, exchange)),
+            segment_bytes=spool_segment_mb * 1024 * 1024)
+    elif spool_dir:
+        # The shards write to the database themselves, so there's nothing
+        # here that could fall back to the spool.
+        logger.warning("%s %s: spool_dir is ignored with worker_processes "
+                       "%d" % (name, exchange, worker_processes))
+    spool_latency = None
+    if spool_latency_ms:
+        spool_latency = spool_latency_ms / 1000.0
+
+    engine = None
+    if lifecycle_cache_size and not pipeline and worker_processes == 1:
+        engine = lifecycle_engine.LifecycleStateEngine(
+            db, max_instances=lifecycle_cache_size,
+            flush_interval=lifecycle_flush_interval)
+        views.STATS.add_cache('lifecycle', engine)
+    views.LIFECYCLE_ENGINE = engine
+
+    cache = None
+    if usage_cache_size and not pipeline and worker_processes == 1:
+        cache = usage_cache.UsageCache(db, max_instances=usage_cache_size)
+        views.STATS.add_cache('usage', cache)
+    views.USAGE_CACHE = cache
+
+    deduplicator = None
+    if dedup_capacity:
+        deduplicator = dedup.Deduplicator(
+            dedup.raw_model(exchange), dedup_capacity,
+            error_rate=dedup_error_rate, window=dedup_window,
+            drop=dedup_drop, transactional=transactional)
+        deduplicator.seed(dedup_seed)
+    views.DEDUP = deduplicator
+
+    if exchange != 'nova':
+        update_policy = 'store-all'
+    policy_args = (update_policy, update_sample_rate, update_coalesce_window,
+                   update_coalesce_max)
+    # Check it now rather than failing on every reconnect.
+    ingest_policy.create(*policy_args)
+
+    # A batch already gathers up the exists with everything else.
+    if exchange != 'nova' or batch_size > 1:
+        exists_burst_threshold = 0
+    if exists_burst_threshold:
+        most_held = exists_batch_size
+    else:
+        most_held = batch_size
+
+    lane_args = None
+    if lane_config:
+        lane_args = (lane_config, priority_depth, priority_wait)
+        # Check them now rather than failing on every reconnect.
+        priority.PriorityLanes(*lane_args)
+        most_held += priority_depth
+    if update_policy == 'coalesce':
+        # Each worker process holds its own updates.
+        most_held += update_coalesce_max * worker_processes
+
+    # A batch can never fill if the broker won't send us that many, the
+    # lanes can only pick from what it has sent, and held updates mustn't
+    # use up the window and stop it sending anything more.
+    prefetch_min = max(prefetch_min, most_held)
+    prefetch = None
+    if adaptive_prefetch:
+        prefetch = flow_control.AdaptivePrefetch(
+            max(prefetch_count or prefetch_max, prefetch_min),
+            minimum=prefetch_min, maximum=max(prefetch_max, prefetch_min),
+            buffer=prefetch_buffer_ms / 1000.0)
+    elif prefetch_count:
+        prefetch = flow_control.FixedPrefetch(max(prefetch_count,
+                                                  most_held))
 
     print "Starting worker for '%s %s'" % (name, exchange)
     logger.info("%s: %s %s %s %s %s" %
@@ -182,22 +1019,88 @@ def run(deployment_config, deployment_id, exchange):
 
     # continue_running() is used for testing
     while continue_running():
+        recycle = False
         try:
             logger.debug("Processing on '%s %s'" % (name, exchange))
             with kombu.connection.BrokerConnection(**params) as conn:
+                # Messages held by the policy belong to this connection,
+                # so every connection starts with a fresh one.
+                policy = ingest_policy.create(*policy_args)
+                lanes = None
+                if lane_args is not None:
+                    lanes = priority.PriorityLanes(*lane_args)
+                burst = None
+                if exists_burst_threshold:
+                    burst = exists_burst.ExistsBurst(
+                        threshold=exists_burst_threshold,
+                        batch_size=exists_batch_size, timeout=batch_timeout)
+                shards = None
+                if worker_processes > 1:
+                    shards = ShardPool(
+                        worker_processes,
+                        (name, None, deployment, durable, queue_arguments,
+                         exchange, topics[exchange]),
+                        dict(batch_size=batch_size,
+                             batch_timeout=batch_timeout,
+                             transactional=transactional,
+                             post_process=not pipeline,
+                             update_policy=policy,
+                             exists_burst=burst,
+                             recycle_after=recycle_after,
+                             recycle_rss_growth=recycle_rss_growth),
+                        lifecycle_cache_size=(0 if pipeline
+                                              else lifecycle_cache_size),
+                        lifecycle_flush_interval=lifecycle_flush_interval,
+                        stats_dir=stats_dir, stats_interval=stats_interval,
+                        deduplicator=deduplicator,
+                        usage_cache_size=(0 if pipeline
+                                          else usage_cache_size))
+                    shards.start()
                 try:
                     consumer = Consumer(name, conn, deployment, durable,
                                         queue_arguments, exchange,
-                                        topics[exchange])
+                                        topics[exchange],
+                                        batch_size=batch_size,
+                                        batch_timeout=batch_timeout,
+                                        transactional=transactional,
+                                        lifecycle_engine=engine,
+                                        post_process=not pipeline,
+                                        shards=shards, spool=spool,
+                                        spool_latency=spool_latency,
+                                        spool_retry_interval=(
+                                            spool_retry_interval),
+                                        update_policy=(None if shards
+                                                       else policy),
+                                        prefetch=prefetch,
+                                        exists_burst=(None if shards
+                                                      else burst),
+                                        lanes=lanes,
+                                        recycle_after=(0 if shards
+                                                       else recycle_after),
+                                        recycle_rss_growth=(
+                                            0 if shards
+                                            else recycle_rss_growth))
                     consumer.run()
+                    recycle = consumer.recycling
                 except Exception as e:
                     logger.error("!!!!Exception!!!!")
                     logger.exception(
                         "name=%s, exchange=%s, exception=%s. "
                         "Reconnecting in 5s" % (name, exchange, e))
                     exit_or_sleep(exit_on_exception)
+                finally:
+                    if shards is not None:
+                        # Only still running if we failed, and then
+                        # everything unacked is redelivered, so they
+                        # mustn't carry on with what's queued for them.
+                        shards.terminate()
             logger.debug("Completed processing on '%s %s'" %
                                       (name, exchange))
+            if recycle:
+                logger.info("%s %s: exiting to be recycled" %
+                            (name, exchange))
+                close_connection()
+                sys.exit(RECYCLE_EXIT_CODE)
         except Exception:
             logger.error("!!!!Exception!!!!")
             e = sys.exc_info()[0]
@@ -205,6 +1108,7 @@ def run(deployment_config, deployment_id, exchange):
                   "exception=%s. Retrying in 5s"
             logger.exception(msg % (name, exchange, e))
             exit_or_sleep(exit_on_exception)
+    close_connection()
     logger.info("Worker exiting.")
 
 signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -215,3 +1119,7 @@ POST_PROCESS_METHODS = {
     'GlanceRawData': views.post_process_glancerawdata,
     'GenericRawData': views.post_process_genericrawdata
 }
+
+BATCH_POST_PROCESS_METHODS = {
+    'RawData': views.post_process_rawdata_batch,
+}